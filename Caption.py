@@ -4,14 +4,14 @@ import json
 from argparse import ArgumentParser
 import warnings
 from tokenizers import Tokenizer
-import torch.nn.functional as F
-from torchvision.transforms import v2
-from torchvision.io import read_image
-from base_files.transformer_files.dataclass import transformerconfig
-from base_files.transformer_files.transformer import transformer
-from llama_architecture import transformer as llama_transformer
-from llama_architecture import mArgs
-from base_files.cnn_model_files.cnn_model import get_cnn_model
+from base_files.inference_files.model_loader import load_caption_model, load_draft_model, get_backbone
+from base_files.inference_files.retrieval_index import open_index
+from base_files.inference_files.bundle import modelbundle, is_bundle
+from base_files.inference_files.speculative import generate_speculative
+from base_files.inference_files.sampling import sampler
+from base_files.dataset_files.image_transforms import preprocess_image, decode_image
+from base_files.inference_files.caption_cache import captioncache, checkpoint_id
+from base_files.runtime_files.precision import precisionpolicy
 
 
 @torch.no_grad()
@@ -20,11 +20,32 @@ def CaptionGenerator(JsonPath:str,
                      TokenSize: str,
                      Temprature: str = '1.0',
                      Topk: str = '100',
-                     SpecialPath = None):
+                     SpecialPath = None,
+                     Cache: captioncache = None,
+                     DraftPath: str = None,
+                     Topp: str = None,
+                     Minp: str = None,
+                     IndexPath: str = None):
+    '''
+    Cache is optional, if it is given repeated requests (same image content,
+    checkpoint and decoding parameters) are answered without the model.
+    With a draft model (DraftPath or 'speculative_config') the caption is
+    generated with speculative decoding.
+    With IndexPath near duplicates of already captioned images (similar Cnn
+    model features, see retrievalindex) get the stored caption without
+    loading the decoder. The namespace of the index is the checkpoint and
+    the decoding parameters (built like the cache keys), so a stored
+    caption is only returned for the settings it was sampled with, an index
+    saved with other settings is not reused.
+    SpecialPath can be a model bundle (see export_bundle.py), JsonPath is
+    optional then and nothing is downloaded.
+    '''
 
     TokenSize = int(TokenSize)
     Topk = int(Topk)
     Temprature = float(Temprature)
+    Topp = None if Topp is None else float(Topp)
+    Minp = None if Minp is None else float(Minp)
     device = 'cpu'
 
     # Use GPU if it is available
@@ -42,126 +63,180 @@ def CaptionGenerator(JsonPath:str,
     null = None
 
     # Importing json file
-    with open (JsonPath, 'r') as f:
-        data = json.load(f)
+    data = None
+    if JsonPath is not None:
+        with open (JsonPath, 'r') as f:
+            data = json.load(f)
 
     if SpecialPath is None:
         ModelPath = data['model_config']['existing_path']
     else:
         ModelPath = SpecialPath
+
+    # A bundle has the model structure, weights and tokenizer in one file
+    Bundle = None
+    if is_bundle(ModelPath):
+        Bundle = modelbundle(ModelPath)
+        data = Bundle.config(data)
     ModelName = data['transformer_config']['model_name']
 
     # Importing tokenizer
-    TokenizerPath = data["tokenizer_config"]['tokenizer_load_path']
-    tokenizer = Tokenizer.from_file(TokenizerPath)
-    
-
-    # Creating a transform image object
-    transform = v2.Compose([
-        v2.Resize(size=[489,456], antialias=True),
-	    v2.Resize(size=[256,224], antialias=True),
-        v2.ToDtype(torch.float, scale=True),
-        v2.RandomRotation(degrees=(0,180)),
-        v2.CenterCrop(224),
-        v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
-
-    # Reading the image and transforming the image
-    img = transform(read_image(ImgPath))
-
-
-    # Initializing transformer config 
-    TrConf = data['transformer_config']
-    MaxLen = TrConf['block_size']
-    VocabSize = TrConf['vocab_size']
-    NumLayers = TrConf['number_layers']
-    NumHeads = TrConf['number_heads']
-    DModel = TrConf['d_model']
-
-    if ModelName == 'gpt-2':
-        config = transformerconfig(blockSize=MaxLen,
-                                   vocabSize=VocabSize,
-                                   nLayers=NumLayers,
-                                   nHead=NumHeads,
-                                   nEmbd=DModel)
-    elif ModelName == 'llama-2':
-        config = mArgs(dim=DModel,
-                       nLayers=NumLayers,
-                       nHeads=NumHeads,
-                       MaxSeqLen=MaxLen,
-                       VocabSize=VocabSize)
-
-
-    # Downloading the Cnn model
-    CnnConf = data['cnn_model_config']
-    ExistingPath = CnnConf['existing_path']
-    SpecificDownloadPath = CnnConf['specific_download_path']
-    if ExistingPath is not None and SpecificDownloadPath is not None:
-        effnetb0 = get_cnn_model(ExistingPath=ExistingPath,
-                                  SpecificDownloadPath=SpecificDownloadPath)
+    if Bundle is not None:
+        tokenizer = Bundle.tokenizer()
     else:
-        effnetb0 = get_cnn_model()
-
-
-    # Initializing the transformer model
-    if ModelName == 'llama-2':
-        model = llama_transformer(config,
-                                  CnnModel=effnetb0,
-                                  device=device)
-    else:
-        model = transformer(config=config,
-                            CnnModel=effnetb0)
-
-    # Loading checkpoint
-    checkpoint = torch.load(ModelPath)
-    state_dict = checkpoint['model_state_dict']
-    for key in list(state_dict.keys()):
-        state_dict[key.replace("module._orig_mod.", "")] = state_dict.pop(key)
-    model.load_state_dict(state_dict)
-    model.to(device)
+        TokenizerPath = data["tokenizer_config"]['tokenizer_load_path']
+        tokenizer = Tokenizer.from_file(TokenizerPath)
+
+
+    # Reading the image
+    with open(ImgPath, 'rb') as f:
+        ImgBytes = f.read()
+
+    # Speculative decoding with a draft model
+    SpecConf = data.get('speculative_config', {})
+    DraftPath = DraftPath or SpecConf.get('draft_path')
+    NumDraft = SpecConf.get('num_draft', 4)
+    DraftId = None if DraftPath is None else checkpoint_id(DraftPath)
+
+    # Checking the cache before loading the model
+    if Cache is not None:
+        ImgHash = captioncache.image_hash(ImgBytes)
+        CheckpointId = checkpoint_id(ModelPath)
+        CaptionKey = captioncache.caption_key(ImgHash,
+                                              CheckpointId,
+                                              TokenSize,
+                                              Temprature,
+                                              Topk,
+                                              Topp,
+                                              Minp,
+                                              DraftId,
+                                              NumDraft)
+        Decoded = Cache.get(CaptionKey)
+        if Decoded is not None:
+            print(f"Caption (cached): {Decoded}")
+            return Decoded
+
+    # Transforming the image (deterministic transform)
+    CnnName = data['cnn_model_config'].get('name', 'efficientnet_b0')
+    img = preprocess_image(decode_image(ImgBytes, CnnName), CnnName)
+    Precision = precisionpolicy(data['model_config']['dtype'], device).apply()
+
+    # Near duplicate lookup, only the Cnn model stage is needed
+    Backbone = None
+    if IndexPath is not None:
+        Backbone = get_backbone(data, device, Bundle)
+        with Precision.autocast():
+            Features = Backbone(img.unsqueeze(0).to(device))[0].float().cpu().numpy()
+        RetConf = data.get('retrieval_config', {})
+        # Captions in the index depend on the checkpoint and the decoding parameters
+        Namespace = '-'.join([checkpoint_id(ModelPath),
+                              captioncache.decoding_params(TokenSize,
+                                                           Temprature,
+                                                           Topk,
+                                                           Topp,
+                                                           Minp,
+                                                           DraftId,
+                                                           NumDraft)])
+        Index = open_index(IndexPath,
+                           Features.shape[-1],
+                           Namespace=Namespace,
+                           Threshold=RetConf.get('threshold', 0.95),
+                           NumTables=RetConf.get('num_tables', 8),
+                           NumBits=RetConf.get('num_bits', 12))
+        Decoded, Similarity = Index.lookup(Features)
+        Metrics = Index.metrics()
+        print(f"Retrieval: similarity {Similarity:.4f} | threshold {Metrics['threshold']} | hit rate {Metrics['hit_rate']:.2%} over {Metrics['lookups']} lookups")
+        if Decoded is not None:
+            Index.save(IndexPath)
+            print(f"Caption (near duplicate): {Decoded}")
+            if Cache is not None:
+                Cache.put(CaptionKey, Decoded)
+            return Decoded
+
+
+    # Loading the decoder and the frozen Cnn model stage
+    model, Backbone, config = load_caption_model(data, ModelPath, device, Backbone, Bundle)
+    draft = load_draft_model(DraftPath, device)
 
 
     '''Creating caption for Image'''
-    model.eval()
     # NumReturnSequences = 4
     CurrentTok = tokenizer.token_to_id('<|start_of_text|>')
     XGen = torch.tensor([CurrentTok], dtype=torch.long)
     XGen = XGen.unsqueeze(0)
     XGen = XGen.to(device)
 
-    img = img.unsqueeze(0)#.repeat(NumReturnSequences, 1, 1)
-    img = img.to(device)
-    SampleRng = torch.Generator(device=device)
-    SampleRng.manual_seed(1337)
-    if ModelName == 'llama-2':
-        values = XGen
-    for x in range(TokenSize):
-
-        # forwarding the model
-        if ModelName == 'llama-2':
-            logits = model(XGen, img, StartPos=x)
+    # Autocast dtype is taken from the model config
+    with Precision.autocast():
+        img = img.unsqueeze(0)#.repeat(NumReturnSequences, 1, 1)
+        img = img.to(device)
+
+        # Image encoding is computed once (or taken from the cache)
+        if ModelName != 'llama-2':
+            ImgEmbd = None
+            if Cache is not None:
+                EncodingKey = captioncache.encoding_key(ImgHash, CheckpointId)
+                ImgEmbd = Cache.get(EncodingKey)
+            if ImgEmbd is None or draft is not None:
+                img = Backbone(img)
+            if ImgEmbd is None:
+                ImgEmbd = model.encode_image(img)
+                if Cache is not None:
+                    Cache.put(EncodingKey, ImgEmbd.cpu())
+            ImgEmbd = ImgEmbd.to(device)
         else:
-            logits = model(XGen, img)
-        # Take the logits at last position
-        logits = logits[:, -1, :] / Temprature
-        # Topk
-        v, _ = torch.topk(logits, min(Topk, logits.size(-1)))
-        logits[logits < v[:, [-1]]] = -float('Inf')
-        # Get the probablities
-        probs = F.softmax(logits, dim=-1)
-        # TopK sampling
-        ix = torch.multinomial(probs, num_samples=1, generator=SampleRng) # (B, 1)
-
-        # gather the corresponding indices
+            img = Backbone(img)
+
+        SampleRng = torch.Generator(device=device)
+        SampleRng.manual_seed(1337)
+        Sampler = sampler(1, config.vocabSize, Topk, device)
         if ModelName == 'llama-2':
-            XGen = ix
-            values = torch.cat((values, ix), dim=1)
+            values = XGen
+        if draft is not None:
+            # Draft proposes tokens, the decoder verifies them in one pass
+            if ModelName == 'llama-2':
+                ImgEmbd = model.encode_image(img)
+            XGen = torch.tensor(generate_speculative(model,
+                                                     draft,
+                                                     ImgEmbd,
+                                                     draft.encode_image(img),
+                                                     TokenSize,
+                                                     StartTok=CurrentTok,
+                                                     EndTok=tokenizer.token_to_id('<|end_of_text|>'),
+                                                     Temprature=Temprature,
+                                                     Topk=Topk,
+                                                     NumDraft=NumDraft,
+                                                     SampleRng=SampleRng,
+                                                     Topp=Topp,
+                                                     Minp=Minp),
+                                device=device)
+            values = XGen
         else:
-            XGen = torch.cat((XGen, ix), dim=1)
-
-        if ix[0] == 1:
-            break
-    if ModelName == 'llama-2':
+            for x in range(TokenSize):
+
+                # forwarding the model
+                if ModelName == 'llama-2':
+                    logits = model(XGen, img, StartPos=x)
+                else:
+                    logits = model.decode(XGen, ImgEmbd)
+                # Sampling from the logits at last position
+                ix = Sampler(logits[:, -1, :],
+                             Temprature,
+                             Topk,
+                             Topp,
+                             Minp,
+                             SampleRng).clone() # (B, 1)
+
+                # gather the corresponding indices
+                if ModelName == 'llama-2':
+                    XGen = ix
+                    values = torch.cat((values, ix), dim=1)
+                else:
+                    XGen = torch.cat((XGen, ix), dim=1)
+
+                if ix[0] == 1:
+                    break
+    if ModelName == 'llama-2' or draft is not None:
         XGen = values
 
     # Print the text which has been generated
@@ -177,6 +252,12 @@ def CaptionGenerator(JsonPath:str,
     XGen = XGen[0].tolist()
     Decoded = tokenizer.decode(XGen)
     print(f"Caption: {Decoded} \n {XGen}")
+
+    if Cache is not None:
+        Cache.put(CaptionKey, Decoded)
+    if IndexPath is not None:
+        Index.add(Features, Decoded)
+        Index.save(IndexPath)
     return Decoded
 
 
@@ -188,7 +269,13 @@ def command_line_argument():
     parser.add_argument('--size', dest='Size', help='Manual token size for the model')
     parser.add_argument('--temp', dest='Temprature', help='Adjust the temprature of the model')
     parser.add_argument('--topk', dest='TopK', help='Random tokens will picked from top K tokens')
-    parser.add_argument('--mpath', dest='ModelPath', help='Inserts model path inside program')
+    parser.add_argument('--topp', dest='TopP', help='Random tokens will picked from the smallest set with this probability')
+    parser.add_argument('--minp', dest='MinP', help='Tokens less likely than this fraction of the top token are dropped')
+    parser.add_argument('--mpath', dest='ModelPath', help='Inserts model path (checkpoint or model bundle) inside program')
+    parser.add_argument('--cache', dest='CacheDir', help='Enables the result cache and stores it inside this directory')
+    parser.add_argument('--draft', dest='DraftPath', help='Draft model path, enables speculative decoding')
+    parser.add_argument('--index', dest='IndexPath', help='Near duplicate index file, repeated images reuse stored captions')
+    parser.add_argument('--cache-size', dest='CacheSize', type=int, default=2**30, help='Maximum size of the disk cache in bytes')
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -199,9 +286,18 @@ if __name__ == '__main__':
     size = Args.Size
     temp= Args.Temprature
     topk = Args.TopK
+    cache = None
+    if Args.CacheDir is not None:
+        cache = captioncache(CacheDir=Args.CacheDir,
+                             MaxDiskBytes=Args.CacheSize)
     decoded = CaptionGenerator(jpath,
                                ipath,
                                size,
                                temp,
                                topk,
-                               mpath)
+                               mpath,
+                               cache,
+                               Args.DraftPath,
+                               Args.TopP,
+                               Args.MinP,
+                               Args.IndexPath)
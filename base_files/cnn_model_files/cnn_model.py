@@ -1,25 +1,137 @@
 import torch
 from torch import nn
 from torchvision import models
+from dataclasses import dataclass
 import os
 
 
+@dataclass(frozen=True)
+class backbonespec:
+    '''
+    Description of a torchvision backbone:
+        builder: torchvision model function
+        weights: pretrained weights (torchvision weight name)
+        head: attribute holding the classifier, removed for pooled features
+        pooledDim: width of the pooled features in front of the classifier
+        resizeSize: resize of the inference transform (a single value
+                    resizes the shorter side)
+        cropSize: side of the center crop fed to the model
+    The classifier output ('logits' features) always has 1000 values.
+    '''
+    builder: str
+    weights: str
+    head: str
+    pooledDim: int
+    resizeSize: tuple
+    cropSize: int
+    mean: tuple = (0.485, 0.456, 0.406)
+    std: tuple = (0.229, 0.224, 0.225)
+
+    def feature_dim(self, Features: str = 'logits') -> int:
+        return self.pooledDim if Features == 'pooled' else 1000
+
+    def get_weights(self):
+        return models.get_weight(self.weights)
+
+
+# Resolutions follow the pretrained weights, efficientnet_b0 keeps the
+# original (256, 224) resize so existing checkpoints see the same inputs
+BACKBONES = {
+        'efficientnet_b0': backbonespec('efficientnet_b0', 'EfficientNet_B0_Weights.IMAGENET1K_V1', 'classifier', 1280, (256, 224), 224),
+        'efficientnet_b1': backbonespec('efficientnet_b1', 'EfficientNet_B1_Weights.IMAGENET1K_V1', 'classifier', 1280, (256,), 240),
+        'efficientnet_b2': backbonespec('efficientnet_b2', 'EfficientNet_B2_Weights.IMAGENET1K_V1', 'classifier', 1408, (288,), 288),
+        'efficientnet_b3': backbonespec('efficientnet_b3', 'EfficientNet_B3_Weights.IMAGENET1K_V1', 'classifier', 1536, (320,), 300),
+        'efficientnet_b4': backbonespec('efficientnet_b4', 'EfficientNet_B4_Weights.IMAGENET1K_V1', 'classifier', 1792, (384,), 380),
+        'efficientnet_b5': backbonespec('efficientnet_b5', 'EfficientNet_B5_Weights.IMAGENET1K_V1', 'classifier', 2048, (456,), 456),
+        'mobilenet_v3_small': backbonespec('mobilenet_v3_small', 'MobileNet_V3_Small_Weights.IMAGENET1K_V1', 'classifier', 576, (256,), 224),
+        'mobilenet_v3_large': backbonespec('mobilenet_v3_large', 'MobileNet_V3_Large_Weights.IMAGENET1K_V1', 'classifier', 960, (256,), 224),
+        'resnet18': backbonespec('resnet18', 'ResNet18_Weights.IMAGENET1K_V1', 'fc', 512, (256,), 224),
+        'resnet50': backbonespec('resnet50', 'ResNet50_Weights.IMAGENET1K_V1', 'fc', 2048, (256,), 224),
+        }
+DEFAULT_BACKBONE = 'efficientnet_b0'
+
+
+def get_backbone_spec(Name: str = None) -> backbonespec:
+    Name = Name or DEFAULT_BACKBONE
+    if Name not in BACKBONES:
+        raise ValueError(f"Unknown backbone {Name!r}, available: {', '.join(BACKBONES)}")
+    return BACKBONES[Name]
+
+
 def get_cnn_model(ExistingPath=None,
-                  SpecificDownloadPath=None):
+                  SpecificDownloadPath=None,
+                  Pretrained:bool=True,
+                  Name:str=DEFAULT_BACKBONE,
+                  Features:str='logits'):
+    '''
+    Builds a backbone of the registry. With Features='pooled' the classifier
+    is removed and the model returns the pooled features (spec.pooledDim
+    values) instead of the 1000 ImageNet logits.
+    '''
+    Spec = get_backbone_spec(Name)
 
     # If model needs to be downloaded on specifice path
     if SpecificDownloadPath is not None:
         os.environ['TORCH_HOME'] = SpecificDownloadPath
 
-    # Loading the model
-    effnetb0 = models.efficientnet_b0(pretrained=True)
+    # Loading the model (weights are not downloaded if they will be replaced)
+    CnnModel = getattr(models, Spec.builder)(weights=Spec.weights if Pretrained else None)
 
-    for param in effnetb0.parameters():
+    for param in CnnModel.parameters():
         param.requires_grad = False
 
+    # Saved weights include the classifier, so they are loaded before it is removed
     if ExistingPath is not None and os.path.exists(ExistingPath):
         weights = torch.load(ExistingPath)
-        effnetb0.load_state_dict(weights)
+        CnnModel.load_state_dict(weights)
+
+    if Features == 'pooled':
+        setattr(CnnModel, Spec.head, nn.Identity())
+
+    return CnnModel
+
+
+class frozenbackbone:
+    '''
+    Runs the frozen Cnn model as a separate stage in front of the decoder.
+    It is kept out of the trainable model, so it is not wrapped by DDP, not
+    part of gradient clipping and not recorded by autograd. The model stays
+    in eval mode (BatchNorm uses its pretrained statistics) and uses
+    channels last memory format, optionally under bf16 autocast.
+
+    torch.no_grad is used instead of inference_mode because features are
+    saved for the backward pass of cnnLayer.
+    '''
+    def __init__(self,
+                 CnnModel,
+                 device,
+                 dtype:str=None,
+                 Name:str=DEFAULT_BACKBONE):
+
+        # Name of the registry entry, selects the matching preprocessing
+        self.name = Name
+        self.device = torch.device(device)
+        self.model = CnnModel.to(self.device,
+                                 memory_format=torch.channels_last)
+        self.model.eval()
+        for param in self.model.parameters():
+            param.requires_grad = False
+        self.dtype = torch.bfloat16 if dtype == 'bf16' else None
+
+    def state_dict(self):
+        return self.model.state_dict()
 
+    def load_state_dict(self, StateDict):
+        return self.model.load_state_dict(StateDict)
 
-    return effnetb0
+    @torch.no_grad()
+    def __call__(self, Img):
+        Img = Img.to(self.device, memory_format=torch.channels_last)
+        if self.dtype is None:
+            Features = self.model(Img)
+        else:
+            with torch.autocast(device_type=self.device.type,
+                                dtype=self.dtype):
+                Features = self.model(Img)
+        # Features of shape (BatchSize, FeatureDim) in float32
+        return Features.float()
@@ -0,0 +1,79 @@
+import torch
+import pandas as pd
+from transformers import PreTrainedTokenizerFast
+
+
+class groupingplan:
+    '''
+    Groups captions of the same image into one batch entry. Every entry has
+    one image and up to CaptionsPerImage captions, images with more captions
+    are split into several entries.
+    '''
+    def __init__(self,
+                 dataset: pd.DataFrame,
+                 CaptionsPerImage: int = 5):
+
+        self.CaptionsPerImage = CaptionsPerImage
+        self.entries = []
+        Groups = dataset.groupby('image_path', sort=False).indices
+        for ImgPath, Indices in Groups.items():
+            Indices = Indices.tolist()
+            for i in range(0, len(Indices), CaptionsPerImage):
+                self.entries.append((ImgPath, Indices[i:i + CaptionsPerImage]))
+
+        # Dataframe of images, used by imgextracter
+        self.images = pd.DataFrame({'image_path': [ImgPath for ImgPath, _ in self.entries]})
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Convert the captions of a grouped entry to id
+class groupedtexttoid:
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizerFast,
+                 dataset: pd.DataFrame,
+                 plan: groupingplan):
+
+        self.dataset = dataset
+        self.plan = plan
+        self.tokenizer = tokenizer
+        self.padToken = tokenizer.convert_tokens_to_ids('<|pad|>')
+
+    def __len__(self):
+        return len(self.plan)
+
+    def __getitem__(self, index) -> dict:
+        '''
+        Returns tensors of shape (CaptionsPerImage, SeqLen). Missing captions
+        are padding rows with label -1, they are ignored by the loss.
+        '''
+        _, Indices = self.plan.entries[index]
+        Rows = ["<|start_of_text|>" + self.dataset['caption'][i] + "<|end_of_text|>"
+                for i in Indices]
+        DecoderInput = self.tokenizer(text=Rows,
+                                      padding='max_length',
+                                      truncation=True,
+                                      return_tensors='pt')['input_ids'] # Tokenized sentences
+
+        # Label should 1 value ahead of input
+        Label = torch.cat([
+            DecoderInput[:, 1:],
+            torch.full((len(Rows), 1), self.padToken)
+            ], dim=1)
+
+        Missing = self.plan.CaptionsPerImage - len(Rows)
+        if Missing > 0:
+            DecoderInput = torch.cat([
+                DecoderInput,
+                torch.full((Missing, DecoderInput.size(1)), self.padToken)
+                ])
+            Label = torch.cat([
+                Label,
+                torch.full((Missing, Label.size(1)), -1)
+                ])
+
+        return{
+                "decoder_input": DecoderInput,
+                "label": Label
+                }
@@ -0,0 +1,105 @@
+import io
+from functools import lru_cache
+import numpy as np
+import torch
+from torchvision.transforms import v2
+from PIL import Image
+from base_files.cnn_model_files.cnn_model import get_backbone_spec, DEFAULT_BACKBONE
+
+
+'''
+Resize, crop and normalization follow the backbone (see BACKBONES), every
+transform is built once per backbone name and shared by every dataset object.
+'''
+
+
+@lru_cache(maxsize=None)
+def get_train_transform(CnnName: str = DEFAULT_BACKBONE) -> v2.Compose:
+    # Training transform, random rotation is used as an augmentation
+    Spec = get_backbone_spec(CnnName)
+    return v2.Compose([
+        v2.Resize(size=[489,456], antialias=True),
+        v2.Resize(size=list(Spec.resizeSize), antialias=True),
+        v2.ToDtype(torch.float, scale=True),
+        v2.RandomRotation(degrees=(0,180)),
+        v2.CenterCrop(Spec.cropSize),
+        v2.Normalize(mean=list(Spec.mean), std=list(Spec.std))
+        ])
+
+
+@lru_cache(maxsize=None)
+def get_resize_transform(CnnName: str = DEFAULT_BACKBONE) -> v2.Compose:
+    # Geometric part of the inference transform, works on uint8 images
+    Spec = get_backbone_spec(CnnName)
+    return v2.Compose([
+        v2.Resize(size=list(Spec.resizeSize), antialias=True),
+        v2.CenterCrop(Spec.cropSize)
+        ])
+
+
+@lru_cache(maxsize=None)
+def get_normalize_transform(CnnName: str = DEFAULT_BACKBONE) -> v2.Compose:
+    # Pixel part of the inference transform, works on whole batches
+    Spec = get_backbone_spec(CnnName)
+    return v2.Compose([
+        v2.ToDtype(torch.float, scale=True),
+        v2.Normalize(mean=list(Spec.mean), std=list(Spec.std))
+        ])
+
+
+@lru_cache(maxsize=None)
+def get_inference_transform(CnnName: str = DEFAULT_BACKBONE) -> v2.Compose:
+    '''
+    Deterministic transform used for captioning and validation. Random
+    rotation is removed so the same image always gives the same input.
+    '''
+    return v2.Compose([
+        get_resize_transform(CnnName),
+        get_normalize_transform(CnnName)
+        ])
+
+
+def decode_image(Data: bytes,
+                 CnnName: str = DEFAULT_BACKBONE) -> torch.Tensor:
+    '''
+    Decodes an image to a uint8 tensor of shape (3, Height, Width). For JPEG
+    images draft mode is used, which lets the decoder skip DCT coefficients
+    and return an image reduced by a power of 2 (but never smaller than the
+    size required by the transform).
+    '''
+    img = Image.open(io.BytesIO(Data))
+    # PIL sizes are (Width, Height), a single resize value is the shorter side
+    Resize = get_backbone_spec(CnnName).resizeSize
+    img.draft('RGB', (Resize[-1], Resize[0]))
+    img = np.asarray(img.convert('RGB'))
+    return torch.from_numpy(img.copy()).permute(2, 0, 1)
+
+
+def load_image(ImgPath: str,
+               CnnName: str = DEFAULT_BACKBONE) -> torch.Tensor:
+    # Reads the image from disk and decodes it
+    with open(ImgPath, 'rb') as f:
+        return decode_image(f.read(), CnnName)
+
+
+def preprocess_images(Images,
+                      CnnName: str = DEFAULT_BACKBONE) -> torch.Tensor:
+    '''
+    Transforms a list of image paths (or decoded uint8 tensors) into a batch
+    of shape (BatchSize, 3, Crop, Crop). Resizing is done per image, because
+    images have different sizes, normalization is done once for the batch.
+    '''
+    Resize = get_resize_transform(CnnName)
+    Batch = []
+    for img in Images:
+        if isinstance(img, str):
+            img = load_image(img, CnnName)
+        Batch.append(Resize(img))
+
+    return get_normalize_transform(CnnName)(torch.stack(Batch))
+
+
+def preprocess_image(Img,
+                     CnnName: str = DEFAULT_BACKBONE) -> torch.Tensor:
+    # Single image version of preprocess_images, shape (3, Crop, Crop)
+    return preprocess_images([Img], CnnName)[0]
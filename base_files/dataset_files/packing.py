@@ -0,0 +1,112 @@
+import torch
+import pandas as pd
+from torchvision.io import read_image, ImageReadMode
+from transformers import PreTrainedTokenizerFast
+from base_files.dataset_files.image_transforms import get_train_transform
+from base_files.cnn_model_files.cnn_model import get_backbone_spec, DEFAULT_BACKBONE
+
+
+class packingplan:
+    '''
+    Decides which captions share a row of block size tokens. Captions are
+    tokenized once and placed greedily in dataset order, a new row is started
+    when the next caption does not fit or the row already holds MaxSegments
+    captions. Captions longer than the block size are truncated.
+    '''
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizerFast,
+                 dataset: pd.DataFrame,
+                 BlockSize: int,
+                 MaxSegments: int):
+
+        self.BlockSize = BlockSize
+        self.MaxSegments = MaxSegments
+        Texts = ["<|start_of_text|>" + Caption + "<|end_of_text|>"
+                 for Caption in dataset['caption'].tolist()]
+        self.tokens = [Ids[:BlockSize]
+                       for Ids in tokenizer(Texts)['input_ids']]
+
+        self.rows = []
+        Row, RowLength = [], 0
+        for Index, Ids in enumerate(self.tokens):
+            if Row and (RowLength + len(Ids) > BlockSize or len(Row) == MaxSegments):
+                self.rows.append(Row)
+                Row, RowLength = [], 0
+            Row.append(Index)
+            RowLength += len(Ids)
+        if Row:
+            self.rows.append(Row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def useful_tokens(self) -> float:
+        # Fraction of non padding tokens
+        return sum(len(Ids) for Ids in self.tokens) / (len(self.rows) * self.BlockSize)
+
+
+# Convert packed rows of text to id
+class packedtexttoid:
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizerFast,
+                 plan: packingplan):
+
+        self.plan = plan
+        self.padToken = tokenizer.convert_tokens_to_ids('<|pad|>')
+
+    def __len__(self):
+        return len(self.plan)
+
+    def __getitem__(self, index) -> dict:
+        '''
+        Returns the packed tokens with:
+            label: next token inside the same caption, -1 (ignored by the
+                   loss) at the end of every caption and on padding
+            position: position inside the caption (restarts at 0)
+            segment: index of the caption inside the row, -1 on padding
+        '''
+        BlockSize = self.plan.BlockSize
+        DecoderInput = torch.full((BlockSize,), self.padToken, dtype=torch.long)
+        Label = torch.full((BlockSize,), -1, dtype=torch.long)
+        Position = torch.zeros(BlockSize, dtype=torch.long)
+        Segment = torch.full((BlockSize,), -1, dtype=torch.long)
+
+        Start = 0
+        for SegmentId, CaptionIndex in enumerate(self.plan.rows[index]):
+            Ids = torch.tensor(self.plan.tokens[CaptionIndex], dtype=torch.long)
+            End = Start + len(Ids)
+            DecoderInput[Start:End] = Ids
+            Label[Start:End - 1] = Ids[1:]
+            Position[Start:End] = torch.arange(len(Ids))
+            Segment[Start:End] = SegmentId
+            Start = End
+
+        return{
+                "decoder_input": DecoderInput,
+                "label": Label,
+                "position": Position,
+                "segment": Segment
+                }
+
+
+# Images of every caption of a packed row
+class packedimgextracter(torch.utils.data.Dataset):
+    def __init__(self,
+                 dataframe: pd.DataFrame,
+                 plan: packingplan,
+                 CnnName: str = DEFAULT_BACKBONE):
+        self.dataframe = dataframe
+        self.plan = plan
+        self.transform = get_train_transform(CnnName)
+        self.CropSize = get_backbone_spec(CnnName).cropSize
+
+    def __len__(self):
+        return len(self.plan)
+
+    def __getitem__(self, index):
+        # Shape (MaxSegments, 3, Crop, Crop), unused segments are zero
+        Images = torch.zeros(self.plan.MaxSegments, 3, self.CropSize, self.CropSize)
+        for SegmentId, CaptionIndex in enumerate(self.plan.rows[index]):
+            row = self.dataframe['image_path'][CaptionIndex] # Path of the image
+            Images[SegmentId] = self.transform(read_image(row, ImageReadMode.RGB))
+        return Images
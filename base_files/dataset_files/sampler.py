@@ -0,0 +1,38 @@
+import math
+import torch
+
+
+class resumesampler(torch.utils.data.Sampler):
+    '''
+    Splits the dataset between ranks in order, like DistributedSampler
+    without shuffling (indices are padded by repeating the first ones, then
+    rank r takes every world_size-th index starting at r). Items before
+    StartIndex are skipped, so a run restarted in the middle of an epoch
+    (possibly with another world size) continues with the items that were
+    not trained on yet.
+    '''
+    def __init__(self,
+                 DatasetLength: int,
+                 rank: int = 0,
+                 world_size: int = 1,
+                 StartIndex: int = 0):
+
+        self.DatasetLength = DatasetLength
+        self.rank = rank
+        self.world_size = world_size
+        self.set_start(StartIndex)
+
+    def set_start(self, StartIndex: int):
+        # Has to be called before the loader is iterated
+        self.StartIndex = min(StartIndex, self.DatasetLength)
+        self.NumSamples = math.ceil((self.DatasetLength - self.StartIndex) / self.world_size)
+
+    def __iter__(self):
+        Indices = list(range(self.StartIndex, self.DatasetLength))
+        Padding = self.NumSamples * self.world_size - len(Indices)
+        if Padding > 0:
+            Indices += (Indices * math.ceil(Padding / len(Indices)))[:Padding]
+        return iter(Indices[self.rank::self.world_size])
+
+    def __len__(self):
+        return self.NumSamples
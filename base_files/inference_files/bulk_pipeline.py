@@ -0,0 +1,255 @@
+import os
+import json
+import hashlib
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from base_files.inference_files.generator import generate_captions
+from base_files.dataset_files.image_transforms import decode_image, get_resize_transform, get_normalize_transform
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def list_images(ImgPath: str) -> list:
+    # A directory (every image inside it, sorted) or a single image
+    if os.path.isdir(ImgPath):
+        return [os.path.join(ImgPath, FileName) for FileName in sorted(os.listdir(ImgPath))
+                if FileName.lower().endswith(IMAGE_EXTENSIONS)]
+    return [ImgPath]
+
+
+def load_manifest(OutPath: str) -> set:
+    '''
+    Images already captioned by an earlier run of the job. The output file is
+    the manifest: one json line per image, lines with an error are retried.
+    A partly written last line (interrupted job) is removed, so new lines are
+    appended after a complete one.
+    '''
+    Done = set()
+    if OutPath is None or not os.path.exists(OutPath):
+        return Done
+    with open(OutPath, 'rb+') as f:
+        Data = f.read()
+        if Data and not Data.endswith(b'\n'):
+            f.truncate(Data.rfind(b'\n') + 1)
+    with open(OutPath, 'r') as f:
+        for Line in f:
+            try:
+                Row = json.loads(Line)
+            except json.JSONDecodeError:
+                continue
+            if 'caption' in Row:
+                Done.add(Row['image_path'])
+    return Done
+
+
+class stagetimer:
+    # Busy time of a stage, updated from several threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = 0.
+        self.items = 0
+
+    def add(self, Seconds: float, Items: int = 1):
+        with self.lock:
+            self.busy += Seconds
+            self.items += Items
+
+
+class bulkpipeline:
+    '''
+    Captions a list of images with the stages overlapping:
+        read, decode: thread pool (NumWorkers threads), file read, JPEG
+                      decode and resize of one image per task
+        model: calling thread, normalization, Cnn model, image encoding and
+               batched generation
+        write: writer thread, appends json lines to the output manifest
+    Queues between the stages are bounded (backpressure): at most Prefetch
+    images are decoded ahead of the model and at most WriteQueue batches wait
+    for the writer, so memory stays flat for any number of images.
+    Every image is sampled with its own generator seeded from a hash of its
+    file content, so its caption does not depend on the batch it lands in
+    (resumed jobs, failed images before it, BatchSize).
+    '''
+    def __init__(self,
+                 model,
+                 Backbone,
+                 tokenizer,
+                 device,
+                 Precision,
+                 BatchSize: int = 32,
+                 NumWorkers: int = 4,
+                 Prefetch: int = None,
+                 WriteQueue: int = 4,
+                 TokenSize: int = None,
+                 Temprature: float = 1.0,
+                 Topk: int = 100,
+                 Topp: float = None,
+                 Minp: float = None):
+
+        self.model = model
+        self.Backbone = Backbone
+        self.tokenizer = tokenizer
+        self.device = device
+        self.Precision = Precision
+        self.BatchSize = BatchSize
+        self.NumWorkers = NumWorkers
+        self.Prefetch = Prefetch or 2 * BatchSize
+        self.WriteQueue = WriteQueue
+        self.TokenSize = min(TokenSize or model.config.blockSize, model.config.blockSize)
+        self.Temprature = Temprature
+        self.Topk = Topk
+        self.Topp = Topp
+        self.Minp = Minp
+        self.StartTok = tokenizer.token_to_id('<|start_of_text|>')
+        self.EndTok = tokenizer.token_to_id('<|end_of_text|>')
+        self.timers = {}
+
+    def _load(self, ImgPath: str):
+        # Read and decode stage of one image, returns (path, uint8 image,
+        # sampling seed, error)
+        try:
+            t0 = time.perf_counter()
+            with open(ImgPath, 'rb') as f:
+                Data = f.read()
+            t1 = time.perf_counter()
+            img = get_resize_transform(self.Backbone.name)(decode_image(Data, self.Backbone.name))
+            t2 = time.perf_counter()
+            self.timers['read'].add(t1 - t0)
+            self.timers['decode'].add(t2 - t1)
+            Seed = int(hashlib.sha256(Data).hexdigest()[:15], 16)
+            return ImgPath, img, Seed, None
+        except Exception as Error:
+            return ImgPath, None, None, f'{type(Error).__name__}: {Error}'
+
+    def _produce(self, Executor, ImgPaths: list, Loaded: queue.Queue):
+        # Futures are queued in order, a full queue blocks new submissions
+        for ImgPath in ImgPaths:
+            Loaded.put(Executor.submit(self._load, ImgPath))
+        Loaded.put(None)
+
+    def _write(self, OutPath: str, Written: queue.Queue):
+        with open(OutPath, 'a') as f:
+            while True:
+                Rows = Written.get()
+                if Rows is None:
+                    break
+                t0 = time.perf_counter()
+                for Row in Rows:
+                    f.write(json.dumps(Row) + '\n')
+                # A batch is in the manifest only once it is on disk
+                f.flush()
+                os.fsync(f.fileno())
+                self.timers['write'].add(time.perf_counter() - t0, len(Rows))
+
+    @torch.no_grad()
+    def _caption(self, Images: list, Seeds: list) -> list:
+        Batch = torch.stack(Images)
+        if self.device == 'cuda':
+            Batch = Batch.pin_memory()
+        # uint8 images are copied, normalization runs on the device
+        Batch = get_normalize_transform(self.Backbone.name)(Batch.to(self.device, non_blocking=True))
+
+        # One generator per image, seeded from its content
+        SampleRng = [torch.Generator(device=self.device).manual_seed(Seed) for Seed in Seeds]
+        with self.Precision.autocast():
+            ImgEmbd = self.model.encode_image(self.Backbone(Batch))
+            Tokens = generate_captions(self.model,
+                                       ImgEmbd,
+                                       self.TokenSize,
+                                       StartTok=self.StartTok,
+                                       EndTok=self.EndTok,
+                                       Temprature=self.Temprature,
+                                       Topk=self.Topk,
+                                       SampleRng=SampleRng,
+                                       Topp=self.Topp,
+                                       Minp=self.Minp)
+        Special = (self.StartTok, self.EndTok)
+        return [self.tokenizer.decode([Tok for Tok in Row if Tok not in Special])
+                for Row in Tokens]
+
+    def _consume(self, Pending: list, Loaded: queue.Queue, Written: queue.Queue, Stats: dict):
+        # Model stage, batches decoded images in order and passes the rows on
+        with ThreadPoolExecutor(max_workers=self.NumWorkers) as Executor:
+            Producer = threading.Thread(target=self._produce,
+                                        args=(Executor, Pending, Loaded),
+                                        daemon=True)
+            Producer.start()
+
+            Finished = False
+            while not Finished:
+                Paths, Images, Seeds, Rows = [], [], [], []
+                while len(Images) < self.BatchSize:
+                    Wait = time.perf_counter()
+                    Future = Loaded.get()
+                    if Future is None:
+                        Finished = True
+                        Stats['starved'] += time.perf_counter() - Wait
+                        break
+                    ImgPath, img, Seed, Error = Future.result()
+                    Stats['starved'] += time.perf_counter() - Wait
+                    if Error is not None:
+                        Stats['errors'] += 1
+                        Rows.append({'image_path': ImgPath, 'error': Error})
+                        continue
+                    Paths.append(ImgPath)
+                    Images.append(img)
+                    Seeds.append(Seed)
+
+                if Images:
+                    Start = time.perf_counter()
+                    Captions = self._caption(Images, Seeds)
+                    self.timers['model'].add(time.perf_counter() - Start, len(Images))
+                    Rows.extend({'image_path': ImgPath, 'caption': Caption}
+                                for ImgPath, Caption in zip(Paths, Captions))
+                if Rows:
+                    Wait = time.perf_counter()
+                    Written.put(Rows)
+                    Stats['blocked'] += time.perf_counter() - Wait
+            Producer.join()
+
+    def run(self, ImgPaths: list, OutPath: str) -> dict:
+        '''
+        Captions every image of ImgPaths that is not in the manifest yet and
+        appends the results to OutPath. Returns the stage report, model_starved
+        is the part of the time the model stage waited for decoded images
+        (more NumWorkers helps) and model_blocked the part it waited for the
+        writer.
+        '''
+        self.timers = {Stage: stagetimer() for Stage in ('read', 'decode', 'model', 'write')}
+        Done = load_manifest(OutPath)
+        Pending = [ImgPath for ImgPath in ImgPaths if ImgPath not in Done]
+
+        Loaded = queue.Queue(maxsize=self.Prefetch)
+        Written = queue.Queue(maxsize=self.WriteQueue)
+        Writer = threading.Thread(target=self._write, args=(OutPath, Written))
+        Writer.start()
+
+        Stats = {'starved': 0., 'blocked': 0., 'errors': 0}
+        t0 = time.perf_counter()
+        try:
+            self._consume(Pending, Loaded, Written, Stats)
+        finally:
+            # Batches captioned before a failure still reach the manifest
+            Written.put(None)
+            Writer.join()
+        Wall = time.perf_counter() - t0
+
+        Report = {
+                'images': len(ImgPaths),
+                'skipped': len(ImgPaths) - len(Pending),
+                'captioned': self.timers['model'].items,
+                'errors': Stats['errors'],
+                'seconds': Wall,
+                'images_per_sec': self.timers['model'].items / Wall if Wall > 0 else 0.,
+                'model_starved': Stats['starved'] / Wall if Wall > 0 else 0.,
+                'model_blocked': Stats['blocked'] / Wall if Wall > 0 else 0.
+                }
+        for Stage, Timer in self.timers.items():
+            # Thread pool stages are divided by the number of threads
+            Capacity = Wall * (self.NumWorkers if Stage in ('read', 'decode') else 1)
+            Report[f'{Stage}_utilization'] = Timer.busy / Capacity if Capacity > 0 else 0.
+        return Report
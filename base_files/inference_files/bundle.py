@@ -0,0 +1,145 @@
+import os
+import copy
+import json
+import mmap
+import struct
+import torch
+from tokenizers import Tokenizer
+
+
+'''
+Single file model bundle, layout:
+    8 bytes   magic (BUNDLE_MAGIC)
+    8 bytes   length of the manifest (little endian)
+    manifest  utf-8 json
+    sections  raw tensor data and files, every section aligned to ALIGNMENT
+The manifest holds the config json, the backbone, the source checkpoint and
+the offset, dtype and shape of every section, so it can be read without
+touching the tensor data.
+'''
+BUNDLE_MAGIC = b'CAPBNDL1'
+BUNDLE_FORMAT = 1
+ALIGNMENT = 64
+
+
+def _align(Offset: int) -> int:
+    return (Offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_bundle(Path: str) -> bool:
+    # Checkpoints written by torch.save are zip files, bundles start with the magic
+    if Path is None or not os.path.isfile(Path):
+        return False
+    with open(Path, 'rb') as f:
+        return f.read(len(BUNDLE_MAGIC)) == BUNDLE_MAGIC
+
+
+def write_bundle(Path: str,
+                 Manifest: dict,
+                 Tensors: dict,
+                 Files: dict = None):
+    '''
+    Writes tensors ({name: tensor}) and files ({name: bytes}) after the
+    manifest. Tensors sharing their storage (tied weights) are stored once.
+    The file is written to a temporary path first.
+    '''
+    Manifest = dict(Manifest)
+    Manifest['format'] = BUNDLE_FORMAT
+    Manifest['tensors'] = {}
+    Manifest['files'] = {}
+
+    Payloads = []
+    Offset = 0
+    Stored = {}
+    for Name, Tensor in Tensors.items():
+        Tensor = Tensor.detach().cpu()
+        Key = (Tensor.untyped_storage().data_ptr(), Tensor.storage_offset(),
+               tuple(Tensor.shape), tuple(Tensor.stride()), Tensor.dtype)
+        if Key in Stored:
+            Manifest['tensors'][Name] = dict(Manifest['tensors'][Stored[Key]])
+            continue
+        Stored[Key] = Name
+        Data = Tensor.contiguous().reshape(-1).view(torch.uint8).numpy()
+        Offset = _align(Offset)
+        Manifest['tensors'][Name] = {
+                'dtype': str(Tensor.dtype).replace('torch.', ''),
+                'shape': list(Tensor.shape),
+                'offset': Offset,
+                'nbytes': Data.nbytes
+                }
+        Payloads.append((Offset, Data))
+        Offset += Data.nbytes
+
+    for Name, Data in (Files or {}).items():
+        Offset = _align(Offset)
+        Manifest['files'][Name] = {'offset': Offset, 'nbytes': len(Data)}
+        Payloads.append((Offset, Data))
+        Offset += len(Data)
+
+    Header = json.dumps(Manifest).encode()
+    DataStart = _align(len(BUNDLE_MAGIC) + 8 + len(Header))
+    with open(f'{Path}.tmp', 'wb') as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(struct.pack('<Q', len(Header)))
+        f.write(Header)
+        for SectionOffset, Data in Payloads:
+            f.seek(DataStart + SectionOffset)
+            f.write(memoryview(Data))
+    os.replace(f'{Path}.tmp', Path)
+
+
+class modelbundle:
+    '''
+    Reads a bundle through one memory map. Tensors are views of the mapping
+    (copy on write), pages are read from disk only when a tensor is used, so
+    opening a bundle costs one manifest read.
+    '''
+    def __init__(self, Path: str):
+        self.Path = Path
+        with open(Path, 'rb') as f:
+            if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+                raise ValueError(f"{Path} is not a model bundle")
+            Length = struct.unpack('<Q', f.read(8))[0]
+            self.manifest = json.loads(f.read(Length))
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if self.manifest['format'] != BUNDLE_FORMAT:
+            raise ValueError(f"Unsupported bundle format {self.manifest['format']}")
+        self.DataStart = _align(len(BUNDLE_MAGIC) + 8 + Length)
+
+    def config(self, data: dict = None) -> dict:
+        '''
+        Config json stored in the bundle. With data (another config json)
+        only the model structure (transformer and Cnn model sections) comes
+        from the bundle, runtime settings come from data.
+        '''
+        Config = copy.deepcopy(self.manifest['config'])
+        if data is None:
+            return Config
+        data = copy.deepcopy(data)
+        for Section in ('transformer_config', 'cnn_model_config'):
+            data[Section] = Config[Section]
+        return data
+
+    def tensor(self, Name: str) -> torch.Tensor:
+        Entry = self.manifest['tensors'][Name]
+        dtype = getattr(torch, Entry['dtype'])
+        Count = Entry['nbytes'] // dtype.itemsize
+        if Count == 0:
+            return torch.empty(Entry['shape'], dtype=dtype)
+        return torch.frombuffer(self.buffer,
+                                dtype=dtype,
+                                count=Count,
+                                offset=self.DataStart + Entry['offset']).view(Entry['shape'])
+
+    def tensors(self, Prefix: str) -> dict:
+        # State dict of every tensor whose name starts with Prefix (removed)
+        return {Name[len(Prefix):]: self.tensor(Name)
+                for Name in self.manifest['tensors'] if Name.startswith(Prefix)}
+
+    def file(self, Name: str) -> bytes:
+        Entry = self.manifest['files'][Name]
+        Start = self.DataStart + Entry['offset']
+        return bytes(self.buffer[Start:Start + Entry['nbytes']])
+
+    def tokenizer(self) -> Tokenizer:
+        return Tokenizer.from_str(self.file('tokenizer.json').decode())
@@ -0,0 +1,151 @@
+import os
+import hashlib
+from collections import OrderedDict
+import torch
+
+
+def checkpoint_id(ModelPath: str) -> str:
+    '''
+    Identifies a checkpoint without reading it. Path, size and modification
+    time change whenever the checkpoint is replaced, so a new model never
+    reuses results of an old one.
+    '''
+    Stat = os.stat(ModelPath)
+    Id = f'{os.path.abspath(ModelPath)}:{Stat.st_size}:{Stat.st_mtime_ns}'
+    return hashlib.sha256(Id.encode()).hexdigest()[:16]
+
+
+class captioncache:
+    '''
+    Content addressed cache for the inference path. It has two tiers, an in
+    memory LRU and an optional on disk tier with size based eviction. Two kinds
+    of entries are stored:
+        - captions, keyed on image hash + checkpoint + decoding parameters
+          (and draft checkpoint with speculative decoding)
+        - image encodings, keyed on image hash + checkpoint
+    '''
+    def __init__(self,
+                 CacheDir: str = None,
+                 MaxItems: int = 1024,
+                 MaxDiskBytes: int = 2**30):
+
+        self.CacheDir = CacheDir
+        self.MaxItems = MaxItems
+        self.MaxDiskBytes = MaxDiskBytes
+        self.memory = OrderedDict()
+
+        # Sizes of the files stored on disk, used for eviction
+        self.diskSizes = {}
+        if CacheDir is not None:
+            os.makedirs(CacheDir, exist_ok=True)
+            for FileName in os.listdir(CacheDir):
+                if FileName.endswith('.pt'):
+                    FilePath = os.path.join(CacheDir, FileName)
+                    self.diskSizes[FilePath] = os.path.getsize(FilePath)
+
+    @staticmethod
+    def image_hash(Data: bytes) -> str:
+        return hashlib.sha256(Data).hexdigest()
+
+    @staticmethod
+    def encoding_key(ImgHash: str,
+                     CheckpointId: str) -> str:
+        return f'enc-{ImgHash}-{CheckpointId}'
+
+    @staticmethod
+    def decoding_params(TokenSize: int,
+                        Temprature: float,
+                        Topk: int,
+                        Topp: float = None,
+                        Minp: float = None,
+                        DraftId: str = None,
+                        NumDraft: int = None) -> str:
+        # Hash of everything the sampled caption depends on besides the image
+        Params = f'{TokenSize}:{Temprature!r}:{Topk}'
+        # Keys without top-p and min-p stay the same as before
+        if Topp is not None or Minp is not None:
+            Params = f'{Params}:{Topp!r}:{Minp!r}'
+        # Speculative decoding uses the random numbers differently, its
+        # captions depend on the draft model
+        if DraftId is not None:
+            Params = f'{Params}:draft:{DraftId}:{NumDraft}'
+        return hashlib.sha256(Params.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def caption_key(ImgHash: str,
+                    CheckpointId: str,
+                    TokenSize: int,
+                    Temprature: float,
+                    Topk: int,
+                    Topp: float = None,
+                    Minp: float = None,
+                    DraftId: str = None,
+                    NumDraft: int = None) -> str:
+        Params = captioncache.decoding_params(TokenSize,
+                                              Temprature,
+                                              Topk,
+                                              Topp,
+                                              Minp,
+                                              DraftId,
+                                              NumDraft)
+        return f'cap-{ImgHash}-{CheckpointId}-{Params}'
+
+    def _disk_path(self, Key: str) -> str:
+        return os.path.join(self.CacheDir, f'{Key}.pt')
+
+    def get(self, Key: str):
+        # Memory tier
+        if Key in self.memory:
+            self.memory.move_to_end(Key)
+            return self.memory[Key]
+
+        # Disk tier
+        if self.CacheDir is None:
+            return None
+        FilePath = self._disk_path(Key)
+        if FilePath not in self.diskSizes:
+            return None
+        try:
+            Value = torch.load(FilePath)
+        except (OSError, RuntimeError, EOFError):
+            self._remove(FilePath)
+            return None
+        os.utime(FilePath) # Marking the file as recently used
+        self._put_memory(Key, Value)
+        return Value
+
+    def put(self, Key: str, Value):
+        self._put_memory(Key, Value)
+        if self.CacheDir is None:
+            return
+
+        FilePath = self._disk_path(Key)
+        TmpPath = f'{FilePath}.tmp'
+        torch.save(Value, TmpPath)
+        os.replace(TmpPath, FilePath) # Readers never see partial files
+        self.diskSizes[FilePath] = os.path.getsize(FilePath)
+        self._evict_disk()
+
+    def _put_memory(self, Key: str, Value):
+        self.memory[Key] = Value
+        self.memory.move_to_end(Key)
+        while len(self.memory) > self.MaxItems:
+            self.memory.popitem(last=False)
+
+    def _remove(self, FilePath: str):
+        self.diskSizes.pop(FilePath, None)
+        if os.path.exists(FilePath):
+            os.remove(FilePath)
+
+    def _evict_disk(self):
+        # Removing least recently used files until the cache fits
+        if sum(self.diskSizes.values()) <= self.MaxDiskBytes:
+            return
+        Files = sorted(self.diskSizes,
+                       key=lambda FilePath: os.path.getmtime(FilePath))
+        Total = sum(self.diskSizes.values())
+        for FilePath in Files:
+            if Total <= self.MaxDiskBytes:
+                break
+            Total -= self.diskSizes[FilePath]
+            self._remove(FilePath)
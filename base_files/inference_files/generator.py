@@ -0,0 +1,69 @@
+import torch
+from base_files.transformer_files.kv_cache import kvcache
+from base_files.inference_files.sampling import sampler
+
+
+@torch.no_grad()
+def generate_captions(model,
+                      ImgEmbd: torch.Tensor,
+                      TokenSize: int,
+                      StartTok: int = 0,
+                      EndTok: int = 1,
+                      Temprature = 1.0,
+                      Topk = 100,
+                      SampleRng = None,
+                      Topp = None,
+                      Minp = None) -> list:
+    '''
+    Generates captions for a batch of encoded images (output of
+    model.encode_image) using a key/value cache, so every step only the newest
+    token is passed through the decoder. Rows that produced the end token stop
+    growing, the loop ends when every row is finished. Sampling settings
+    and generators can be given per row (see sampler).
+
+    Returns a list of token id lists, one per image (end token included).
+    '''
+    BatchSize = ImgEmbd.size(0)
+    device = ImgEmbd.device
+    TokenSize = min(TokenSize, model.config.blockSize)
+
+    Cache = kvcache(model.config,
+                    BatchSize=BatchSize,
+                    device=device,
+                    dtype=ImgEmbd.dtype)
+
+    XGen = torch.full((BatchSize, 1), StartTok, dtype=torch.long, device=device)
+    Tokens = torch.full((BatchSize, TokenSize), EndTok, dtype=torch.long, device=device)
+    Finished = torch.zeros(BatchSize, dtype=torch.bool, device=device)
+    MaxTopk = int(Topk.max()) if isinstance(Topk, torch.Tensor) else Topk
+    Sampler = sampler(BatchSize, model.config.vocabSize, MaxTopk, device)
+
+    Length = 0
+    for x in range(TokenSize):
+
+        # forwarding only the newest token
+        logits = model.decode(XGen, ImgEmbd, StartPos=x, Cache=Cache)
+        # Sampling from the logits at last position
+        ix = Sampler(logits[:, -1, :],
+                     Temprature,
+                     Topk,
+                     Topp,
+                     Minp,
+                     SampleRng) # (B, 1)
+
+        # Finished rows keep producing the end token
+        ix = ix.masked_fill(Finished.unsqueeze(1), EndTok)
+        Tokens[:, x] = ix[:, 0]
+        Length = x + 1
+        XGen = ix
+
+        Finished |= ix[:, 0] == EndTok
+        if Finished.all():
+            break
+
+    Captions = []
+    for Row in Tokens[:, :Length].tolist():
+        if EndTok in Row:
+            Row = Row[:Row.index(EndTok) + 1]
+        Captions.append([StartTok] + Row)
+    return Captions
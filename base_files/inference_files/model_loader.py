@@ -0,0 +1,167 @@
+import json
+import torch
+from tokenizers import Tokenizer
+from dataclasses import asdict
+from base_files.transformer_files.dataclass import transformerconfig
+from base_files.transformer_files.transformer import transformer
+from base_files.transformer_files.checkpoint import load_state
+from base_files.cnn_model_files.cnn_model import get_cnn_model, get_backbone_spec, frozenbackbone
+from base_files.inference_files.bundle import modelbundle, is_bundle
+from base_files.runtime_files.compile_config import compile_component, load_compile_cache
+from llama_architecture import mArgs
+from llama_architecture import transformer as llama_transformer
+
+
+def get_image_dim(CnnConf: dict) -> int:
+    # Width of the features of the configured backbone (input of cnnLayer)
+    return get_backbone_spec(CnnConf.get('name', 'efficientnet_b0')).feature_dim(CnnConf.get('features', 'logits'))
+
+
+def get_model_config(TrConf: dict,
+                     ImgDim: int = 1000):
+    # Creating the transformer config from the 'transformer_config' section
+    if TrConf['model_name'] == 'llama-2':
+        return mArgs(dim=TrConf['d_model'],
+                     nLayers=TrConf['number_layers'],
+                     nHeads=TrConf['number_heads'],
+                     nKVHeads=TrConf.get('number_kv_heads'),
+                     MaxSeqLen=TrConf['block_size'],
+                     VocabSize=TrConf['vocab_size'],
+                     ImgDim=ImgDim)
+
+    return transformerconfig(blockSize=TrConf['block_size'],
+                             vocabSize=TrConf['vocab_size'],
+                             nLayers=TrConf['number_layers'],
+                             nHead=TrConf['number_heads'],
+                             nEmbd=TrConf['d_model'],
+                             imgDim=ImgDim,
+                             adaptiveCutoffs=TrConf.get('adaptive_cutoffs'),
+                             adaptiveDivValue=TrConf.get('adaptive_div_value', 4.0))
+
+
+def get_backbone(data: dict,
+                 device,
+                 Bundle: modelbundle = None) -> frozenbackbone:
+    '''
+    Downloading the Cnn model and wrapping it as a frozen stage. With a
+    bundle its weights are taken from the bundle (no download).
+    '''
+    CnnConf = data['cnn_model_config']
+    ExistingPath = CnnConf['existing_path']
+    SpecificDownloadPath = CnnConf['specific_download_path']
+    CnnName = CnnConf.get('name', 'efficientnet_b0')
+    CnnFeatures = CnnConf.get('features', 'logits')
+    if Bundle is not None:
+        CnnModel = get_cnn_model(Pretrained=False,
+                                 Name=CnnName,
+                                 Features=CnnFeatures)
+        CnnModel.load_state_dict(Bundle.tensors('backbone.'))
+    elif ExistingPath is not None and SpecificDownloadPath is not None:
+        CnnModel = get_cnn_model(ExistingPath=ExistingPath,
+                                 SpecificDownloadPath=SpecificDownloadPath,
+                                 Name=CnnName,
+                                 Features=CnnFeatures)
+    else:
+        CnnModel = get_cnn_model(Name=CnnName,
+                                 Features=CnnFeatures)
+
+    return frozenbackbone(CnnModel,
+                          device,
+                          dtype=CnnConf.get('dtype'),
+                          Name=CnnName)
+
+
+def load_inference_config(JsonPath: str = None,
+                          ModelPath: str = None) -> tuple:
+    '''
+    Returns (config json, model path, tokenizer) of an inference job. The
+    model path defaults to existing_path of the config json. A model bundle
+    has its own config json and tokenizer, JsonPath is optional then.
+    '''
+    data = None
+    if JsonPath is not None:
+        with open (JsonPath, 'r') as f:
+            data = json.load(f)
+    if ModelPath is None:
+        ModelPath = data['model_config']['existing_path']
+
+    if is_bundle(ModelPath):
+        Bundle = modelbundle(ModelPath)
+        return Bundle.config(data), ModelPath, Bundle.tokenizer()
+    TokenizerPath = data['tokenizer_config']['tokenizer_load_path']
+    return data, ModelPath, Tokenizer.from_file(TokenizerPath)
+
+
+def build_decoder(config, device=None):
+    # The decoder architecture follows the type of its config
+    if isinstance(config, mArgs):
+        return llama_transformer(config,
+                                 device=device)
+    return transformer(config=config)
+
+
+def load_caption_model(data: dict,
+                       ModelPath: str,
+                       device,
+                       Backbone: frozenbackbone = None,
+                       Bundle: modelbundle = None):
+    '''
+    Builds the caption model described by a config json and loads the
+    checkpoint. Returns the decoder in eval mode, the frozen backbone stage
+    (an already created one can be given) and the decoder config.
+    ModelPath can be a model bundle, then the model structure and every
+    weight come from the bundle.
+    '''
+    if Bundle is None and is_bundle(ModelPath):
+        Bundle = modelbundle(ModelPath)
+    if Bundle is not None:
+        data = Bundle.config(data)
+
+    config = get_model_config(data['transformer_config'],
+                              get_image_dim(data['cnn_model_config']))
+    if Backbone is None:
+        Backbone = get_backbone(data, device, Bundle)
+
+    model = build_decoder(config, device)
+
+    # Loading checkpoint (bundle tensors are memory mapped)
+    if Bundle is not None:
+        load_state(model, Bundle.tensors('decoder.'))
+    else:
+        checkpoint = torch.load(ModelPath, map_location='cpu')
+        load_state(model, checkpoint['model_state_dict'], Backbone)
+    model.to(device)
+    model.eval()
+
+    # Compiling the inference components (backbone and decode step)
+    CompileConf = data.get('compile_config', {})
+    load_compile_cache(CompileConf.get('cache_dir'))
+    Backbone.model = compile_component(Backbone.model, CompileConf, 'backbone')
+    if hasattr(model, 'decode'):
+        model.decode = compile_component(model.decode, CompileConf, 'decode_step')
+    return model, Backbone, config
+
+
+def get_draft_checkpoint(model, Teacher: str) -> dict:
+    # Draft checkpoints keep their config, they do not have a config json
+    return {
+            'model_state_dict': model.state_dict(),
+            'config': asdict(model.config),
+            'teacher': Teacher
+            }
+
+
+def load_draft_model(DraftPath: str,
+                     device):
+    '''
+    Loads a draft decoder for speculative decoding (written by distill.py),
+    returns None if no draft path is given.
+    '''
+    if DraftPath is None:
+        return None
+    checkpoint = torch.load(DraftPath, map_location='cpu')
+    model = transformer(config=transformerconfig(**checkpoint['config']))
+    load_state(model, checkpoint['model_state_dict'])
+    model.to(device)
+    model.eval()
+    return model
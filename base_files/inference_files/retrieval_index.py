@@ -0,0 +1,188 @@
+import os
+import json
+import numpy as np
+
+
+class retrievalindex:
+    '''
+    Near duplicate lookup over image features of already captioned images
+    (crops, resizes and recompressions have different bytes, so the content
+    hash of captioncache misses them).
+
+    Features are compared with cosine similarity. Candidates come from random
+    hyperplane LSH: every table hashes a feature to NumBits signs of
+    projections, images whose features point in a similar direction share a
+    bucket in at least one table with high probability. Candidates are
+    re-ranked with the exact cosine similarity, a lookup is a hit when the
+    best one reaches Threshold.
+
+    Namespace identifies what the stored captions depend on (the checkpoint),
+    a saved index with another namespace is not reused.
+    '''
+    def __init__(self,
+                 Dim: int,
+                 Threshold: float = 0.95,
+                 NumTables: int = 8,
+                 NumBits: int = 12,
+                 Seed: int = 1337,
+                 Namespace: str = None):
+
+        self.Dim = Dim
+        self.Threshold = Threshold
+        self.NumTables = NumTables
+        self.NumBits = NumBits
+        self.Seed = Seed
+        self.Namespace = Namespace
+
+        Rng = np.random.default_rng(Seed)
+        self.planes = Rng.standard_normal((Dim, NumTables * NumBits)).astype(np.float32)
+        self.bitWeights = 1 << np.arange(NumBits, dtype=np.int64)
+
+        # Storage grows by doubling, inserts are amortized O(1)
+        self.size = 0
+        self.embeddings = np.zeros((16, Dim), dtype=np.float32)
+        self.codes = np.zeros((16, NumTables), dtype=np.int64)
+        self.captions = []
+        self.buckets = [{} for _ in range(NumTables)]
+
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self):
+        return self.size
+
+    def _normalize(self, Features) -> np.ndarray:
+        Features = np.asarray(Features, dtype=np.float32).reshape(-1, self.Dim)
+        Norm = np.linalg.norm(Features, axis=1, keepdims=True)
+        return Features / np.maximum(Norm, 1e-12)
+
+    def _hash(self, Features: np.ndarray) -> np.ndarray:
+        # (N, Dim) -> (N, NumTables) bucket codes
+        Bits = (Features @ self.planes > 0).reshape(-1, self.NumTables, self.NumBits)
+        return Bits.astype(np.int64) @ self.bitWeights
+
+    def _grow(self, Size: int):
+        Capacity = len(self.embeddings)
+        while Capacity < Size:
+            Capacity *= 2
+        if Capacity != len(self.embeddings):
+            self.embeddings = np.resize(self.embeddings, (Capacity, self.Dim))
+            self.codes = np.resize(self.codes, (Capacity, self.NumTables))
+
+    def add(self, Features, Caption: str) -> int:
+        # Inserts one image (features of any shape with Dim values)
+        Embedding = self._normalize(Features)
+        Codes = self._hash(Embedding)[0]
+        Id = self.size
+        self._grow(Id + 1)
+        self.embeddings[Id] = Embedding[0]
+        self.codes[Id] = Codes
+        self.captions.append(Caption)
+        for Table, Code in zip(self.buckets, Codes.tolist()):
+            Table.setdefault(Code, []).append(Id)
+        self.size += 1
+        return Id
+
+    def search(self, Features) -> tuple:
+        '''
+        Returns (caption, similarity) of the most similar stored image found
+        through the LSH buckets, (None, -1.0) if no candidate was found.
+        Does not count as a lookup.
+        '''
+        Embedding = self._normalize(Features)
+        Codes = self._hash(Embedding)[0].tolist()
+        Candidates = set()
+        for Table, Code in zip(self.buckets, Codes):
+            Candidates.update(Table.get(Code, ()))
+        if not Candidates:
+            return None, -1.0
+
+        Candidates = np.fromiter(Candidates, dtype=np.int64)
+        Similarity = self.embeddings[Candidates] @ Embedding[0]
+        Best = int(np.argmax(Similarity))
+        return self.captions[Candidates[Best]], float(Similarity[Best])
+
+    def lookup(self, Features) -> tuple:
+        '''
+        Returns (caption, similarity) when a stored image is at least
+        Threshold similar, otherwise (None, similarity of the best candidate).
+        '''
+        Caption, Similarity = self.search(Features)
+        self.lookups += 1
+        if Caption is not None and Similarity >= self.Threshold:
+            self.hits += 1
+            return Caption, Similarity
+        return None, Similarity
+
+    def metrics(self) -> dict:
+        return {
+                'threshold': self.Threshold,
+                'size': self.size,
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.
+                }
+
+    def save(self, Path: str):
+        # Single npz file, written to a temporary file first
+        Meta = {
+                'dim': self.Dim,
+                'threshold': self.Threshold,
+                'num_tables': self.NumTables,
+                'num_bits': self.NumBits,
+                'seed': self.Seed,
+                'namespace': self.Namespace,
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'captions': self.captions
+                }
+        with open(f'{Path}.tmp', 'wb') as f:
+            np.savez(f,
+                     embeddings=self.embeddings[:self.size],
+                     codes=self.codes[:self.size],
+                     meta=np.array(json.dumps(Meta)))
+        os.replace(f'{Path}.tmp', Path)
+
+    @classmethod
+    def load(cls, Path: str, Threshold: float = None):
+        # Threshold can be changed without rebuilding the index
+        with np.load(Path) as Data:
+            Meta = json.loads(str(Data['meta']))
+            Embeddings = Data['embeddings']
+            Codes = Data['codes']
+
+        Index = cls(Meta['dim'],
+                    Threshold=Meta['threshold'] if Threshold is None else Threshold,
+                    NumTables=Meta['num_tables'],
+                    NumBits=Meta['num_bits'],
+                    Seed=Meta['seed'],
+                    Namespace=Meta['namespace'])
+        Index.size = len(Embeddings)
+        Index._grow(max(Index.size, 1))
+        Index.embeddings[:Index.size] = Embeddings
+        Index.codes[:Index.size] = Codes
+        Index.captions = Meta['captions']
+        Index.lookups = Meta['lookups']
+        Index.hits = Meta['hits']
+        for Id, Row in enumerate(Codes.tolist()):
+            for Table, Code in zip(Index.buckets, Row):
+                Table.setdefault(Code, []).append(Id)
+        return Index
+
+
+def open_index(Path: str,
+               Dim: int,
+               Namespace: str = None,
+               Threshold: float = 0.95,
+               NumTables: int = 8,
+               NumBits: int = 12) -> retrievalindex:
+    # Loads the saved index if it was built for the same namespace and sizes
+    if Path is not None and os.path.exists(Path):
+        Index = retrievalindex.load(Path, Threshold)
+        if (Index.Namespace, Index.Dim, Index.NumTables, Index.NumBits) == (Namespace, Dim, NumTables, NumBits):
+            return Index
+    return retrievalindex(Dim,
+                          Threshold=Threshold,
+                          NumTables=NumTables,
+                          NumBits=NumBits,
+                          Namespace=Namespace)
@@ -0,0 +1,134 @@
+import torch
+import torch.nn.functional as F
+
+
+def filtered_probs(logits: torch.Tensor,
+                   Temprature: float,
+                   Topk: int,
+                   Topp: float = None,
+                   Minp: float = None) -> torch.Tensor:
+    '''
+    Full vocabulary distribution with the filters of sampler (applied in the
+    same order), used where probabilities of every token are needed
+    (speculative decoding).
+    '''
+    logits = logits.float() / Temprature
+    v, _ = torch.topk(logits, min(Topk, logits.size(-1)))
+    logits[logits < v[..., [-1]]] = -float('Inf')
+    Probs = F.softmax(logits, dim=-1)
+
+    if Minp is not None:
+        Probs = Probs.masked_fill(Probs < Minp * Probs.max(dim=-1, keepdim=True).values, 0.)
+
+    if Topp is not None:
+        Sorted, Index = Probs.sort(dim=-1, descending=True)
+        Cumulative = Sorted.cumsum(dim=-1) - Sorted
+        Drop = Cumulative >= Topp * Sorted.sum(dim=-1, keepdim=True)
+        Drop[..., 0] = False
+        Probs = Probs.masked_fill(torch.zeros_like(Drop).scatter(-1, Index, Drop), 0.)
+
+    return Probs / Probs.sum(dim=-1, keepdim=True)
+
+
+class sampler:
+    '''
+    Samples the next token of every row from the top-k candidates only, all
+    work after torch.topk happens on (BatchSize, MaxTopk) buffers allocated
+    once, so decode steps do not allocate vocabulary sized tensors.
+
+    Temprature, Topk, Topp and Minp are numbers (same for every row) or
+    tensors with one value per row, so requests with different settings can
+    share a batch:
+        Topk: candidates kept, at most MaxTopk
+        Topp: smallest set of candidates whose probability reaches Topp
+        Minp: candidates less likely than Minp * most likely are dropped
+    The most likely token is always kept. Sampling uses SampleRng, so a
+    seeded generator gives the same tokens on every run. SampleRng can also
+    be a list with one generator per row, a row then gets the same tokens
+    whatever else is in its batch.
+    '''
+    def __init__(self,
+                 BatchSize: int,
+                 VocabSize: int,
+                 MaxTopk: int,
+                 device):
+
+        MaxTopk = min(MaxTopk or VocabSize, VocabSize)
+        self.MaxTopk = MaxTopk
+        self.values = torch.empty(BatchSize, MaxTopk, device=device)
+        self.indices = torch.empty(BatchSize, MaxTopk, dtype=torch.long, device=device)
+        self.probs = torch.empty(BatchSize, MaxTopk, device=device)
+        self.cumulative = torch.empty(BatchSize, MaxTopk, device=device)
+        self.mask = torch.empty(BatchSize, MaxTopk, dtype=torch.bool, device=device)
+        self.choice = torch.empty(BatchSize, 1, dtype=torch.long, device=device)
+        self.tokens = torch.empty(BatchSize, 1, dtype=torch.long, device=device)
+        self.column = torch.empty(BatchSize, 1, device=device)
+        self.range = torch.arange(MaxTopk, device=device).unsqueeze(0)
+        # Per row settings as (BatchSize, 1) columns
+        self.temprature = torch.empty(BatchSize, 1, device=device)
+        self.topk = torch.empty(BatchSize, 1, dtype=torch.long, device=device)
+        self.topp = torch.empty(BatchSize, 1, device=device)
+        self.minp = torch.empty(BatchSize, 1, device=device)
+
+    @staticmethod
+    def _set(Buffer: torch.Tensor, Value):
+        # Writes a number or a per row tensor into a settings column
+        if isinstance(Value, torch.Tensor):
+            Buffer.copy_(Value.view(-1, 1))
+        else:
+            Buffer.fill_(Value)
+        return Buffer
+
+    def __call__(self,
+                 logits: torch.Tensor,
+                 Temprature=1.0,
+                 Topk=None,
+                 Topp=None,
+                 Minp=None,
+                 SampleRng=None) -> torch.Tensor:
+        '''
+        logits: (BatchSize, Vocab) logits of the last position
+        Returns the sampled tokens as a (BatchSize, 1) tensor (a view of an
+        internal buffer, it is overwritten by the next call).
+        '''
+        B = logits.size(0)
+        if self.values.dtype != logits.dtype:
+            # topk writes in the dtype of the logits (autocast gives bf16)
+            self.values = torch.empty_like(self.values, dtype=logits.dtype)
+        Values, Indices = self.values[:B], self.indices[:B]
+        Probs, Mask, Column = self.probs[:B], self.mask[:B], self.column[:B]
+
+        # Temperature does not change the order, so top-k runs on the logits
+        torch.topk(logits, self.MaxTopk, dim=-1, out=(Values, Indices))
+        Probs.copy_(Values)
+        Probs.div_(self._set(self.temprature[:B], Temprature))
+
+        # Softmax numerator, the first candidate is the largest (exp(0) = 1)
+        Probs.sub_(Column.copy_(Probs[:, :1]))
+        Probs.exp_()
+
+        if Topk is not None:
+            torch.ge(self.range, self._set(self.topk[:B], Topk), out=Mask)
+            Probs.masked_fill_(Mask, 0.)
+
+        if Minp is not None:
+            torch.lt(Probs, self._set(self.minp[:B], Minp), out=Mask)
+            Probs.masked_fill_(Mask, 0.)
+
+        if Topp is not None:
+            # Drops candidates after the cumulative probability reached Topp
+            Cumulative = self.cumulative[:B]
+            torch.cumsum(Probs, dim=-1, out=Cumulative)
+            Cumulative.sub_(Probs)
+            Cumulative.div_(torch.sum(Probs, dim=-1, keepdim=True, out=Column))
+            torch.ge(Cumulative, self._set(self.topp[:B], Topp), out=Mask)
+            Mask[:, 0] = False
+            Probs.masked_fill_(Mask, 0.)
+
+        # multinomial does not need normalized probabilities
+        if isinstance(SampleRng, (list, tuple)):
+            for Row, Rng in enumerate(SampleRng[:B]):
+                torch.multinomial(Probs[Row], num_samples=1, generator=Rng, out=self.choice[Row])
+        else:
+            torch.multinomial(Probs, num_samples=1, generator=SampleRng, out=self.choice[:B])
+        return torch.gather(Indices, 1, self.choice[:B], out=self.tokens[:B])
@@ -0,0 +1,130 @@
+import torch
+from base_files.transformer_files.kv_cache import kvcache
+from base_files.inference_files.sampling import filtered_probs
+
+
+def _sample(Probs: torch.Tensor, SampleRng: torch.Generator = None) -> torch.Tensor:
+    # Samples one token of every row of (BatchSize, Vocab) probabilities
+    return torch.multinomial(Probs, num_samples=1, generator=SampleRng)[:, 0]
+
+
+@torch.no_grad()
+def generate_speculative(model,
+                         draft,
+                         ImgEmbd: torch.Tensor,
+                         DraftImgEmbd: torch.Tensor,
+                         TokenSize: int,
+                         StartTok: int = 0,
+                         EndTok: int = 1,
+                         Temprature: float = 1.0,
+                         Topk: int = 100,
+                         NumDraft: int = 4,
+                         SampleRng: torch.Generator = None,
+                         Stats: dict = None,
+                         Topp: float = None,
+                         Minp: float = None) -> list:
+    '''
+    Speculative sampling: every round the small draft decoder proposes up to
+    NumDraft tokens one by one, then the main decoder scores all of them in
+    a single forward pass. A drafted token d is accepted with probability
+    min(1, p(d) / q(d)) (p: main model, q: draft model), the first rejected
+    one is replaced by a sample of max(p - q, 0), if all are accepted one
+    more token is sampled from p. The captions therefore follow exactly the
+    distribution of generate_captions with the main model (same
+    temperature, top-k, top-p and min-p).
+
+    Rows of a batch advance together: every row keeps as many tokens as the
+    row with the fewest accepted drafts, plus one more token that is an exact
+    sample of p (an accepted draft or the correction).
+
+    ImgEmbd and DraftImgEmbd are the image encodings of each model. Returns a
+    list of token id lists like generate_captions, the number of rounds,
+    drafted and accepted tokens are added to Stats (if given).
+    '''
+    BatchSize = ImgEmbd.size(0)
+    device = ImgEmbd.device
+    TokenSize = min(TokenSize, model.config.blockSize, draft.config.blockSize)
+
+    Cache = kvcache(model.config, BatchSize=BatchSize, device=device, dtype=ImgEmbd.dtype)
+    DraftCache = kvcache(draft.config, BatchSize=BatchSize, device=device, dtype=DraftImgEmbd.dtype)
+
+    # Sequence with the start token, Length tokens are known
+    Seq = torch.full((BatchSize, TokenSize + 1), EndTok, dtype=torch.long, device=device)
+    Seq[:, 0] = StartTok
+    Length = 1
+    DraftLength = 0 # Positions stored inside the draft cache
+    Finished = torch.zeros(BatchSize, dtype=torch.bool, device=device)
+    Rounds = Drafted = Accepted = 0
+
+    while Length - 1 < TokenSize and not Finished.all():
+        # Drafts never make the round produce more than TokenSize tokens
+        k = min(NumDraft, TokenSize - Length)
+
+        # Drafting k tokens (the draft cache may lag behind by a few tokens)
+        DraftTokens, DraftProbs = [], []
+        XGen = Seq[:, DraftLength:Length]
+        Pos = DraftLength
+        for _ in range(k):
+            logits = draft.decode(XGen, DraftImgEmbd, StartPos=Pos, Cache=DraftCache)
+            q = filtered_probs(logits[:, -1, :], Temprature, Topk, Topp, Minp)
+            ix = _sample(q, SampleRng)
+            Pos += XGen.size(1)
+            XGen = ix.unsqueeze(1)
+            DraftTokens.append(ix)
+            DraftProbs.append(q)
+
+        # Scoring the last known token and every draft in one forward pass
+        XGen = torch.cat([Seq[:, Length - 1:Length]] + [d.unsqueeze(1) for d in DraftTokens], dim=1)
+        logits = model.decode(XGen, ImgEmbd, StartPos=Length - 1, Cache=Cache)
+        p = filtered_probs(logits, Temprature, Topk, Topp, Minp) # (BatchSize, k + 1, Vocab)
+
+        m = 0
+        if k > 0:
+            d = torch.stack(DraftTokens, dim=1) # (BatchSize, k)
+            q = torch.stack(DraftProbs, dim=1) # (BatchSize, k, Vocab)
+            pd = p[:, :k].gather(-1, d.unsqueeze(-1)).squeeze(-1)
+            qd = q.gather(-1, d.unsqueeze(-1)).squeeze(-1)
+            u = torch.rand(pd.shape, device=device, generator=SampleRng)
+            Accept = u * qd < pd
+            NumAccepted = Accept.long().cumprod(dim=1).sum(dim=1)
+            # Finished rows do not limit the others
+            NumAccepted = NumAccepted.masked_fill(Finished, k)
+            m = int(NumAccepted.min())
+            Drafted += k
+            Accepted += m
+
+        # Token at position m: accepted draft, correction or extra sample of p
+        if m < k:
+            Residual = (p[:, m] - q[:, m]).clamp(min=0)
+            Empty = Residual.sum(dim=-1, keepdim=True) == 0
+            Residual = torch.where(Empty, p[:, m], Residual)
+            Last = torch.where(NumAccepted > m, d[:, m], _sample(Residual, SampleRng))
+        else:
+            Last = _sample(p[:, k], SampleRng)
+
+        New = Last.unsqueeze(1) if m == 0 else torch.cat([d[:, :m], Last.unsqueeze(1)], dim=1)
+
+        # Finished rows keep producing the end token
+        IsEnd = New == EndTok
+        AfterEnd = (IsEnd.long().cumsum(dim=1) - IsEnd.long()) > 0
+        New = New.masked_fill(Finished.unsqueeze(1) | AfterEnd, EndTok)
+        Finished |= IsEnd.any(dim=1)
+
+        Seq[:, Length:Length + m + 1] = New
+        DraftLength = Length + min(m, k - 1) if k > 0 else DraftLength
+        Length += m + 1
+        Rounds += 1
+
+    if Stats is not None:
+        for Key, Value in (('rounds', Rounds),
+                           ('drafted', Drafted),
+                           ('accepted', Accepted),
+                           ('tokens', Length - 1)):
+            Stats[Key] = Stats.get(Key, 0) + Value
+
+    Captions = []
+    for Row in Seq[:, 1:Length].tolist():
+        if EndTok in Row:
+            Row = Row[:Row.index(EndTok) + 1]
+        Captions.append([StartTok] + Row)
+    return Captions
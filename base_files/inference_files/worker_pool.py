@@ -0,0 +1,251 @@
+import os
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+from base_files.inference_files.model_loader import load_caption_model
+from base_files.inference_files.generator import generate_captions
+from base_files.dataset_files.image_transforms import load_image, preprocess_images
+from base_files.training_files.distributed import pin_cpu_threads
+from base_files.runtime_files.precision import precisionpolicy
+
+
+def _worker_loop(WorkerId: int,
+                 NumWorkers: int,
+                 ThreadsPerWorker: int,
+                 model,
+                 Backbone,
+                 Precision: precisionpolicy,
+                 Settings: dict,
+                 Tasks,
+                 Results):
+    # Every worker gets its own cores and intra-op threads
+    pin_cpu_threads(WorkerId, NumWorkers, ThreadsPerWorker)
+    SampleRng = torch.Generator()
+    while True:
+        Task = Tasks.get()
+        if Task is None:
+            break
+        CallId, BatchId, ImgPaths = Task
+        # The parent knows which batch a worker holds if the worker dies
+        Results.put(('start', WorkerId, CallId, BatchId, None, None))
+        try:
+            # Images that can not be read or decoded get an error entry
+            Images, Rows = [], []
+            for ImgPath in ImgPaths:
+                try:
+                    Images.append(load_image(ImgPath, Backbone.name))
+                    Rows.append(None)
+                except Exception as Error:
+                    Rows.append(f'{type(Error).__name__}: {Error}')
+
+            Tokens = []
+            if Images:
+                # Seeded per batch, captions do not depend on the worker
+                SampleRng.manual_seed(1337 + BatchId)
+                with torch.inference_mode(), Precision.autocast():
+                    ImgEmbd = model.encode_image(Backbone(preprocess_images(Images, Backbone.name)))
+                    Tokens = generate_captions(model,
+                                               ImgEmbd,
+                                               Settings['TokenSize'],
+                                               StartTok=Settings['StartTok'],
+                                               EndTok=Settings['EndTok'],
+                                               Temprature=Settings['Temprature'],
+                                               Topk=Settings['Topk'],
+                                               SampleRng=SampleRng,
+                                               Topp=Settings['Topp'],
+                                               Minp=Settings['Minp'])
+            # (tokens, None) for captioned images, (None, error) for the others
+            Tokens = iter(Tokens)
+            Rows = [(next(Tokens), None) if Error is None else (None, Error)
+                    for Error in Rows]
+            Results.put(('done', WorkerId, CallId, BatchId, Rows, None))
+        except Exception:
+            Results.put(('done', WorkerId, CallId, BatchId, None, traceback.format_exc()))
+
+
+class workerpool:
+    '''
+    CPU inference with several model replicas. The checkpoint is loaded once
+    in the parent process and its tensors are moved to shared memory, then
+    NumWorkers processes are forked and map the same weights, so memory does
+    not grow with the number of workers. Every worker is pinned to its own
+    cores (ThreadsPerWorker intra-op threads) and takes batches of images
+    from a shared queue, busy workers do not hold back the others.
+    '''
+    def __init__(self,
+                 data: dict,
+                 ModelPath: str,
+                 tokenizer,
+                 NumWorkers: int = None,
+                 ThreadsPerWorker: int = None,
+                 BatchSize: int = 8,
+                 TokenSize: int = None,
+                 Temprature: float = 1.0,
+                 Topk: int = 100,
+                 Topp: float = None,
+                 Minp: float = None,
+                 PollInterval: float = 1.0):
+
+        Cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        if NumWorkers is None:
+            NumWorkers = max(1, Cores // (ThreadsPerWorker or 4))
+        ThreadsPerWorker = ThreadsPerWorker or max(1, Cores // NumWorkers)
+        self.NumWorkers = NumWorkers
+        self.ThreadsPerWorker = ThreadsPerWorker
+        self.BatchSize = BatchSize
+        self.tokenizer = tokenizer
+        self.CallId = 0
+        self.PollInterval = PollInterval # Seconds between checks of the workers
+
+        '''
+        One intra-op thread while loading keeps the OpenMP thread team from
+        being created before the fork (it is not usable in forked children).
+        The thread count of the parent is restored once the workers run.
+        '''
+        ParentThreads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        try:
+            os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+            model, Backbone, config = load_caption_model(data, ModelPath, 'cpu')
+            model.share_memory()
+            Backbone.model.share_memory()
+            self.config = config
+            self.Precision = precisionpolicy(data['model_config']['dtype'], 'cpu').apply()
+
+            Settings = {
+                    'TokenSize': min(TokenSize or config.blockSize, config.blockSize),
+                    'StartTok': tokenizer.token_to_id('<|start_of_text|>'),
+                    'EndTok': tokenizer.token_to_id('<|end_of_text|>'),
+                    'Temprature': Temprature,
+                    'Topk': Topk,
+                    'Topp': Topp,
+                    'Minp': Minp
+                    }
+            self.Settings = Settings
+
+            Context = mp.get_context('fork')
+            self.tasks = Context.Queue()
+            self.results = Context.Queue()
+            self.workers = []
+            for WorkerId in range(NumWorkers):
+                Worker = Context.Process(target=_worker_loop,
+                                         args=(WorkerId,
+                                               NumWorkers,
+                                               ThreadsPerWorker,
+                                               model,
+                                               Backbone,
+                                               self.Precision,
+                                               Settings,
+                                               self.tasks,
+                                               self.results),
+                                         daemon=True)
+                Worker.start()
+                self.workers.append(Worker)
+        finally:
+            torch.set_num_threads(ParentThreads)
+
+    def caption(self, ImgPaths: list) -> list:
+        '''
+        Returns one row per image, in the order of ImgPaths: image_path and
+        caption, or image_path and error for images that could not be read.
+        Every batch of the call is collected before a worker failure is
+        raised, so no result is left in the queue for the next call.
+        '''
+        if not self.workers:
+            raise RuntimeError("The worker pool is closed")
+        self.CallId += 1
+        Batches = [ImgPaths[i:i + self.BatchSize]
+                   for i in range(0, len(ImgPaths), self.BatchSize)]
+        for BatchId, Batch in enumerate(Batches):
+            self.tasks.put((self.CallId, BatchId, Batch))
+
+        Results = [None] * len(Batches)
+        Failures = []
+        Unfinished = set(range(len(Batches)))
+        Running = {} # BatchId a worker is captioning
+        while Unfinished:
+            try:
+                Kind, WorkerId, CallId, BatchId, Rows, Error = self.results.get(timeout=self.PollInterval)
+            except queue.Empty:
+                self._check_workers(Running, Unfinished)
+                continue
+            # Results of an earlier call are dropped
+            if CallId != self.CallId:
+                continue
+            if Kind == 'start':
+                Running[WorkerId] = BatchId
+                continue
+            Running.pop(WorkerId, None)
+            Unfinished.discard(BatchId)
+            if Error is not None:
+                Failures.append(f"Worker failed on batch {BatchId}:\n{Error}")
+            Results[BatchId] = Rows
+        if Failures:
+            raise RuntimeError("\n".join(Failures))
+
+        Special = (self.Settings['StartTok'], self.Settings['EndTok'])
+        Captions = []
+        for Batch, Rows in zip(Batches, Results):
+            for ImgPath, (Tokens, Error) in zip(Batch, Rows):
+                if Error is not None:
+                    Captions.append({'image_path': ImgPath, 'error': Error})
+                else:
+                    Captions.append({'image_path': ImgPath,
+                                     'caption': self.tokenizer.decode([Tok for Tok in Tokens if Tok not in Special])})
+        return Captions
+
+    def _check_workers(self, Running: dict, Unfinished: set):
+        '''
+        A worker that died (killed, out of memory) never sends its result.
+        The pool is shut down, a dead worker can leave the shared queues
+        locked, and the dead workers with their batches are reported.
+        '''
+        Dead = [(WorkerId, Worker) for WorkerId, Worker in enumerate(self.workers)
+                if not Worker.is_alive()]
+        if not Dead:
+            return
+        Message = "; ".join(f"worker {WorkerId} (pid {Worker.pid}, exit code {Worker.exitcode}) died with batch {Running.get(WorkerId, 'none')}"
+                            for WorkerId, Worker in Dead)
+        self.terminate()
+        raise RuntimeError(f"{Message}, unfinished batches: {sorted(Unfinished)}, the worker pool was shut down")
+
+    def memory(self) -> dict:
+        '''
+        Resident (rss) and proportional (pss, shared pages divided between
+        the processes using them) memory of the parent and the workers in MB.
+        Linux only, empty elsewhere.
+        '''
+        Usage = {'rss_mb': 0., 'pss_mb': 0.}
+        for Pid in [os.getpid()] + [Worker.pid for Worker in self.workers]:
+            try:
+                with open(f'/proc/{Pid}/smaps_rollup') as f:
+                    for Line in f:
+                        Key, Value = Line.split(':', 1)
+                        if Key in ('Rss', 'Pss'):
+                            Usage[f'{Key.lower()}_mb'] += int(Value.split()[0]) / 1024
+            except OSError:
+                return {}
+        return Usage
+
+    def terminate(self):
+        # Stops the workers without waiting for queued batches
+        for Worker in self.workers:
+            if Worker.is_alive():
+                Worker.terminate()
+        for Worker in self.workers:
+            Worker.join()
+        self.workers = []
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for Worker in self.workers:
+            Worker.join()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *Args):
+        self.close()
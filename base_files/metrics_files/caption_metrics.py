@@ -0,0 +1,202 @@
+import math
+import numpy as np
+from multiprocessing import Pool
+
+
+MAX_N = 4
+
+
+def ngram_codes(Tokens: np.ndarray,
+                n: int,
+                Base: int) -> np.ndarray:
+    '''
+    Encodes every n-gram of a token id array into a single int64 using the
+    vocabulary size as base. 30080 ** 4 fits inside int64, so n-grams up to
+    4 tokens can be counted with np.unique instead of python dictionaries.
+    '''
+    if len(Tokens) < n:
+        return np.empty(0, dtype=np.int64)
+    Windows = np.lib.stride_tricks.sliding_window_view(Tokens, n)
+    Powers = Base ** np.arange(n - 1, -1, -1, dtype=np.int64)
+    return Windows.astype(np.int64) @ Powers
+
+
+def count_ngrams(Tokens: np.ndarray,
+                 n: int,
+                 Base: int):
+    # Sorted unique n-gram codes and their counts
+    return np.unique(ngram_codes(Tokens, n, Base), return_counts=True)
+
+
+def max_ref_counts(Refs: list,
+                   n: int,
+                   Base: int):
+    '''
+    Maximum count of every n-gram over the references, this is the clipping
+    limit of modified n-gram precision in BLEU.
+    '''
+    Codes, Counts = [], []
+    for Ref in Refs:
+        c, k = count_ngrams(Ref, n, Base)
+        Codes.append(c)
+        Counts.append(k)
+    Codes = np.concatenate(Codes)
+    Counts = np.concatenate(Counts)
+    if len(Codes) == 0:
+        return Codes, Counts
+
+    Order = np.argsort(Codes, kind='stable')
+    Codes, Counts = Codes[Order], Counts[Order]
+    Unique, Starts = np.unique(Codes, return_index=True)
+    return Unique, np.maximum.reduceat(Counts, Starts)
+
+
+def match_counts(Codes: np.ndarray,
+                 RefCodes: np.ndarray,
+                 RefValues: np.ndarray) -> np.ndarray:
+    # Looks up RefValues of sorted RefCodes for every code, 0 when missing
+    if len(RefCodes) == 0:
+        return np.zeros(len(Codes), dtype=RefValues.dtype)
+    Index = np.searchsorted(RefCodes, Codes)
+    Index = np.minimum(Index, len(RefCodes) - 1)
+    Found = RefCodes[Index] == Codes
+    return np.where(Found, RefValues[Index], 0)
+
+
+def document_frequency(References: list,
+                       Base: int) -> list:
+    '''
+    For every n, number of images whose reference set contains an n-gram.
+    Returned as a list of (sorted codes, frequencies) pairs.
+    '''
+    Frequency = []
+    for n in range(1, MAX_N + 1):
+        PerImage = [np.unique(np.concatenate([ngram_codes(Ref, n, Base)
+                                              for Ref in Refs]))
+                    for Refs in References]
+        Frequency.append(np.unique(np.concatenate(PerImage),
+                                   return_counts=True))
+    return Frequency
+
+
+'''Worker side of the scoring, state is set once per process'''
+_State = {}
+
+
+def _init_worker(Frequency: list,
+                 NumImages: int,
+                 Base: int):
+    _State['frequency'] = Frequency
+    _State['log_images'] = math.log(float(NumImages))
+    _State['base'] = Base
+
+
+def _tfidf(Tokens: np.ndarray, n: int):
+    # Tf-idf vector (sparse, as sorted codes and values) and its norm
+    Codes, Counts = count_ngrams(Tokens, n, _State['base'])
+    DfCodes, Df = _State['frequency'][n - 1]
+    Df = match_counts(Codes, DfCodes, Df)
+    Values = Counts * (_State['log_images'] - np.log(np.maximum(1.0, Df)))
+    return Codes, Values, np.sqrt(np.sum(Values ** 2))
+
+
+def _cider_d(Hyp: np.ndarray,
+             Refs: list,
+             Sigma: float = 6.0) -> float:
+    Scores = np.zeros(MAX_N)
+    for n in range(1, MAX_N + 1):
+        HypCodes, HypValues, HypNorm = _tfidf(Hyp, n)
+        for Ref in Refs:
+            RefCodes, RefValues, RefNorm = _tfidf(Ref, n)
+            RefMatch = match_counts(HypCodes, RefCodes, RefValues)
+            Value = np.sum(np.minimum(HypValues, RefMatch) * RefMatch)
+            if HypNorm != 0 and RefNorm != 0:
+                Value /= HypNorm * RefNorm
+            Delta = float(len(Hyp) - len(Ref))
+            Scores[n - 1] += Value * math.exp(-(Delta ** 2) / (2 * Sigma ** 2))
+    return float(np.mean(Scores / len(Refs)) * 10.0)
+
+
+def _score_chunk(Chunk: list) -> dict:
+    # BLEU statistics and CIDEr-D scores for a list of (Hyp, Refs) pairs
+    Base = _State['base']
+    Matches = np.zeros(MAX_N, dtype=np.int64)
+    Totals = np.zeros(MAX_N, dtype=np.int64)
+    HypLength = 0
+    RefLength = 0
+    Cider = []
+    for Hyp, Refs in Chunk:
+        for n in range(1, MAX_N + 1):
+            Codes, Counts = count_ngrams(Hyp, n, Base)
+            RefCodes, RefCounts = max_ref_counts(Refs, n, Base)
+            Matches[n - 1] += np.minimum(Counts,
+                                         match_counts(Codes, RefCodes, RefCounts)).sum()
+            Totals[n - 1] += Counts.sum()
+
+        # Closest reference length (shorter one on ties)
+        Lengths = np.array([len(Ref) for Ref in Refs])
+        Closest = Lengths[np.lexsort((Lengths, np.abs(Lengths - len(Hyp))))[0]]
+        HypLength += len(Hyp)
+        RefLength += int(Closest)
+        Cider.append(_cider_d(Hyp, Refs))
+
+    return {
+            'matches': Matches,
+            'totals': Totals,
+            'hyp_length': HypLength,
+            'ref_length': RefLength,
+            'cider': Cider
+            }
+
+
+def corpus_scores(Hypotheses: list,
+                  References: list,
+                  VocabSize: int,
+                  NumWorkers: int = 1,
+                  ChunkSize: int = 256) -> dict:
+    '''
+    Corpus level BLEU-4 and CIDEr-D over token id sequences. The n-grams
+    are BPE tokens, not the words of the COCO caption evaluation, so the
+    scores are named bleu4_bpe and cider_d_bpe.
+
+    Hypotheses: list of token id lists (one per image)
+    References: list of lists of token id lists (references of every image)
+    '''
+    Hypotheses = [np.asarray(Hyp, dtype=np.int64) for Hyp in Hypotheses]
+    References = [[np.asarray(Ref, dtype=np.int64) for Ref in Refs]
+                  for Refs in References]
+    Frequency = document_frequency(References, VocabSize)
+
+    Pairs = list(zip(Hypotheses, References))
+    Chunks = [Pairs[i:i + ChunkSize] for i in range(0, len(Pairs), ChunkSize)]
+    InitArgs = (Frequency, len(References), VocabSize)
+    if NumWorkers > 1:
+        with Pool(NumWorkers, initializer=_init_worker, initargs=InitArgs) as pool:
+            Results = pool.map(_score_chunk, Chunks)
+    else:
+        _init_worker(*InitArgs)
+        Results = [_score_chunk(Chunk) for Chunk in Chunks]
+
+    Matches = sum(Result['matches'] for Result in Results)
+    Totals = sum(Result['totals'] for Result in Results)
+    HypLength = sum(Result['hyp_length'] for Result in Results)
+    RefLength = sum(Result['ref_length'] for Result in Results)
+    Cider = [Score for Result in Results for Score in Result['cider']]
+
+    # Geometric mean of modified precisions with brevity penalty
+    Precisions = Matches / np.maximum(Totals, 1)
+    if np.any(Matches == 0):
+        Bleu = 0.0
+    else:
+        Bleu = math.exp(np.mean(np.log(Precisions)))
+    if HypLength < RefLength:
+        Bleu *= math.exp(1 - RefLength / max(HypLength, 1))
+
+    return {
+            'bleu4_bpe': Bleu,
+            'precisions': Precisions.tolist(),
+            'hyp_length': int(HypLength),
+            'ref_length': int(RefLength),
+            'cider_d_bpe': float(np.mean(Cider)) if Cider else 0.0,
+            'cider_d_bpe_per_image': Cider
+            }
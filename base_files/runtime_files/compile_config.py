@@ -0,0 +1,71 @@
+import os
+import torch
+
+
+# Settings used when a component is missing from 'compile_config'
+DEFAULT_COMPILE = {
+        'backbone': {'enabled': False, 'mode': 'default', 'dynamic': True},
+        'decoder': {'enabled': True, 'mode': 'default', 'dynamic': None},
+        'decode_step': {'enabled': False, 'mode': 'default', 'dynamic': True}
+        }
+
+ARTIFACT_NAME = 'compile_artifacts.bin'
+
+
+def get_component_config(CompileConf: dict,
+                         Component: str) -> dict:
+    Conf = dict(DEFAULT_COMPILE[Component])
+    Conf.update(CompileConf.get(Component) or {})
+    return Conf
+
+
+def compile_component(Module,
+                      CompileConf: dict,
+                      Component: str):
+    '''
+    Compiles a module (or function) with the settings of one component:
+        backbone: frozen Cnn model, batch size changes so dynamic by default
+        decoder: trainable transformer
+        decode_step: transformer.decode used by incremental decoding, StartPos
+                     and cache length change every step so dynamic by default
+    Returns the input unchanged if compilation of the component is disabled.
+    '''
+    Conf = get_component_config(CompileConf, Component)
+    if not Conf['enabled']:
+        return Module
+    return torch.compile(Module,
+                         mode=Conf['mode'],
+                         dynamic=Conf['dynamic'],
+                         fullgraph=bool(Conf.get('fullgraph', False)))
+
+
+def load_compile_cache(CacheDir: str = None):
+    '''
+    Points the inductor cache to a persistent directory (the default one is
+    inside /tmp) and loads artifacts saved by a previous run, so restarts
+    reuse compiled kernels and graphs instead of compiling again.
+    '''
+    if CacheDir is None:
+        return
+    os.makedirs(CacheDir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = CacheDir
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+
+    ArtifactPath = os.path.join(CacheDir, ARTIFACT_NAME)
+    if os.path.exists(ArtifactPath) and hasattr(torch.compiler, 'load_cache_artifacts'):
+        with open(ArtifactPath, 'rb') as f:
+            torch.compiler.load_cache_artifacts(f.read())
+
+
+def save_compile_cache(CacheDir: str = None):
+    # Saves artifacts of everything compiled by this process
+    if CacheDir is None or not hasattr(torch.compiler, 'save_cache_artifacts'):
+        return
+    Artifacts = torch.compiler.save_cache_artifacts()
+    if Artifacts is None:
+        return
+    ArtifactPath = os.path.join(CacheDir, ARTIFACT_NAME)
+    with open(f'{ArtifactPath}.tmp', 'wb') as f:
+        f.write(Artifacts[0])
+    os.replace(f'{ArtifactPath}.tmp', ArtifactPath)
@@ -0,0 +1,56 @@
+from contextlib import nullcontext
+import torch
+
+
+class precisionpolicy:
+    '''
+    Decides how a model runs for a requested dtype ('bf16', 'fp16' or 'fp32')
+    on a device:
+        - cuda: bf16 autocast if the GPU supports it (otherwise fp16), fp16
+                autocast with a GradScaler
+        - cpu: bf16 autocast, fp16 is mapped to bf16 because CPU fp16
+               kernels are slow and bf16 does not need loss scaling
+        - mps: fp32
+    The forward pass is run exactly once inside autocast().
+    '''
+    def __init__(self,
+                 dtype: str,
+                 device_type: str):
+
+        self.device_type = device_type
+        self.dtype = None # Autocast dtype, None means fp32
+
+        if device_type == 'cuda':
+            if dtype == 'bf16' and torch.cuda.is_bf16_supported():
+                self.dtype = torch.bfloat16
+            elif dtype in ('bf16', 'fp16'):
+                self.dtype = torch.float16
+        elif device_type == 'cpu':
+            if dtype in ('bf16', 'fp16'):
+                self.dtype = torch.bfloat16
+
+        # Gradients of fp16 can underflow, so loss scaling is required
+        self.UseScaler = self.dtype == torch.float16
+
+        # TF32 matmuls for the parts left in fp32
+        self.MatmulPrecision = 'high' if device_type == 'cuda' else 'highest'
+
+    def __repr__(self):
+        Name = {torch.bfloat16: 'bf16', torch.float16: 'fp16'}.get(self.dtype, 'fp32')
+        return f'precisionpolicy({Name}, device={self.device_type}, scaler={self.UseScaler})'
+
+    def apply(self):
+        # Sets the global matmul precision
+        torch.set_float32_matmul_precision(self.MatmulPrecision)
+        return self
+
+    def autocast(self):
+        if self.dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=self.device_type,
+                              dtype=self.dtype)
+
+    def get_scaler(self):
+        if not self.UseScaler:
+            return None
+        return torch.amp.GradScaler(self.device_type, enabled=True)
@@ -0,0 +1,141 @@
+import time
+import threading
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torch.distributed.algorithms.ddp_comm_hooks import powerSGD_hook as powersgd
+
+
+# Settings used when a key is missing from the hook settings
+DEFAULT_HOOK = {
+        'name': 'none',
+        'powersgd_rank': 1,
+        'powersgd_start_iter': 1000,
+        'powersgd_min_compression_rate': 2
+        }
+
+
+def get_hook_config(DistConf: dict,
+                    Checkpoint: dict = None) -> dict:
+    '''
+    Hook settings of the run. A resumed run keeps the hook stored in its
+    checkpoint, so the gradients are communicated the same way as before.
+    '''
+    HookConf = dict(DEFAULT_HOOK)
+    if Checkpoint is not None and 'comm_hook' in Checkpoint:
+        HookConf.update(Checkpoint['comm_hook'])
+    else:
+        HookConf.update(DistConf.get('comm_hook') or {})
+    HookConf['name'] = str(HookConf['name']).lower()
+    return HookConf
+
+
+class commstats:
+    '''
+    Communication of the gradient buckets during one optimizer step:
+        bytes: size of the tensors that were all-reduced (after compression)
+        time: sum over buckets of the time between starting the all-reduce
+              and its completion, buckets overlap with the backward pass so
+              this is not all waiting time
+    Future callbacks run on other threads, so updates are locked.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.time = 0.
+
+    def add(self, Bytes: int = 0, Time: float = 0.):
+        with self.lock:
+            self.bytes += Bytes
+            self.time += Time
+
+    def step(self) -> tuple:
+        # Returns (bytes, seconds) since the last call and resets the counters
+        with self.lock:
+            Result = (self.bytes, self.time)
+            self.bytes, self.time = 0, 0.
+        return Result
+
+
+def _allreduce_bytes(Bucket, ElementSize: int = None) -> int:
+    Buffer = Bucket.buffer()
+    return Buffer.numel() * (ElementSize or Buffer.element_size())
+
+
+def _powersgd_bytes(State, Bucket) -> int:
+    '''
+    PowerSGD sends the whole bucket until start_powerSGD_iter, afterwards
+    vectors and small matrices are sent as they are and the other matrices
+    as two low rank factors P (rows x rank) and Q (cols x rank).
+    '''
+    if State.iter < State.start_powerSGD_iter:
+        return _allreduce_bytes(Bucket)
+
+    Bytes = 0
+    for Tensor in Bucket.gradients():
+        Size = Tensor.element_size()
+        if Tensor.ndimension() <= 1:
+            Bytes += Tensor.numel() * Size
+            continue
+        Rows = Tensor.shape[0]
+        Cols = Tensor.numel() // Rows
+        Rank = min(Rows, Cols, State.matrix_approximation_rank)
+        Compressed = (Rows + Cols) * Rank
+        if Tensor.numel() > Compressed * State.min_compression_rate:
+            Bytes += Compressed * Size
+        else:
+            Bytes += Tensor.numel() * Size
+    return Bytes
+
+
+def _measured(Hook, BytesFn, Stats: commstats):
+    # Wraps a hook to record its communicated bytes and time (DDP checks the
+    # argument names, so they have to be 'state' and 'bucket')
+    def hook(state, bucket):
+        Stats.add(Bytes=BytesFn(state, bucket))
+        t0 = time.perf_counter()
+
+        def done(Fut):
+            Stats.add(Time=time.perf_counter() - t0)
+            return Fut.value()
+
+        return Hook(state, bucket).then(done)
+    return hook
+
+
+def register_comm_hook(model,
+                       HookConf: dict,
+                       GlobalStep: int = 0) -> commstats:
+    '''
+    Registers the gradient communication hook on a DDP model:
+        none: default all-reduce (still measured)
+        fp16 / bf16: gradients are cast to 16 bits before the all-reduce
+        powersgd: low rank compression with error feedback, plain all-reduce
+                  is used for the first powersgd_start_iter steps
+    GlobalStep is the step a resumed run starts from, so PowerSGD does not
+    repeat its warm up steps. Returns the statistics filled by the hook.
+    '''
+    Name = HookConf['name']
+    Stats = commstats()
+
+    if Name == 'none':
+        model.register_comm_hook(None, _measured(default_hooks.allreduce_hook,
+                                                 lambda State, Bucket: _allreduce_bytes(Bucket),
+                                                 Stats))
+    elif Name in ('fp16', 'bf16'):
+        Hook = default_hooks.fp16_compress_hook if Name == 'fp16' \
+            else default_hooks.bf16_compress_hook
+        model.register_comm_hook(None, _measured(Hook,
+                                                 lambda State, Bucket: _allreduce_bytes(Bucket, 2),
+                                                 Stats))
+    elif Name == 'powersgd':
+        State = powersgd.PowerSGDState(process_group=None,
+                                       matrix_approximation_rank=HookConf['powersgd_rank'],
+                                       start_powerSGD_iter=HookConf['powersgd_start_iter'],
+                                       min_compression_rate=HookConf['powersgd_min_compression_rate'])
+        State.iter = GlobalStep
+        model.register_comm_hook(State, _measured(powersgd.powerSGD_hook,
+                                                  _powersgd_bytes,
+                                                  Stats))
+    else:
+        raise ValueError(f"Unknown communication hook: {Name}")
+
+    return Stats
@@ -0,0 +1,86 @@
+import os
+import torch
+from torch.distributed import init_process_group
+
+
+def get_backend(Backend: str = None) -> str:
+    # nccl is used for GPU's, gloo for CPU only hosts
+    if Backend is not None:
+        return Backend
+    return 'nccl' if torch.cuda.is_available() else 'gloo'
+
+
+def get_world_size(Backend: str,
+                   WorldSize: int = None) -> int:
+    # One process per GPU for nccl, one process for CPU unless configured
+    if WorldSize is not None:
+        return WorldSize
+    if Backend == 'nccl':
+        return torch.cuda.device_count()
+    return 1
+
+
+def get_elastic_env() -> dict:
+    '''
+    Ranks of a process started by torchrun (or another launcher using the
+    same environment variables), None for a normal launch.
+    '''
+    if not all(Key in os.environ for Key in ('RANK', 'WORLD_SIZE', 'LOCAL_RANK')):
+        return None
+    return {
+            'rank': int(os.environ['RANK']),
+            'world_size': int(os.environ['WORLD_SIZE']),
+            'local_rank': int(os.environ['LOCAL_RANK']),
+            'local_world_size': int(os.environ.get('LOCAL_WORLD_SIZE', os.environ['WORLD_SIZE']))
+            }
+
+
+def setup(rank: int,
+          world_size: int,
+          Backend: str = 'nccl',
+          MasterAddr: str = None,
+          MasterPort: str = None,
+          Elastic: bool = False):
+    '''
+    Initializes the process group. Rendezvous address and port are taken
+    from the arguments, then from the environment, then the defaults. With
+    Elastic=True the launcher has already set every variable (env://).
+    '''
+    if Elastic:
+        init_process_group(backend=Backend)
+        return
+
+    os.environ['MASTER_ADDR'] = str(MasterAddr or os.environ.get('MASTER_ADDR', 'localhost'))
+    os.environ['MASTER_PORT'] = str(MasterPort or os.environ.get('MASTER_PORT', '5674'))
+
+    init_process_group(backend=Backend,
+                       rank=rank,
+                       world_size=world_size)
+
+
+def pin_cpu_threads(rank: int,
+                    world_size: int,
+                    ThreadsPerRank: int = None) -> int:
+    '''
+    Gives every CPU rank its own set of cores, so intra-op threads of
+    different ranks do not compete for the same cores.
+    '''
+    Cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+        else list(range(os.cpu_count()))
+    if ThreadsPerRank is None:
+        ThreadsPerRank = max(1, len(Cores) // world_size)
+
+    RankCores = Cores[rank * ThreadsPerRank:(rank + 1) * ThreadsPerRank]
+    if RankCores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, RankCores)
+
+    torch.set_num_threads(ThreadsPerRank)
+    return ThreadsPerRank
+
+
+def synchronize(device_type: str):
+    # Waits for the device to finish its work (no-op on CPU)
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    elif device_type == 'mps':
+        torch.mps.synchronize()
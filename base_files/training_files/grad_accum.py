@@ -0,0 +1,54 @@
+from contextlib import nullcontext
+import torch
+
+
+class gradaccumulator:
+    '''
+    Runs forward and backward for every micro batch of an optimizer step.
+    Each loss is scaled by 1 / GradAccumSteps, so accumulated gradients equal
+    the gradient of the mean loss over the whole batch. Gradients of DDP ranks
+    are synchronized only during the backward pass of the last micro batch
+    (no_sync is used for the others).
+    '''
+    def __init__(self,
+                 model,
+                 GradAccumSteps: int,
+                 Scaler=None,
+                 DistDataParallel: bool = False):
+
+        self.model = model
+        self.GradAccumSteps = GradAccumSteps
+        self.Scaler = Scaler
+        self.DistDataParallel = DistDataParallel
+
+    def sync_context(self, MicroStep: int):
+        if self.DistDataParallel and MicroStep < self.GradAccumSteps - 1:
+            return self.model.no_sync()
+        return nullcontext()
+
+    def backward(self, loss):
+        if self.Scaler is not None:
+            self.Scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def accumulate(self, MicroBatches, ForwardFn) -> torch.Tensor:
+        '''
+        MicroBatches: iterator, next() gives the input of ForwardFn
+        ForwardFn: function returning the loss of a micro batch
+
+        Returns the mean loss of the step as a detached device tensor, so no
+        host device synchronization happens here.
+        '''
+        LossAccum = None
+        for MicroStep in range(self.GradAccumSteps):
+            Batch = next(MicroBatches)
+
+            with self.sync_context(MicroStep):
+                loss = ForwardFn(Batch) / self.GradAccumSteps
+                self.backward(loss)
+
+            loss = loss.detach()
+            LossAccum = loss if LossAccum is None else LossAccum + loss
+
+        return LossAccum
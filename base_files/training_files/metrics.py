@@ -0,0 +1,213 @@
+import time
+import queue
+import threading
+from contextlib import contextmanager
+import torch
+import torch.distributed as dist
+
+
+# TensorBoard tags of the values given to end_step
+METRIC_TAGS = {
+        'loss': 'Training Loss',
+        'norm': 'Gradient Norm',
+        'lr': 'Learning Rate',
+        'comm_mb': 'Communication MB Per Step',
+        'comm_ms': 'Communication Time Per Step'
+        }
+
+
+def _event(device_type: str):
+    # Timing event of the device, None where host timers are exact (cpu)
+    if device_type == 'cuda':
+        return torch.cuda.Event(enable_timing=True)
+    if device_type == 'mps' and hasattr(torch.mps, 'event'):
+        return torch.mps.event.Event(enable_timing=True)
+    return None
+
+
+class metricslogger:
+    '''
+    Training metrics without host device synchronization on the critical
+    path. Values logged every step stay on the device (detached tensors) and
+    step and stage times are measured with device events. Every FlushInterval
+    steps the device values of the window are stacked into one tensor and
+    copied to the host asynchronously, a background thread waits for the
+    copy, then writes the TensorBoard scalars and prints the progress lines.
+
+    Aggregate:
+        False: only rank 0 records, other ranks do nothing
+        True: every rank records and device values are all-reduced at every
+              flush ('mean' by default, 'sum' for names in SumMetrics), every
+              rank has to call end_step and close the same number of times
+    Only rank 0 writes. Host values (learning rate, communication stats) are
+    the ones of rank 0.
+    '''
+    def __init__(self,
+                 writer,
+                 device_type: str,
+                 FlushInterval: int = 50,
+                 rank: int = 0,
+                 world_size: int = 1,
+                 Aggregate: bool = False,
+                 SumMetrics: tuple = (),
+                 Verbose: bool = True):
+
+        self.writer = writer
+        self.device_type = device_type
+        self.FlushInterval = max(1, FlushInterval)
+        self.rank = rank
+        self.world_size = world_size
+        self.Aggregate = Aggregate and world_size > 1
+        self.SumMetrics = set(SumMetrics)
+        self.Verbose = Verbose
+        self.active = rank == 0 or self.Aggregate
+
+        self.window = []
+        self.stages = {}
+        self.stepStart = None
+        self.TimeTaken = 0. # Total step time in ms, updated by the writer thread
+
+        self.queue = queue.Queue()
+        self.thread = None
+        if rank == 0:
+            self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+            self.thread.start()
+
+    def _mark(self):
+        # Device event recorded now (or host time on cpu)
+        Event = _event(self.device_type)
+        if Event is None:
+            return time.perf_counter()
+        Event.record()
+        return Event
+
+    @staticmethod
+    def _elapsed(Start, End) -> float:
+        # Milliseconds between two marks, events must have completed
+        if isinstance(Start, float):
+            return (End - Start) * 1000
+        return Start.elapsed_time(End)
+
+    def start_step(self):
+        if self.active:
+            self.stepStart = self._mark()
+            self.stages = {}
+
+    @contextmanager
+    def stage(self, Name: str):
+        # Times a part of the step, stages may be entered several times
+        if not self.active:
+            yield
+            return
+        Start = self._mark()
+        yield
+        self.stages.setdefault(Name, []).append((Start, self._mark()))
+
+    def end_step(self,
+                 Step: int,
+                 Tokens: int = 0,
+                 Epoch: int = None,
+                 LocalStep: int = None,
+                 **Values):
+        '''
+        Values are device tensors (kept on the device until the flush) or
+        numbers. Tokens is the count of the whole step (all ranks), Tokens
+        Per Second is the throughput of the job, not of one rank. Flushes
+        once FlushInterval steps were recorded.
+        '''
+        if not self.active:
+            return
+        self.window.append({
+                'step': Step,
+                'tokens': Tokens,
+                'epoch': Epoch,
+                'local_step': LocalStep,
+                'time': (self.stepStart, self._mark()),
+                'stages': self.stages,
+                'tensors': {Name: Value.detach().float().reshape(())
+                            for Name, Value in Values.items() if isinstance(Value, torch.Tensor)},
+                'numbers': {Name: Value
+                            for Name, Value in Values.items() if not isinstance(Value, torch.Tensor)}
+                })
+        if len(self.window) >= self.FlushInterval:
+            self.flush()
+
+    def flush(self):
+        if not self.active or not self.window:
+            return
+        Window, self.window = self.window, []
+
+        # One tensor with every device value of the window, one copy
+        Names = sorted({Name for Record in Window for Name in Record['tensors']})
+        Values = None
+        if Names:
+            Reference = next(Value for Record in Window for Value in Record['tensors'].values())
+            Missing = Reference.new_full((), float('nan'))
+            Values = torch.stack([Record['tensors'].get(Name, Missing)
+                                  for Record in Window for Name in Names])
+            if self.Aggregate:
+                # Same flush on every rank, so collectives stay in order. For
+                # nccl wait only orders the device stream, the host goes on
+                dist.all_reduce(Values, op=dist.ReduceOp.SUM, async_op=True).wait()
+        if self.rank != 0:
+            return
+
+        if Values is not None and self.device_type == 'cuda':
+            Host = torch.empty(Values.shape, dtype=Values.dtype, pin_memory=True)
+            Values = Host.copy_(Values, non_blocking=True)
+        elif Values is not None and Values.device.type != 'cpu':
+            Values = Values.to('cpu', non_blocking=True)
+        self.queue.put((Window, Names, Values, self._mark()))
+
+    def _writer_loop(self):
+        while True:
+            Item = self.queue.get()
+            if Item is None:
+                break
+            self._write(*Item)
+
+    def _write(self, Window, Names, Values, Event):
+        # Waits for the copy (and every event recorded before it)
+        if not isinstance(Event, float):
+            Event.synchronize()
+        if Values is not None:
+            Values = Values.view(len(Window), len(Names)).tolist()
+
+        for Index, Record in enumerate(Window):
+            Step = Record['step']
+            Metrics = dict(Record['numbers'])
+            if Values is not None:
+                for Name, Value in zip(Names, Values[Index]):
+                    if Name in Record['tensors']:
+                        if self.Aggregate and Name not in self.SumMetrics:
+                            Value /= self.world_size
+                        Metrics[Name] = Value
+
+            StepTime = self._elapsed(*Record['time'])
+            self.TimeTaken += StepTime
+            TokensPerSec = Record['tokens'] / (StepTime / 1000) if StepTime > 0 else 0.
+
+            for Name, Value in Metrics.items():
+                self.writer.add_scalar(METRIC_TAGS.get(Name, Name), Value, global_step=Step)
+            self.writer.add_scalar('Training Time Per Step', StepTime, global_step=Step)
+            self.writer.add_scalar('Training Time', self.TimeTaken, global_step=Step)
+            self.writer.add_scalar('Tokens Per Second', TokensPerSec, global_step=Step)
+            for Name, Marks in Record['stages'].items():
+                StageTime = sum(self._elapsed(Start, End) for Start, End in Marks)
+                self.writer.add_scalar(f'Stage Time/{Name}', StageTime, global_step=Step)
+
+            if self.Verbose:
+                Line = f"Epoch: {Record['epoch']} | Steps: {Record['local_step']}"
+                if 'loss' in Metrics:
+                    Line += f" | loss: {Metrics['loss']: .2f}"
+                if 'lr' in Metrics:
+                    Line += f" | lr: {Metrics['lr']: .5e}"
+                print(f"{Line} | Process time: {StepTime:.2f}ms | tok/sec: {TokensPerSec:.2f}")
+
+    def close(self):
+        # Writes the remaining steps and stops the writer thread
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,144 @@
+import torch
+import pandas as pd
+from torch import nn
+from torch.nn import functional as F
+from transformers import PreTrainedTokenizerFast
+
+
+def count_tokens(tokenizer: PreTrainedTokenizerFast,
+                 dataset: pd.DataFrame,
+                 VocabSize: int,
+                 ChunkSize: int = 65536) -> torch.Tensor:
+    # Number of times every token id appears in the training captions
+    Counts = torch.zeros(VocabSize, dtype=torch.long)
+    Captions = dataset['caption'].tolist()
+    for Start in range(0, len(Captions), ChunkSize):
+        Texts = ["<|start_of_text|>" + Caption + "<|end_of_text|>"
+                 for Caption in Captions[Start:Start + ChunkSize]]
+        Ids = torch.tensor([Id for Row in tokenizer(Texts)['input_ids'] for Id in Row],
+                           dtype=torch.long)
+        Counts += torch.bincount(Ids, minlength=VocabSize)[:VocabSize]
+    return Counts
+
+
+def frequency_order(Counts: torch.Tensor) -> torch.Tensor:
+    # Token ids from the most to the least frequent one (ties by token id)
+    return torch.sort(Counts, descending=True, stable=True).indices
+
+
+class adaptivehead(nn.Module):
+    '''
+    Frequency clustered output head (adaptive softmax). Token ids are sorted
+    by their frequency in the training captions (order), the Cutoffs[0] most
+    frequent tokens and one entry per tail cluster are scored at full width,
+    tokens of tail cluster i are scored after a projection to
+    nEmbd / DivValue ** (i + 1):
+        shortlist token: log p = log p_head(token)
+        tail token:      log p = log p_head(cluster) + log p_cluster(token)
+    The output is the exact log probability of every token id, it is used as
+    logits (softmax of log probabilities gives the same probabilities back),
+    so samplers and distillation do not change. Training uses loss, which
+    only needs the log probability of the labels.
+    '''
+    def __init__(self,
+                 nEmbd: int,
+                 VocabSize: int,
+                 Cutoffs: list,
+                 DivValue: float = 4.0):
+        super(adaptivehead, self).__init__()
+        self.asm = nn.AdaptiveLogSoftmaxWithLoss(nEmbd,
+                                                 VocabSize,
+                                                 list(Cutoffs),
+                                                 div_value=DivValue)
+        # order[i] is the token id of the i-th most frequent token, rank is
+        # the inverse (frequency position of every token id)
+        self.register_buffer('order', torch.arange(VocabSize))
+        self.register_buffer('rank', torch.arange(VocabSize))
+
+    def set_order(self, Order: torch.Tensor):
+        Order = Order.to(self.order.device)
+        assert torch.equal(torch.sort(Order).values, torch.arange(len(self.order), device=Order.device)), "Order has to be a permutation of the token ids"
+        self.order.copy_(Order)
+        self.rank[Order] = torch.arange(len(Order), device=Order.device)
+
+    def coverage(self, Counts: torch.Tensor) -> list:
+        # Part of the training tokens that falls in every cluster
+        Counts = Counts[self.order.cpu()].double()
+        Bounds = [0] + self.asm.cutoffs
+        return [(Counts[Start:End].sum() / Counts.sum()).item()
+                for Start, End in zip(Bounds[:-1], Bounds[1:])]
+
+    def flops_per_token(self) -> int:
+        # Multiply accumulates of the head per token (every cluster scored)
+        return sum(m.in_features * m.out_features
+                   for m in self.asm.modules() if isinstance(m, nn.Linear))
+
+    def full_head_state(self, Weight: torch.Tensor) -> dict:
+        '''
+        Adaptive head weights from the weight of a full (vocabSize, nEmbd)
+        output head, used to start from a checkpoint trained without it.
+        Shortlist rows are copied, a cluster is scored with the mean of its
+        rows and the weights of its tokens are approximated with a truncated
+        SVD (rank of the cluster projection). Needs fine tuning afterwards.
+        '''
+        Weight = Weight.float()[self.order.cpu()]
+        Shortlist = self.asm.shortlist_size
+        Clusters = []
+        State = {}
+        for i, Tail in enumerate(self.asm.tail):
+            Rows = Weight[self.asm.cutoffs[i]:self.asm.cutoffs[i + 1]]
+            Clusters.append(Rows.mean(0))
+            U, S, Vh = torch.linalg.svd(Rows, full_matrices=False)
+            # Small clusters have fewer singular values than the projection
+            Rank = min(Tail[0].out_features, len(S))
+            Projection = Rows.new_zeros(Tail[0].weight.shape)
+            Projection[:Rank] = Vh[:Rank]
+            Output = Rows.new_zeros(Tail[1].weight.shape)
+            Output[:, :Rank] = U[:, :Rank] * S[:Rank]
+            State[f'asm.tail.{i}.0.weight'] = Projection
+            State[f'asm.tail.{i}.1.weight'] = Output
+        State['asm.head.weight'] = torch.cat([Weight[:Shortlist], torch.stack(Clusters)])
+        return State
+
+    def loss(self, Input: torch.Tensor, Label: torch.Tensor) -> torch.Tensor:
+        '''
+        Mean negative log likelihood of Label (-1 is ignored), the same value
+        as cross entropy of the full log probabilities. Only the log
+        probability of the label is put together, the (..., vocabSize) output
+        is never written.
+        '''
+        Input = Input.reshape(-1, Input.size(-1))
+        Label = Label.reshape(-1)
+        Keep = Label != -1
+        Target = self.rank[Label.clamp(min=0)]
+        Shortlist = self.asm.shortlist_size
+        Cutoffs = self.asm.cutoffs
+
+        # 0 for shortlist tokens, i + 1 for tokens of tail cluster i
+        Cluster = sum((Target >= Cutoff).long() for Cutoff in Cutoffs[:-1])
+        HeadTarget = torch.where(Cluster == 0, Target, Shortlist + Cluster - 1)
+        Head = self.asm.head(Input).float()
+        LogProb = Head.gather(1, HeadTarget.unsqueeze(1)).squeeze(1) - torch.logsumexp(Head, dim=-1)
+        for i, Tail in enumerate(self.asm.tail):
+            Output = Tail(Input).float()
+            Index = (Target - Cutoffs[i]).clamp(0, Cutoffs[i + 1] - Cutoffs[i] - 1)
+            TailLogProb = Output.gather(1, Index.unsqueeze(1)).squeeze(1) - torch.logsumexp(Output, dim=-1)
+            LogProb = LogProb + torch.where(Cluster == i + 1, TailLogProb, torch.zeros_like(TailLogProb))
+        # clamp: a batch with every label ignored gives 0 instead of NaN
+        return -(LogProb * Keep).sum() / Keep.sum().clamp(min=1)
+
+    def forward(self, Input: torch.Tensor) -> torch.Tensor:
+        '''
+        Log probabilities of shape (..., vocabSize) in token id order. Every
+        cluster is computed for every position (static shapes, no host
+        synchronization), the tail clusters are low rank, so this is still a
+        fraction of the full head.
+        '''
+        Shortlist = self.asm.shortlist_size
+        Head = F.log_softmax(self.asm.head(Input).float(), dim=-1)
+        LogProb = [Head[..., :Shortlist]]
+        for i, Tail in enumerate(self.asm.tail):
+            Cluster = Head[..., Shortlist + i:Shortlist + i + 1]
+            LogProb.append(F.log_softmax(Tail(Input).float(), dim=-1) + Cluster)
+        # Frequency order back to token id order
+        return torch.cat(LogProb, dim=-1).index_select(-1, self.rank)
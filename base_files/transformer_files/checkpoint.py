@@ -0,0 +1,90 @@
+import os
+import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from base_files.transformer_files.adaptive_head import adaptivehead
+
+
+def load_state(model, StateDict: dict, Backbone=None):
+    '''
+    Loads a checkpoint into the decoder. Prefixes added by DDP and
+    torch.compile are removed. Older checkpoints stored the Cnn model inside
+    the transformer ('cnnModel.' keys), those weights are loaded into the
+    backbone stage if it is given and dropped otherwise.
+    '''
+    for key in list(StateDict.keys()):
+        NewKey = key
+        for Prefix in ('module.', '_orig_mod.'):
+            if NewKey.startswith(Prefix):
+                NewKey = NewKey[len(Prefix):]
+        StateDict[NewKey] = StateDict.pop(key)
+
+    CnnState = {}
+    for key in list(StateDict.keys()):
+        if key.startswith('cnnModel.'):
+            CnnState[key[len('cnnModel.'):]] = StateDict.pop(key)
+    if CnnState and Backbone is not None:
+        Backbone.load_state_dict(CnnState)
+
+    '''
+    Checkpoints trained with a full output head can start a model with the
+    adaptive head (weights converted, the frequency order of the model is
+    kept), the other way round the adaptive head has to be set in the config.
+    '''
+    Head = getattr(model, 'head', None)
+    if isinstance(Head, adaptivehead) and 'head.weight' in StateDict:
+        print("Checkpoint has a full output head, converting it to the adaptive head")
+        Weight = StateDict.pop('head.weight')
+        StateDict.update({f'head.{key}': Value for key, Value in Head.full_head_state(Weight).items()})
+        StateDict['head.order'] = Head.order
+        StateDict['head.rank'] = Head.rank
+    elif not isinstance(Head, adaptivehead) and 'head.asm.head.weight' in StateDict:
+        raise ValueError("Checkpoint was trained with the adaptive softmax head, set 'adaptive_cutoffs' in the transformer config")
+
+    model.load_state_dict(StateDict)
+    return model
+
+
+def is_resumable(ModelName: str) -> bool:
+    '''
+    True for a periodic checkpoint of an unfinished run: it has the position
+    inside its epoch and has not reached its end epoch. Final checkpoints
+    (and missing files) are never resumed automatically.
+    '''
+    if not os.path.exists(ModelName):
+        return False
+    Checkpoint = torch.load(ModelName, map_location='cpu', mmap=True)
+    return ('epoch_position' in Checkpoint and
+            Checkpoint['epoch'] < Checkpoint.get('end_epoch', Checkpoint['epoch']))
+
+
+def save_checkpoint(ModelName: str,
+                    model,
+                    optimizer,
+                    Epoch: int,
+                    GlobalStep: int,
+                    Scaler=None,
+                    rank: int = 0,
+                    **Extra):
+    '''
+    Saves the training state, only rank 0 writes the file. Sharded (ZeRO)
+    optimizer state is first gathered on rank 0, so the saved optimizer state
+    is a normal AdamW state dict and can be resumed with any world size. Must
+    be called by every rank when the optimizer is sharded.
+    '''
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        optimizer.consolidate_state_dict(to=0)
+    if rank != 0:
+        return
+
+    Checkpoint = {
+            'epoch': Epoch,
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'global_step': GlobalStep
+            }
+    if Scaler is not None:
+        Checkpoint['scaler'] = Scaler.state_dict()
+    Checkpoint.update(Extra)
+    # Written to a temporary file first, a crash while saving keeps the old one
+    torch.save(Checkpoint, f'{ModelName}.tmp')
+    os.replace(f'{ModelName}.tmp', ModelName)
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional, Union
 
 
 # Creating a data class for the transformer config
@@ -10,3 +11,10 @@ class transformerconfig:
     nLayers: int = 6
     nHead: int = 6
     nEmbd: int = 384
+    # Width of the Cnn model features (see BACKBONES)
+    imgDim: int = 1000
+    # Activation checkpointing: False, True (every block) or list of blocks
+    gradCheckpoint: Union[bool, list] = False
+    # Adaptive softmax output head: cluster cutoffs (None for a full head)
+    adaptiveCutoffs: Optional[list] = None
+    adaptiveDivValue: float = 4.0
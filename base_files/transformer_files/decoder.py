@@ -14,7 +14,7 @@ class block(nn.Module):
         self.fFN = ffn(config) # feed forward network
 
 
-    def forward(self, x, CnnImg):
+    def forward(self, x, CnnImg, Cache=None, StartPos:int=0, Mask=None):
         '''
         Step-1: Input -> LayerNorm -> Casual Attention = Modified input
         Step-2: Input + Modified input = Input
@@ -23,6 +23,6 @@ class block(nn.Module):
         Step-4: Input + Modified input = Decoder output
         '''
         # x = x + self.attn(self.layerNorm1(x))
-        x = x + self.attn(self.layerNorm1(x), CnnImg)
+        x = x + self.attn(self.layerNorm1(x), CnnImg, Cache, StartPos, Mask)
         x = x + self.fFN(self.layerNorm2(x))
         return x
@@ -0,0 +1,53 @@
+import torch
+
+
+class layercache:
+    # Key and value buffers of a single decoder block
+    def __init__(self, k, v):
+        self.k = k
+        self.v = v
+
+    def update(self, k, v, StartPos:int):
+        '''
+        Writes keys and values of the new positions and returns keys and
+        values of every position seen so far.
+        '''
+        EndPos = StartPos + k.size(2)
+        self.k[:k.size(0), :, StartPos:EndPos] = k
+        self.v[:v.size(0), :, StartPos:EndPos] = v
+        return self.k[:k.size(0), :, :EndPos], self.v[:v.size(0), :, :EndPos]
+
+
+class kvcache:
+    '''
+    Preallocated key/value cache for incremental decoding. Layout follows the
+    one used inside the attention of each decoder:
+        gpt-2 (cmha): (BatchSize, nEmbd // nHead, SeqLen, nHead)
+        llama: (BatchSize, nKVHeads, SeqLen, dim // nHeads), only key/value
+               heads are stored (grouped query attention)
+    '''
+    def __init__(self,
+                 config,
+                 BatchSize:int,
+                 device,
+                 dtype=torch.float):
+
+        if hasattr(config, 'nKVHeads'):
+            Shape = (config.nLayers,
+                     BatchSize,
+                     config.nKVHeads,
+                     config.MaxSeqLen,
+                     config.headDim)
+        else:
+            Shape = (config.nLayers,
+                     BatchSize,
+                     config.nEmbd // config.nHead,
+                     config.blockSize,
+                     config.nHead)
+        self.k = torch.zeros(Shape, device=device, dtype=dtype)
+        self.v = torch.zeros(Shape, device=device, dtype=dtype)
+        self.layers = [layercache(self.k[i], self.v[i])
+                       for i in range(config.nLayers)]
+
+    def __getitem__(self, Layer:int) -> layercache:
+        return self.layers[Layer]
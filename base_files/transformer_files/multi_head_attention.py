@@ -28,14 +28,16 @@ class cmha(nn.Module):
             ).view(1, 1, config.blockSize, config.blockSize))
 
 
-    def forward(self, x, CnnImg):
+    def forward(self, x, CnnImg, Cache=None, StartPos:int=0, Mask=None):
         BatchSize, SeqLen, DModel = x.size()
         # Creating query, key and value matrix
         qk = self.qkLayer(CnnImg)
         #qkv = self.qkvLayer(x)
         v = self.vLayer(x)
-        # Splitting the projected matrix
-        qk = qk.repeat(1, SeqLen, 1)
+        # Splitting the projected matrix (packed rows already have one image
+        # per token)
+        if qk.size(1) == 1:
+            qk = qk.repeat(1, SeqLen, 1)
         q, k = qk.split(self.nEmbd, dim=2)
 
         # Changing the dimensions of the matrix for multi head attention
@@ -70,7 +72,28 @@ class cmha(nn.Module):
         Att = F.softmax(Att, dim=-1)
         # Matrix Multiplication with Value vector
         y = Att @ v'''
-        x = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        if Mask is not None:
+            # Packed rows, block diagonal causal mask of shape (B, 1, T, T)
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=Mask)
+        elif Cache is None:
+            x = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        else:
+            '''
+            During incremental decoding only the new positions are passed,
+            keys and values of previous positions are read from the cache.
+            A single new position attends to everything, otherwise the causal
+            mask has to be shifted by StartPos.
+            '''
+            k, v = Cache.update(k, v, StartPos)
+            if SeqLen == 1:
+                x = F.scaled_dot_product_attention(q, k, v)
+            elif StartPos == 0:
+                x = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+            else:
+                Mask = torch.ones(SeqLen, k.size(2),
+                                  dtype=torch.bool,
+                                  device=x.device).tril(diagonal=StartPos)
+                x = F.scaled_dot_product_attention(q, k, v, attn_mask=Mask)
 
         # Re - assemble the matrix to its original shape
         x = x.transpose(1, 2).contiguous().view(BatchSize, SeqLen, DModel)
@@ -2,12 +2,15 @@ import inspect
 import torch
 from torch import nn
 from base_files.transformer_files.decoder import block
+from base_files.transformer_files.adaptive_head import adaptivehead
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+from torch.distributed.optim import ZeroRedundancyOptimizer
 
 
 class transformer(nn.Module):
 
-    def __init__(self, config, CnnModel):
+    def __init__(self, config):
         super(transformer, self).__init__()
         self.config = config # Transformer config
         '''
@@ -26,16 +29,27 @@ class transformer(nn.Module):
             # Layer normalization is applied at the end of each Decoder output
             layerNorm = nn.LayerNorm(config.nEmbd),
             ))
-        self.head = nn.Linear(config.nEmbd,
-                              config.vocabSize,
-                              bias=False)
+        '''
+        The adaptive head outputs log probabilities (used as logits) and is
+        not tied to the token embeddings, see adaptivehead.
+        '''
+        if config.adaptiveCutoffs:
+            self.head = adaptivehead(config.nEmbd,
+                                     config.vocabSize,
+                                     config.adaptiveCutoffs,
+                                     config.adaptiveDivValue)
+        else:
+            self.head = nn.Linear(config.nEmbd,
+                                  config.vocabSize,
+                                  bias=False)
 
-        # Cnn Model
-        self.cnnModel = CnnModel
-        self.cnnLayer = nn.Linear(1000, config.nEmbd)
+        # Projection of the Cnn model features (the Cnn model itself runs
+        # as a separate frozen stage, see frozenbackbone)
+        self.cnnLayer = nn.Linear(config.imgDim, config.nEmbd)
 
         # Pointing final Linear projection weights to token embedding weights
-        self.transformer.tokEmbd.weight = self.head.weight
+        if not config.adaptiveCutoffs:
+            self.transformer.tokEmbd.weight = self.head.weight
 
         # Initializing weights
         self.apply(self._init_weights)
@@ -57,7 +71,8 @@ class transformer(nn.Module):
     def configure_optimizers(self,
                              WeightDecay:float,
                              LearningRate:float,
-                             device):
+                             device,
+                             ZeroSharding:bool=False):
         # Find all the parameters that requires gradients
         Params = {NumParams: p for NumParams, p in self.named_parameters()}
         Params = {NumParams: p for NumParams, p in Params.items() if p.requires_grad}
@@ -80,13 +95,32 @@ class transformer(nn.Module):
         print(f"Number of decaying parameter tensors: {len(DecayParams)}, with {NumDecayParams} parameters")
         print(f"Number of non decaying parameter tensors: {len(NonDecayParams)}, with {NumNonDecayParams} parameters")
 
-        # Check fused is available or not
-        if 'cuda' in device:
-            FusedAvailable = 'fused' in inspect.signature(torch.optim.AdamW).parameters
-            UseFused = FusedAvailable 
-        else:
-            UseFused = False
+        # Check fused is available or not (fused kernels exist per device)
+        FusedAvailable = 'fused' in inspect.signature(torch.optim.AdamW).parameters
+        UseFused = False
+        if FusedAvailable:
+            try:
+                Probe = torch.zeros(1, device=device, requires_grad=True)
+                torch.optim.AdamW([Probe], fused=True)
+                UseFused = True
+            except (RuntimeError, ValueError):
+                UseFused = False
         print(f'Using fused AdamW: {UseFused}')
+
+        '''
+        With ZeRO sharding (stage 1) every rank keeps AdamW state only for its
+        part of the parameters, after the step updated parameters are
+        broadcast to the other ranks. Requires an initialized process group.
+        '''
+        if ZeroSharding:
+            Optimizer = ZeroRedundancyOptimizer(OptimGroups,
+                                                optimizer_class=torch.optim.AdamW,
+                                                lr=LearningRate,
+                                                betas=(0.9, 0.95),
+                                                eps=1e-8,
+                                                fused=UseFused)
+            return Optimizer
+
         # Configuring optimizer
         Optimizer = torch.optim.AdamW(OptimGroups,
                                       lr=LearningRate,
@@ -95,19 +129,56 @@ class transformer(nn.Module):
                                       fused=UseFused)
         return Optimizer
 
-    def forward(self, Input, Img, Label=None):
+    def is_checkpointed(self, Layer:int) -> bool:
+        # Checks if activations of a decoder block are recomputed
+        if isinstance(self.config.gradCheckpoint, bool):
+            return self.config.gradCheckpoint
+        return Layer in self.config.gradCheckpoint
+
+    def encode_image(self, Img):
+        '''
+        Projecting Cnn Model features, output is (BatchSize, 1, nEmbd), or
+        (BatchSize, NumSegments, nEmbd) for packed rows.
+        '''
+        Img = self.cnnLayer(Img)
+        return torch.reshape(Img,
+                             (Img.size(0), -1, self.config.nEmbd))
+
+    def decode(self,
+               Input,
+               Img,
+               Label=None,
+               StartPos:int=0,
+               Cache=None,
+               Position=None,
+               Segment=None):
+        '''
+        Runs the decoder on an already encoded image (output of encode_image),
+        this lets the image encoding be computed once and reused. For
+        incremental decoding a kvcache is passed with the position of the
+        first token in Input.
+
+        Packed rows (several captions in one row) pass Position (restarts at
+        0 for every caption) and Segment (caption index of every token, -1 on
+        padding). Tokens attend only to earlier tokens of their own caption
+        and are conditioned on the image of their caption.
+        '''
         # Input is of shape (BatchSize, SeqLen)
         BatchSize, SeqLen = Input.size()
-        assert SeqLen <= self.config.blockSize, f"Cannot pass the sequence to the model, Error: length {SeqLen} is greater than the block size parameter for the model"
+        assert StartPos + SeqLen <= self.config.blockSize, f"Cannot pass the sequence to the model, Error: length {StartPos + SeqLen} is greater than the block size parameter for the model"
 
         # Applying embeddings and tokenization
-        # Passing image through Cnn Model
-        Img = self.cnnModel(Img)
-        Img = self.cnnLayer(Img)
-        Img = torch.reshape(Img,
-                            (BatchSize, 1, self.config.nEmbd)) 
-
-        Pos = torch.arange(0, SeqLen, dtype=torch.int, device=Input.device)
+        Mask = None
+        if Segment is not None:
+            Pos = Position
+            # Image of the caption every token belongs to
+            Index = Segment.clamp(min=0).unsqueeze(-1).expand(-1, -1, Img.size(-1))
+            Img = torch.gather(Img, 1, Index)
+            # Block diagonal causal mask of shape (BatchSize, 1, SeqLen, SeqLen)
+            Mask = (Segment.unsqueeze(2) == Segment.unsqueeze(1)).tril()
+            Mask = Mask.unsqueeze(1)
+        else:
+            Pos = torch.arange(StartPos, StartPos + SeqLen, dtype=torch.int, device=Input.device)
         PosEmbd = self.transformer.posEmbd(Pos)
         Input = self.transformer.tokEmbd(Input)
 
@@ -115,8 +186,24 @@ class transformer(nn.Module):
         Input = PosEmbd + Input #+ Img
 
         # applying decoder block
-        for block in self.transformer.hid:
-            Input = block(Input, Img)
+        for i, block in enumerate(self.transformer.hid):
+            '''
+            With activation checkpointing, outputs of a block (attention and
+            the 4x wide ffn intermediate) are not stored during training,
+            they are recomputed during the backward pass.
+            '''
+            if self.training and Cache is None and self.is_checkpointed(i):
+                Input = checkpoint(block,
+                                   Input,
+                                   Img,
+                                   Mask=Mask,
+                                   use_reentrant=False)
+            else:
+                Input = block(Input,
+                              Img,
+                              None if Cache is None else Cache[i],
+                              StartPos,
+                              Mask)
 
         # forward the final layernorm
         Input = self.transformer.layerNorm(Input)
@@ -125,6 +212,10 @@ class transformer(nn.Module):
         # Adding Image and input
         Input = Input + Img
 
+        # The adaptive head computes the loss without the full log probabilities
+        if Label is not None and isinstance(self.head, adaptivehead):
+            return None, self.head.loss(Input, Label)
+
         # Classifying
         logits = self.head(Input)
         if Label is not None:
@@ -133,3 +224,24 @@ class transformer(nn.Module):
             return logits, loss
 
         return logits
+
+    def forward(self,
+                Input,
+                Img,
+                Label=None,
+                Position=None,
+                Segment=None,
+                ImgIndex=None):
+        '''
+        Img is the output of the frozen Cnn model (frozenbackbone). With image
+        grouped batches Img has one row per image and ImgIndex gives the image
+        of every caption, so every image is encoded once for all captions.
+        '''
+        Img = self.encode_image(Img)
+        if ImgIndex is not None:
+            Img = Img[ImgIndex]
+        return self.decode(Input,
+                           Img,
+                           Label,
+                           Position=Position,
+                           Segment=Segment)
@@ -0,0 +1,96 @@
+import torch
+import warnings
+from argparse import ArgumentParser
+from base_files.inference_files.model_loader import load_caption_model, load_inference_config
+from base_files.inference_files.bulk_pipeline import bulkpipeline, list_images
+from base_files.runtime_files.precision import precisionpolicy
+
+
+def caption_bulk(JsonPath: str,
+                 ImgPath: str,
+                 OutPath: str,
+                 ModelPath: str = None,
+                 BatchSize: int = 32,
+                 NumWorkers: int = 4,
+                 Prefetch: int = None,
+                 TokenSize: int = None,
+                 Temprature: float = 1.0,
+                 Topk: int = 100,
+                 Topp: float = None,
+                 Minp: float = None) -> dict:
+    '''
+    Offline captioning of an image directory with overlapping read, decode,
+    model and write stages (see bulkpipeline). OutPath is a json lines file
+    and the manifest of the job, running the job again skips images that
+    were already captioned.
+    '''
+    device = 'cpu'
+
+    # Use GPU if it is available
+    if torch.cuda.is_available():
+        device = 'cuda'
+
+    # Use MPS if it is available(Apple devices only)
+    elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
+        device = 'mps'
+
+    # Filtering the warnings
+    warnings.filterwarnings('ignore')
+
+    data, ModelPath, tokenizer = load_inference_config(JsonPath, ModelPath)
+    model, Backbone, config = load_caption_model(data, ModelPath, device)
+    Precision = precisionpolicy(data['model_config']['dtype'], device).apply()
+
+    Pipeline = bulkpipeline(model,
+                            Backbone,
+                            tokenizer,
+                            device,
+                            Precision,
+                            BatchSize=BatchSize,
+                            NumWorkers=NumWorkers,
+                            Prefetch=Prefetch,
+                            TokenSize=TokenSize,
+                            Temprature=Temprature,
+                            Topk=Topk,
+                            Topp=Topp,
+                            Minp=Minp)
+    Report = Pipeline.run(list_images(ImgPath), OutPath)
+
+    print(f"Captioned: {Report['captioned']} | skipped: {Report['skipped']} | errors: {Report['errors']} | images/sec: {Report['images_per_sec']:.2f}")
+    print(" | ".join(f"{Stage}: {Report[f'{Stage}_utilization']:.0%}" for Stage in ('read', 'decode', 'model', 'write')))
+    print(f"Model stage waited for images {Report['model_starved']:.0%} and for the writer {Report['model_blocked']:.0%} of the time")
+    return Report
+
+
+# Argument parser
+def command_line_argument():
+    parser = ArgumentParser()
+    parser.add_argument('--jpath', dest='JsonPath', help='Inserts json path inside program')
+    parser.add_argument('--ipath', dest='ImgPath', help='Image or directory of images')
+    parser.add_argument('--out', dest='OutPath', default='captions.jsonl', help='Output json lines file, also used to resume the job')
+    parser.add_argument('--mpath', dest='ModelPath', help='Inserts model path (checkpoint or model bundle) inside program')
+    parser.add_argument('--batch', dest='BatchSize', type=int, default=32, help='Images per batch of the model stage')
+    parser.add_argument('--workers', dest='NumWorkers', type=int, default=4, help='Threads reading and decoding images')
+    parser.add_argument('--prefetch', dest='Prefetch', type=int, help='Images decoded ahead of the model (default: 2 batches)')
+    parser.add_argument('--size', dest='TokenSize', type=int, help='Manual token size for the model')
+    parser.add_argument('--temp', dest='Temprature', type=float, default=1.0, help='Adjust the temprature of the model')
+    parser.add_argument('--topk', dest='TopK', type=int, default=100, help='Random tokens will picked from top K tokens')
+    parser.add_argument('--topp', dest='TopP', type=float, help='Random tokens will picked from the smallest set with this probability')
+    parser.add_argument('--minp', dest='MinP', type=float, help='Tokens less likely than this fraction of the top token are dropped')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    Args = command_line_argument()
+    caption_bulk(Args.JsonPath,
+                 Args.ImgPath,
+                 Args.OutPath,
+                 Args.ModelPath,
+                 Args.BatchSize,
+                 Args.NumWorkers,
+                 Args.Prefetch,
+                 Args.TokenSize,
+                 Args.Temprature,
+                 Args.TopK,
+                 Args.TopP,
+                 Args.MinP)
@@ -0,0 +1,94 @@
+import time
+import json
+import warnings
+from argparse import ArgumentParser
+from base_files.inference_files.worker_pool import workerpool
+from base_files.inference_files.model_loader import load_inference_config
+from base_files.inference_files.bulk_pipeline import list_images
+
+
+def caption_pool(JsonPath: str,
+                 ImgPath: str,
+                 ModelPath: str = None,
+                 NumWorkers: int = None,
+                 ThreadsPerWorker: int = None,
+                 BatchSize: int = 8,
+                 TokenSize: int = None,
+                 Temprature: float = 1.0,
+                 Topk: int = 100,
+                 Topp: float = None,
+                 Minp: float = None,
+                 OutPath: str = None) -> list:
+    '''
+    Captions every image of a directory with a pool of CPU workers sharing
+    one copy of the weights (see workerpool).
+    '''
+    # Filtering the warnings
+    warnings.filterwarnings('ignore')
+
+    data, ModelPath, tokenizer = load_inference_config(JsonPath, ModelPath)
+
+    ImgPaths = list_images(ImgPath)
+    with workerpool(data,
+                    ModelPath,
+                    tokenizer,
+                    NumWorkers=NumWorkers,
+                    ThreadsPerWorker=ThreadsPerWorker,
+                    BatchSize=BatchSize,
+                    TokenSize=TokenSize,
+                    Temprature=Temprature,
+                    Topk=Topk,
+                    Topp=Topp,
+                    Minp=Minp) as Pool:
+        print(f"Workers: {Pool.NumWorkers} x {Pool.ThreadsPerWorker} threads")
+        t0 = time.time()
+        Result = Pool.caption(ImgPaths)
+        dt = time.time() - t0
+        Memory = Pool.memory()
+
+    Errors = sum('error' in Row for Row in Result)
+    print(f"{len(ImgPaths)} images in {dt:.2f}s | images/sec: {len(ImgPaths) / dt:.2f} | errors: {Errors}")
+    if Memory:
+        print(f"Memory of parent and workers: rss {Memory['rss_mb']:.0f}MB | pss {Memory['pss_mb']:.0f}MB")
+
+    if OutPath is not None:
+        with open(OutPath, 'w') as f:
+            json.dump(Result, f, indent=2)
+    else:
+        for Row in Result:
+            print(f"{Row['image_path']}: {Row.get('caption', Row.get('error'))}")
+    return Result
+
+
+# Argument parser
+def command_line_argument():
+    parser = ArgumentParser()
+    parser.add_argument('--jpath', dest='JsonPath', help='Inserts json path inside program')
+    parser.add_argument('--ipath', dest='ImgPath', help='Image or directory of images')
+    parser.add_argument('--mpath', dest='ModelPath', help='Inserts model path (checkpoint or model bundle) inside program')
+    parser.add_argument('--workers', dest='NumWorkers', type=int, help='Number of worker processes (default: cores / threads)')
+    parser.add_argument('--threads', dest='ThreadsPerWorker', type=int, help='Intra-op threads (and pinned cores) per worker')
+    parser.add_argument('--batch', dest='BatchSize', type=int, default=8, help='Images per batch sent to a worker')
+    parser.add_argument('--size', dest='TokenSize', type=int, help='Manual token size for the model')
+    parser.add_argument('--temp', dest='Temprature', type=float, default=1.0, help='Adjust the temprature of the model')
+    parser.add_argument('--topk', dest='TopK', type=int, default=100, help='Random tokens will picked from top K tokens')
+    parser.add_argument('--topp', dest='TopP', type=float, help='Random tokens will picked from the smallest set with this probability')
+    parser.add_argument('--minp', dest='MinP', type=float, help='Tokens less likely than this fraction of the top token are dropped')
+    parser.add_argument('--out', dest='OutPath', help='Writes the captions to this json file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    Args = command_line_argument()
+    caption_pool(Args.JsonPath,
+                 Args.ImgPath,
+                 Args.ModelPath,
+                 Args.NumWorkers,
+                 Args.ThreadsPerWorker,
+                 Args.BatchSize,
+                 Args.TokenSize,
+                 Args.Temprature,
+                 Args.TopK,
+                 Args.TopP,
+                 Args.MinP,
+                 Args.OutPath)
@@ -0,0 +1,200 @@
+import time
+import json
+import torch
+import warnings
+from argparse import ArgumentParser
+from tokenizers import Tokenizer
+from tqdm.auto import tqdm
+from torch.nn import functional as F
+from torch.utils.data import DataLoader
+from torch.utils.tensorboard import SummaryWriter
+from base_files.transformer_files.dataclass import transformerconfig
+from base_files.transformer_files.transformer import transformer
+from base_files.tokenizer_files.tokenizer import texttoid, fast_tokenizer
+from base_files.dataset_files.json_extracter import caption_extracter
+from base_files.dataset_files.image_extracter import imgextracter
+from base_files.inference_files.model_loader import load_caption_model, get_draft_checkpoint
+from base_files.inference_files.caption_cache import checkpoint_id
+from base_files.runtime_files.precision import precisionpolicy
+
+
+# Setting seed for reproducability
+torch.manual_seed(1337)
+if torch.cuda.is_available():
+    torch.cuda.manual_seed(1337)
+
+
+def init_from_teacher(draft, teacher):
+    '''
+    Copies every teacher weight with the same name and shape (embeddings,
+    image projection, final layer norm and the first decoder blocks when the
+    widths match), the draft starts close to the teacher.
+    '''
+    DraftState = draft.state_dict()
+    State = {Key: Value for Key, Value in teacher.state_dict().items()
+             if Key in DraftState and Value.shape == DraftState[Key].shape}
+    draft.load_state_dict(State, strict=False)
+    return len(State)
+
+
+def distillation_loss(StudentLogits: torch.Tensor,
+                      TeacherLogits: torch.Tensor,
+                      Mask: torch.Tensor,
+                      Temprature: float) -> torch.Tensor:
+    # KL(teacher || student) on softened distributions, only on real tokens
+    Student = F.log_softmax(StudentLogits.float() / Temprature, dim=-1)
+    Teacher = F.log_softmax(TeacherLogits.float() / Temprature, dim=-1)
+    KL = F.kl_div(Student, Teacher, log_target=True, reduction='none').sum(-1)
+    return (KL * Mask).sum() / Mask.sum() * Temprature ** 2
+
+
+def distill(JsonPath: str,
+            ModelPath: str = None,
+            OutPath: str = 'draft_model.pt',
+            NumLayers: int = 1,
+            DModel: int = None,
+            NumHeads: int = None,
+            Steps: int = 2000,
+            BatchSize: int = 64,
+            LearningRate: float = 1e-3,
+            Temprature: float = 2.0,
+            Alpha: float = 0.5):
+    '''
+    Trains a small draft decoder for speculative decoding from an existing
+    checkpoint. The loss mixes the distillation loss on the teacher's
+    distributions (weight Alpha) with the normal next token loss. Width and
+    heads default to the teacher's, so its embeddings and first blocks can
+    be copied into the draft.
+    '''
+    device = 'cpu'
+
+    # Use GPU if it is available
+    if torch.cuda.is_available():
+        device = 'cuda'
+
+    # Use MPS if it is available(Apple devices only)
+    elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
+        device = 'mps'
+
+    # Filtering the warnings
+    warnings.filterwarnings('ignore')
+
+    # Importing json file
+    with open (JsonPath, 'r') as f:
+        data = json.load(f)
+
+    if ModelPath is None:
+        ModelPath = data['model_config']['existing_path']
+
+    # Teacher and frozen Cnn model stage
+    teacher, Backbone, config = load_caption_model(data, ModelPath, device)
+    # The draft is a gpt-2 decoder, speculative decoding needs the same family
+    if not isinstance(teacher, transformer):
+        raise ValueError(f"Draft models can only be distilled from a gpt-2 teacher, got {type(teacher).__module__}.{type(teacher).__name__}")
+    for p in teacher.parameters():
+        p.requires_grad = False
+
+    TrConf = data['transformer_config']
+    DraftConfig = transformerconfig(blockSize=config.blockSize,
+                                    vocabSize=config.vocabSize,
+                                    nLayers=NumLayers,
+                                    nHead=NumHeads or TrConf['number_heads'],
+                                    nEmbd=DModel or TrConf['d_model'],
+                                    imgDim=config.imgDim)
+    draft = transformer(config=DraftConfig)
+    NumCopied = init_from_teacher(draft, teacher)
+    if NumCopied == 0:
+        raise ValueError("No teacher weight matches the draft (different d_model?), the draft would start from random weights")
+    draft.to(device)
+    print(f"Draft: {NumLayers} layers, {sum(p.numel() for p in draft.parameters())} parameters, {NumCopied} tensors copied from the teacher")
+
+    # Training captions
+    TokenizerPath = data['tokenizer_config']['tokenizer_load_path']
+    tokenizer = fast_tokenizer(Tokenizer.from_file(TokenizerPath),
+                               MaxSeqLen=config.blockSize)
+    FilePath = data['file_path']
+    TrainData = caption_extracter(FilePath['json_path']['train_json'],
+                                  FilePath['image_path']['train_path'])
+    TrainData = TrainData.sample(min(Steps * BatchSize, len(TrainData)),
+                                 random_state=1337).reset_index(drop=True)
+    CaptionData = DataLoader(texttoid(tokenizer, TrainData), batch_size=BatchSize)
+    ImgData = DataLoader(imgextracter(dataframe=TrainData, CnnName=Backbone.name), batch_size=BatchSize)
+    PadToken = tokenizer.convert_tokens_to_ids('<|pad|>')
+
+    Precision = precisionpolicy(data['model_config']['dtype'], device).apply()
+    Scaler = Precision.get_scaler()
+    optimizer = draft.configure_optimizers(WeightDecay=0.1,
+                                           LearningRate=LearningRate,
+                                           device=device)
+
+    writer = SummaryWriter()
+    draft.train()
+    for Step, (caption, img) in enumerate(tqdm(zip(CaptionData, ImgData), total=len(CaptionData))):
+        t0 = time.time()
+        DecoderInput = caption['decoder_input'].to(device)
+        Label = caption['label'].to(device)
+        Features = Backbone(img.to(device))
+        Mask = (DecoderInput != PadToken).float()
+
+        with Precision.autocast():
+            with torch.no_grad():
+                TeacherLogits = teacher(DecoderInput, Features)
+            StudentLogits, CELoss = draft(DecoderInput, Features, Label)
+        SoftLoss = distillation_loss(StudentLogits, TeacherLogits, Mask, Temprature)
+        loss = Alpha * SoftLoss + (1 - Alpha) * CELoss
+
+        if Scaler is not None:
+            Scaler.scale(loss).backward()
+            Scaler.unscale_(optimizer)
+        else:
+            loss.backward()
+        torch.nn.utils.clip_grad_norm_(draft.parameters(), 1.0)
+        if Scaler is not None:
+            Scaler.step(optimizer)
+            Scaler.update()
+        else:
+            optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+        dt = time.time() - t0
+        writer.add_scalar('Distillation Loss', SoftLoss.item(), global_step=Step)
+        writer.add_scalar('Distillation CE Loss', CELoss.item(), global_step=Step)
+        if Step % 50 == 0:
+            print(f"Step: {Step} | kl: {SoftLoss.item():.4f} | ce: {CELoss.item():.4f} | Process time: {dt*1000:.2f}ms")
+    writer.close()
+
+    torch.save(get_draft_checkpoint(draft, checkpoint_id(ModelPath)), OutPath)
+    print(f"Draft model saved to {OutPath}")
+    return draft
+
+
+# Argument parser
+def command_line_argument():
+    parser = ArgumentParser()
+    parser.add_argument('--jpath', dest='JsonPath', help='Inserts json path inside program')
+    parser.add_argument('--mpath', dest='ModelPath', help='Path of the teacher checkpoint')
+    parser.add_argument('--out', dest='OutPath', default='draft_model.pt', help='Path of the draft checkpoint')
+    parser.add_argument('--layers', dest='NumLayers', type=int, default=1, help='Number of draft decoder layers')
+    parser.add_argument('--dmodel', dest='DModel', type=int, help='Width of the draft (default: teacher width)')
+    parser.add_argument('--heads', dest='NumHeads', type=int, help='Heads of the draft (default: teacher heads)')
+    parser.add_argument('--steps', dest='Steps', type=int, default=2000, help='Number of training steps')
+    parser.add_argument('--batch', dest='BatchSize', type=int, default=64, help='Batch size')
+    parser.add_argument('--lr', dest='LearningRate', type=float, default=1e-3, help='Learning rate')
+    parser.add_argument('--temp', dest='Temprature', type=float, default=2.0, help='Distillation temprature')
+    parser.add_argument('--alpha', dest='Alpha', type=float, default=0.5, help='Weight of the distillation loss')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    Args = command_line_argument()
+    distill(Args.JsonPath,
+            Args.ModelPath,
+            Args.OutPath,
+            Args.NumLayers,
+            Args.DModel,
+            Args.NumHeads,
+            Args.Steps,
+            Args.BatchSize,
+            Args.LearningRate,
+            Args.Temprature,
+            Args.Alpha)
@@ -0,0 +1,181 @@
+import os
+import time
+import json
+import torch
+import warnings
+from argparse import ArgumentParser
+from tokenizers import Tokenizer
+from tqdm.auto import tqdm
+from torch.utils.tensorboard import SummaryWriter
+from base_files.dataset_files.json_extracter import caption_extracter
+from base_files.dataset_files.image_transforms import preprocess_images
+from base_files.inference_files.model_loader import load_caption_model, load_draft_model
+from base_files.inference_files.generator import generate_captions
+from base_files.inference_files.speculative import generate_speculative
+from base_files.metrics_files.caption_metrics import corpus_scores
+from base_files.runtime_files.precision import precisionpolicy
+
+
+@torch.no_grad()
+def evaluate(JsonPath: str,
+             ModelPath: str = None,
+             BatchSize: int = 64,
+             MaxImages: int = None,
+             Temprature: float = 1.0,
+             Topk: int = 100,
+             NumWorkers: int = None,
+             OutPath: str = 'evaluation.json',
+             DraftPath: str = None) -> dict:
+    '''
+    Captions every image of the validation split with batched generation and
+    scores the captions against the COCO references (BLEU-4 and CIDEr-D).
+    Both are computed on BPE token ids (bleu4_bpe, cider_d_bpe), they track
+    progress between checkpoints but are not comparable to COCO leaderboard
+    numbers, which use the word level PTB tokenized captions.
+    Results are written to tensorboard and to a json file. With a draft model
+    (DraftPath or 'speculative_config') speculative decoding is used.
+    '''
+    device = 'cpu'
+
+    # Use GPU if it is available
+    if torch.cuda.is_available():
+        device = 'cuda'
+
+    # Use MPS if it is available(Apple devices only)
+    elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
+        device = 'mps'
+
+    # Filtering the warnings
+    warnings.filterwarnings('ignore')
+
+    # Importing json file
+    with open (JsonPath, 'r') as f:
+        data = json.load(f)
+
+    if ModelPath is None:
+        ModelPath = data['model_config']['existing_path']
+    if NumWorkers is None:
+        NumWorkers = os.cpu_count()
+
+    # Importing tokenizer
+    tokenizer = Tokenizer.from_file(data['tokenizer_config']['tokenizer_load_path'])
+    StartTok = tokenizer.token_to_id('<|start_of_text|>')
+    EndTok = tokenizer.token_to_id('<|end_of_text|>')
+
+    # References of every validation image
+    FilePath = data['file_path']
+    ValData = caption_extracter(FilePath['json_path']['validation_json'],
+                                FilePath['image_path']['validation_path'])
+    ValData = ValData.groupby('image_path', sort=True)['caption'].apply(list)
+    if MaxImages is not None:
+        ValData = ValData.iloc[:MaxImages]
+    ImgPaths = ValData.index.tolist()
+    References = [[Encoding.ids for Encoding in tokenizer.encode_batch(Captions)]
+                  for Captions in ValData.tolist()]
+
+    model, Backbone, config = load_caption_model(data, ModelPath, device)
+    Precision = precisionpolicy(data['model_config']['dtype'], device).apply()
+
+    SpecConf = data.get('speculative_config', {})
+    draft = load_draft_model(DraftPath or SpecConf.get('draft_path'), device)
+    SpecStats = {}
+
+    # Captioning the split in batches
+    SampleRng = torch.Generator(device=device)
+    SampleRng.manual_seed(1337)
+    Hypotheses = []
+    t0 = time.time()
+    for i in tqdm(range(0, len(ImgPaths), BatchSize)):
+        img = preprocess_images(ImgPaths[i:i + BatchSize], Backbone.name).to(device)
+        with Precision.autocast():
+            Features = Backbone(img)
+            ImgEmbd = model.encode_image(Features)
+            if draft is None:
+                Tokens = generate_captions(model,
+                                           ImgEmbd,
+                                           config.blockSize,
+                                           StartTok=StartTok,
+                                           EndTok=EndTok,
+                                           Temprature=Temprature,
+                                           Topk=Topk,
+                                           SampleRng=SampleRng)
+            else:
+                Tokens = generate_speculative(model,
+                                              draft,
+                                              ImgEmbd,
+                                              draft.encode_image(Features),
+                                              config.blockSize,
+                                              StartTok=StartTok,
+                                              EndTok=EndTok,
+                                              Temprature=Temprature,
+                                              Topk=Topk,
+                                              NumDraft=SpecConf.get('num_draft', 4),
+                                              SampleRng=SampleRng,
+                                              Stats=SpecStats)
+        # Removing the special tokens
+        Hypotheses.extend([Tok for Tok in Row if Tok not in (StartTok, EndTok)]
+                          for Row in Tokens)
+    CaptionTime = time.time() - t0
+
+    Scores = corpus_scores(Hypotheses,
+                           References,
+                           VocabSize=config.vocabSize,
+                           NumWorkers=NumWorkers)
+    PerImage = Scores.pop('cider_d_bpe_per_image')
+
+    Result = {
+            'model_path': ModelPath,
+            'num_images': len(ImgPaths),
+            'batch_size': BatchSize,
+            'temperature': Temprature,
+            'top_k': Topk,
+            'images_per_sec': len(ImgPaths) / CaptionTime,
+            **Scores,
+            **({'draft_acceptance': SpecStats['accepted'] / max(SpecStats['drafted'], 1)}
+               if draft is not None else {}),
+            'captions': [{'image_path': Path,
+                          'caption': tokenizer.decode(Hyp),
+                          'cider_d_bpe': Cider}
+                         for Path, Hyp, Cider in zip(ImgPaths, Hypotheses, PerImage)]
+            }
+
+    # Tensorboard
+    writer = SummaryWriter()
+    writer.add_scalar('Evaluation bleu4_bpe', Result['bleu4_bpe'])
+    writer.add_scalar('Evaluation cider_d_bpe', Result['cider_d_bpe'])
+    writer.add_scalar('Evaluation Images Per Sec', Result['images_per_sec'])
+    writer.close()
+
+    with open(OutPath, 'w') as f:
+        json.dump(Result, f, indent=2)
+
+    print(f"BLEU-4 (BPE): {Result['bleu4_bpe']:.4f} | CIDEr-D (BPE): {Result['cider_d_bpe']:.4f} | images/sec: {Result['images_per_sec']:.2f}")
+    return Result
+
+
+# Argument parser
+def command_line_argument():
+    parser = ArgumentParser()
+    parser.add_argument('--jpath', dest='JsonPath', help='Inserts json path inside program')
+    parser.add_argument('--mpath', dest='ModelPath', help='Inserts model path inside program')
+    parser.add_argument('--batch', dest='BatchSize', type=int, default=64, help='Number of images captioned together')
+    parser.add_argument('--max-images', dest='MaxImages', type=int, help='Evaluates only the first N images')
+    parser.add_argument('--temp', dest='Temprature', type=float, default=1.0, help='Adjust the temprature of the model')
+    parser.add_argument('--topk', dest='TopK', type=int, default=100, help='Random tokens will picked from top K tokens')
+    parser.add_argument('--workers', dest='NumWorkers', type=int, help='Number of processes used for scoring')
+    parser.add_argument('--out', dest='OutPath', default='evaluation.json', help='Path of the result json')
+    parser.add_argument('--draft', dest='DraftPath', help='Draft model path, enables speculative decoding')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    Args = command_line_argument()
+    evaluate(Args.JsonPath,
+             Args.ModelPath,
+             Args.BatchSize,
+             Args.MaxImages,
+             Args.Temprature,
+             Args.TopK,
+             Args.NumWorkers,
+             Args.OutPath,
+             Args.DraftPath)
@@ -0,0 +1,83 @@
+import os
+import copy
+import json
+import torch
+import warnings
+from argparse import ArgumentParser
+from base_files.inference_files.model_loader import get_model_config, get_image_dim, get_backbone, build_decoder
+from base_files.inference_files.bundle import write_bundle
+from base_files.inference_files.caption_cache import checkpoint_id
+from base_files.transformer_files.checkpoint import load_state
+
+
+def export_bundle(JsonPath: str,
+                  ModelPath: str = None,
+                  OutPath: str = 'caption_model.bundle'):
+    '''
+    Packages everything captioning needs into one model bundle: decoder
+    weights, backbone weights (pretrained or fine tuned), the tokenizer and
+    the config json. Paths inside the stored config are removed, the bundle
+    does not depend on other files or on a network download.
+    '''
+    # Filtering the warnings
+    warnings.filterwarnings('ignore')
+
+    # Importing json file
+    with open (JsonPath, 'r') as f:
+        data = json.load(f)
+
+    if ModelPath is None:
+        ModelPath = data['model_config']['existing_path']
+
+    # Building the model on cpu, without compilation
+    config = get_model_config(data['transformer_config'],
+                              get_image_dim(data['cnn_model_config']))
+    Backbone = get_backbone(data, 'cpu')
+    model = build_decoder(config)
+    checkpoint = torch.load(ModelPath, map_location='cpu')
+    load_state(model, checkpoint['model_state_dict'], Backbone)
+
+    Tensors = {f'decoder.{Key}': Value for Key, Value in model.state_dict().items()}
+    Tensors.update({f'backbone.{Key}': Value for Key, Value in Backbone.state_dict().items()})
+
+    with open(data['tokenizer_config']['tokenizer_load_path'], 'rb') as f:
+        TokenizerData = f.read()
+
+    Config = copy.deepcopy(data)
+    Config['model_config']['existing_path'] = None
+    Config['cnn_model_config']['existing_path'] = None
+    Config['cnn_model_config']['specific_download_path'] = None
+    Config['tokenizer_config']['tokenizer_load_path'] = None
+    Config['tokenizer_config']['tokenizer_save_path'] = None
+
+    CnnConf = data['cnn_model_config']
+    Manifest = {
+            'model_name': data['transformer_config']['model_name'],
+            'backbone': {
+                'name': CnnConf.get('name', 'efficientnet_b0'),
+                'features': CnnConf.get('features', 'logits')
+                },
+            'checkpoint': checkpoint_id(ModelPath),
+            'checkpoint_name': os.path.basename(ModelPath),
+            'torch_version': torch.__version__,
+            'config': Config
+            }
+    write_bundle(OutPath, Manifest, Tensors, {'tokenizer.json': TokenizerData})
+    print(f"Bundle saved to {OutPath} ({os.path.getsize(OutPath) / 2**20:.1f}MB, {len(Tensors)} tensors)")
+    return OutPath
+
+
+# Argument parser
+def command_line_argument():
+    parser = ArgumentParser()
+    parser.add_argument('--jpath', dest='JsonPath', help='Inserts json path inside program')
+    parser.add_argument('--mpath', dest='ModelPath', help='Path of the checkpoint (default: existing_path of the config)')
+    parser.add_argument('--out', dest='OutPath', default='caption_model.bundle', help='Path of the bundle')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    Args = command_line_argument()
+    export_bundle(Args.JsonPath,
+                  Args.ModelPath,
+                  Args.OutPath)
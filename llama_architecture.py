@@ -0,0 +1,303 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Union
+from base_files.transformer_files.kv_cache import kvcache
+from base_files.transformer_files.transformer import transformer as gpt_transformer
+
+
+# Creating a data class for the llama config
+
+@dataclass
+class mArgs:
+    dim: int = 384
+    nLayers: int = 6
+    nHeads: int = 6
+    # Key/value heads, every key/value head is shared by nHeads // nKVHeads
+    # query heads (grouped query attention), None means nHeads
+    nKVHeads: Optional[int] = None
+    VocabSize: int = 30080
+    MultipleOf: int = 64
+    FFNDimMultiplier: Optional[float] = None
+    NormEps: float = 1e-5
+    MaxSeqLen: int = 128
+    RopeTheta: float = 10000.0
+    # Size of the Cnn model features
+    ImgDim: int = 1000
+    # Activation checkpointing: False, True (every block) or list of blocks
+    gradCheckpoint: Union[bool, list] = False
+
+    def __post_init__(self):
+        if self.nKVHeads is None:
+            self.nKVHeads = self.nHeads
+        assert self.dim % self.nHeads == 0
+        assert self.nHeads % self.nKVHeads == 0, "Number of heads has to be divisible by number of key/value heads"
+
+    # Names shared with transformerconfig (used by generation and validation)
+    @property
+    def blockSize(self) -> int:
+        return self.MaxSeqLen
+
+    @property
+    def vocabSize(self) -> int:
+        return self.VocabSize
+
+    @property
+    def imgDim(self) -> int:
+        return self.ImgDim
+
+    @property
+    def headDim(self) -> int:
+        return self.dim // self.nHeads
+
+
+@lru_cache(maxsize=None)
+def precompute_theta_pos_frequencies(HeadDim: int,
+                                     SeqLen: int,
+                                     Theta: float = 10000.0) -> tuple:
+    '''
+    Rotary embedding tables of shape (SeqLen, HeadDim // 2): cosine and sine
+    of position * Theta ^ (-2i / HeadDim). They only depend on the sizes, so
+    they are computed once and shared by every model with the same sizes.
+    '''
+    assert HeadDim % 2 == 0, "Head dimension has to be even for rotary embeddings"
+    Freqs = 1.0 / (Theta ** (torch.arange(0, HeadDim, 2).float() / HeadDim))
+    Angles = torch.outer(torch.arange(SeqLen).float(), Freqs)
+    return torch.cos(Angles), torch.sin(Angles)
+
+
+def apply_rotary_embeddings(x, Cos, Sin):
+    '''
+    Rotates every pair of features (2i, 2i + 1) of x (BatchSize, Heads,
+    SeqLen, HeadDim) by the angle of its position. Cos and Sin are
+    (SeqLen, HeadDim // 2), or (BatchSize, 1, SeqLen, HeadDim // 2) when
+    every row has its own positions.
+    '''
+    x1 = x[..., 0::2].float()
+    x2 = x[..., 1::2].float()
+    Out = torch.stack((x1 * Cos - x2 * Sin,
+                       x1 * Sin + x2 * Cos), dim=-1)
+    return Out.flatten(-2).type_as(x)
+
+
+class rmsnorm(nn.Module):
+    def __init__(self, dim: int, Eps: float = 1e-5):
+        super(rmsnorm, self).__init__()
+        self.eps = Eps
+        self.weight = nn.Parameter(torch.ones(dim))
+
+    def forward(self, x):
+        # Normalizing by root mean square (no mean subtraction and bias)
+        Norm = x.float() * torch.rsqrt(x.float().pow(2).mean(-1, keepdim=True) + self.eps)
+        return Norm.type_as(x) * self.weight
+
+
+class selfattention(nn.Module):
+    def __init__(self, config: mArgs):
+        super(selfattention, self).__init__()
+        self.nHeads = config.nHeads
+        self.nKVHeads = config.nKVHeads
+        self.headDim = config.headDim
+        self.wq = nn.Linear(config.dim, config.nHeads * self.headDim, bias=False)
+        self.wk = nn.Linear(config.dim, config.nKVHeads * self.headDim, bias=False)
+        self.wv = nn.Linear(config.dim, config.nKVHeads * self.headDim, bias=False)
+        self.wo = nn.Linear(config.nHeads * self.headDim, config.dim, bias=False)
+        self.wo.TRANSFORMER_SCALE_INIT = 1
+
+    def forward(self, x, Cos, Sin, Cache=None, StartPos: int = 0, Mask=None):
+        BatchSize, SeqLen, _ = x.size()
+
+        # (BatchSize, Heads, SeqLen, HeadDim)
+        q = self.wq(x).view(BatchSize, SeqLen, self.nHeads, self.headDim).transpose(1, 2)
+        k = self.wk(x).view(BatchSize, SeqLen, self.nKVHeads, self.headDim).transpose(1, 2)
+        v = self.wv(x).view(BatchSize, SeqLen, self.nKVHeads, self.headDim).transpose(1, 2)
+
+        q = apply_rotary_embeddings(q, Cos, Sin)
+        k = apply_rotary_embeddings(k, Cos, Sin)
+
+        '''
+        Only the key/value heads are cached, they are repeated for their
+        query heads right before the attention. Masks follow the ones used
+        by cmha.
+        '''
+        IsCausal = Mask is None
+        if Cache is not None:
+            k, v = Cache.update(k, v, StartPos)
+            if Mask is None and SeqLen == 1:
+                IsCausal = False
+            elif Mask is None and StartPos > 0:
+                IsCausal = False
+                Mask = torch.ones(SeqLen, k.size(2),
+                                  dtype=torch.bool,
+                                  device=x.device).tril(diagonal=StartPos)
+
+        if self.nKVHeads != self.nHeads:
+            k = k.repeat_interleave(self.nHeads // self.nKVHeads, dim=1)
+            v = v.repeat_interleave(self.nHeads // self.nKVHeads, dim=1)
+
+        x = F.scaled_dot_product_attention(q, k, v,
+                                           attn_mask=Mask,
+                                           is_causal=IsCausal)
+
+        x = x.transpose(1, 2).contiguous().view(BatchSize, SeqLen, -1)
+        return self.wo(x)
+
+
+class feedforward(nn.Module):
+    def __init__(self, config: mArgs):
+        super(feedforward, self).__init__()
+        # SwiGLU, hidden size is 2/3 of 4 * dim rounded to MultipleOf
+        HiddenDim = int(2 * 4 * config.dim / 3)
+        if config.FFNDimMultiplier is not None:
+            HiddenDim = int(config.FFNDimMultiplier * HiddenDim)
+        HiddenDim = config.MultipleOf * ((HiddenDim + config.MultipleOf - 1) // config.MultipleOf)
+
+        self.w1 = nn.Linear(config.dim, HiddenDim, bias=False)
+        self.w3 = nn.Linear(config.dim, HiddenDim, bias=False)
+        self.w2 = nn.Linear(HiddenDim, config.dim, bias=False)
+        self.w2.TRANSFORMER_SCALE_INIT = 1
+
+    def forward(self, x):
+        return self.w2(F.silu(self.w1(x)) * self.w3(x))
+
+
+class llamablock(nn.Module):
+    def __init__(self, config: mArgs):
+        super(llamablock, self).__init__()
+        self.attentionNorm = rmsnorm(config.dim, config.NormEps)
+        self.attention = selfattention(config)
+        self.ffnNorm = rmsnorm(config.dim, config.NormEps)
+        self.feedForward = feedforward(config)
+
+    def forward(self, x, Cos, Sin, Cache=None, StartPos: int = 0, Mask=None):
+        x = x + self.attention(self.attentionNorm(x), Cos, Sin, Cache, StartPos, Mask)
+        x = x + self.feedForward(self.ffnNorm(x))
+        return x
+
+
+class transformer(nn.Module):
+    '''
+    Llama style decoder (RMSNorm, rotary embeddings, SwiGLU and grouped
+    query attention). The projected Cnn model features are added to the
+    embedding of every token. Interface is the same as the gpt-2 decoder:
+    encode_image, decode (with a kvcache for incremental decoding) and
+    forward on the output of the frozen Cnn model stage.
+    '''
+    def __init__(self, config: mArgs, device=None):
+        super(transformer, self).__init__()
+        self.config = config
+        self.tokEmbd = nn.Embedding(config.VocabSize, config.dim)
+        self.layers = nn.ModuleList([llamablock(config) for _ in range(config.nLayers)])
+        self.norm = rmsnorm(config.dim, config.NormEps)
+        self.output = nn.Linear(config.dim, config.VocabSize, bias=False)
+        self.cnnLayer = nn.Linear(config.ImgDim, config.dim)
+
+        # Rotary tables are not trainable, so they are not saved either
+        Cos, Sin = precompute_theta_pos_frequencies(config.headDim,
+                                                    config.MaxSeqLen,
+                                                    config.RopeTheta)
+        self.register_buffer('ropeCos', Cos.to(device), persistent=False)
+        self.register_buffer('ropeSin', Sin.to(device), persistent=False)
+
+        # Cache used by forward(..., StartPos=...) when no cache is given
+        self.cache = None
+
+        self.apply(self._init_weights)
+
+    # Weight initialization, optimizer groups and block selection for
+    # activation checkpointing are the same as in the gpt-2 decoder
+    _init_weights = gpt_transformer._init_weights
+    configure_optimizers = gpt_transformer.configure_optimizers
+    is_checkpointed = gpt_transformer.is_checkpointed
+
+    def encode_image(self, Img):
+        # Projecting Cnn Model features, output is (BatchSize, -1, dim)
+        Img = self.cnnLayer(Img)
+        return torch.reshape(Img, (Img.size(0), -1, self.config.dim))
+
+    def decode(self,
+               Input,
+               Img,
+               Label=None,
+               StartPos: int = 0,
+               Cache=None,
+               Position=None,
+               Segment=None):
+        '''
+        Runs the decoder on an already encoded image. For incremental decoding
+        a kvcache is passed with the position of the first token in Input.
+        Packed rows pass Position and Segment like the gpt-2 decoder.
+        '''
+        BatchSize, SeqLen = Input.size()
+        assert StartPos + SeqLen <= self.config.MaxSeqLen, f"Cannot pass the sequence to the model, Error: length {StartPos + SeqLen} is greater than the block size parameter for the model"
+
+        Mask = None
+        if Segment is not None:
+            # Rotary angles of every token and image of its caption
+            Cos = self.ropeCos[Position].unsqueeze(1)
+            Sin = self.ropeSin[Position].unsqueeze(1)
+            Index = Segment.clamp(min=0).unsqueeze(-1).expand(-1, -1, Img.size(-1))
+            Img = torch.gather(Img, 1, Index)
+            Mask = (Segment.unsqueeze(2) == Segment.unsqueeze(1)).tril().unsqueeze(1)
+        else:
+            Cos = self.ropeCos[StartPos:StartPos + SeqLen]
+            Sin = self.ropeSin[StartPos:StartPos + SeqLen]
+
+        x = self.tokEmbd(Input) + Img
+
+        for i, layer in enumerate(self.layers):
+            if self.training and Cache is None and self.is_checkpointed(i):
+                x = checkpoint(layer, x, Cos, Sin, Mask=Mask, use_reentrant=False)
+            else:
+                x = layer(x,
+                          Cos,
+                          Sin,
+                          None if Cache is None else Cache[i],
+                          StartPos,
+                          Mask)
+
+        logits = self.output(self.norm(x))
+        if Label is not None:
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)),
+                                   Label.view(-1), ignore_index=-1)
+            return logits, loss
+
+        return logits
+
+    def forward(self,
+                Input,
+                Img,
+                Label=None,
+                StartPos: int = None,
+                Position=None,
+                Segment=None,
+                ImgIndex=None):
+        '''
+        Img is the output of the frozen Cnn model. Passing StartPos decodes
+        incrementally with the model's own cache (allocated again whenever a
+        new sequence starts at StartPos 0), so only new tokens are passed.
+        '''
+        Img = self.encode_image(Img)
+        if ImgIndex is not None:
+            Img = Img[ImgIndex]
+
+        if StartPos is None:
+            return self.decode(Input,
+                               Img,
+                               Label,
+                               Position=Position,
+                               Segment=Segment)
+
+        if StartPos == 0 or self.cache is None:
+            self.cache = kvcache(self.config,
+                                 BatchSize=Input.size(0),
+                                 device=Input.device,
+                                 dtype=Img.dtype)
+        return self.decode(Input,
+                           Img,
+                           Label,
+                           StartPos=StartPos,
+                           Cache=self.cache)
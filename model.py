@@ -1,11 +1,8 @@
 import torch
-import time
 import os
 import pandas
-from torch.cuda import is_bf16_supported
 from torch.nn import functional as F
 from torch.utils.data import DataLoader
-from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 from tokenizers import Tokenizer
 import json
@@ -14,41 +11,37 @@ from argparse import ArgumentParser
 import warnings
 import math
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.distributed import init_process_group, destroy_process_group
+from torch.distributed import destroy_process_group
 import torch.distributed as dist
 import torch.multiprocessing as mp
 from base_files.transformer_files.dataclass import transformerconfig
 from base_files.transformer_files.transformer import transformer
-from base_files.cnn_model_files.cnn_model import get_cnn_model
+from base_files.transformer_files.adaptive_head import count_tokens, frequency_order
+from base_files.cnn_model_files.cnn_model import get_cnn_model, get_backbone_spec, frozenbackbone
+from base_files.transformer_files.checkpoint import load_state, save_checkpoint, is_resumable
 from base_files.tokenizer_files.tokenizer import get_tokenizer, texttoid, fast_tokenizer
 from base_files.dataset_files.json_extracter import caption_extracter
 from base_files.dataset_files.image_extracter import imgextracter
-from validation import validation
+from base_files.dataset_files.packing import packingplan, packedtexttoid, packedimgextracter
+from base_files.dataset_files.grouping import groupingplan, groupedtexttoid
+from base_files.dataset_files.sampler import resumesampler
+from validation import validator
+from base_files.training_files.grad_accum import gradaccumulator
+from base_files.training_files.comm_hooks import get_hook_config, register_comm_hook
+from base_files.training_files.metrics import metricslogger
+from base_files.runtime_files.precision import precisionpolicy
+from base_files.runtime_files.compile_config import (compile_component,
+                                                     load_compile_cache,
+                                                     save_compile_cache)
+from base_files.training_files.distributed import (setup,
+                                                   get_backend,
+                                                   get_world_size,
+                                                   get_elastic_env,
+                                                   pin_cpu_threads)
 from llama_architecture import mArgs, precompute_theta_pos_frequencies
 from llama_architecture import transformer as llama_transformer
 
 
-def is_bf16_supported():
-    try:
-        device = torch.device('cuda')
-        x = torch.tensor([1, 2], dtype=torch.bfloat16, device=device)
-        return True
-    except Exception as e:
-        print("bf16 is not supported")
-        return False
-
-
-def setup(rank:int,
-          world_size:int):
-
-    os.environ["MASTER_ADDR"] = 'localhost'
-    os.environ['MASTER_PORT'] = '5674'
-
-    init_process_group(backend='nccl',
-                       rank=rank,
-                       world_size=world_size)
-
-
 # Setting seed for reproducability
 torch.manual_seed(1337)
 if torch.cuda.is_available():
@@ -82,10 +75,10 @@ def parallel_data_sampler(rank,
                           dataset,
                           batch_size:int):
 
-    sampler = DistributedSampler(dataset,
-                                 num_replicas=WorldSize,
-                                 rank=rank,
-                                 shuffle=False)
+    # Items of a rank can be restarted from any position of the epoch
+    sampler = resumesampler(len(dataset),
+                            rank=rank,
+                            world_size=WorldSize)
 
     dataloader = DataLoader(dataset,
                             batch_size=batch_size,
@@ -99,14 +92,37 @@ def parallel_data_sampler(rank,
 def train(rank:int,
           world_size:int,
           JsonPath:str,
-          ):
-    
-    # Check for multiple GPU's
+          Backend:str='nccl',
+          LocalRank:int=None,
+          LocalWorldSize:int=None,
+          Elastic:bool=False):
+
+    # Loading json
+    with open (JsonPath, 'r') as f:
+        data = json.load(f)
+    DistConf = data.get('distributed_config', {})
+
+    # Check for multiple processes (GPU's with nccl, CPU ranks with gloo)
     if world_size > 1:
-        setup(rank=rank,# Current GPU id
-              world_size=world_size) # Total number of GPU's
-        device = rank
-        device_type = 'cuda'
+        setup(rank=rank,# Current process id
+              world_size=world_size, # Total number of processes
+              Backend=Backend,
+              MasterAddr=DistConf.get('master_addr'),
+              MasterPort=DistConf.get('master_port'),
+              Elastic=Elastic)
+        # Devices and cores are per node, multi node launches use local ranks
+        LocalRank = rank if LocalRank is None else LocalRank
+        LocalWorldSize = world_size if LocalWorldSize is None else LocalWorldSize
+        if Backend == 'nccl':
+            device = LocalRank
+            device_type = 'cuda'
+            torch.cuda.set_device(device)
+        else:
+            device = 'cpu'
+            device_type = 'cpu'
+            pin_cpu_threads(LocalRank,
+                            LocalWorldSize,
+                            DistConf.get('threads_per_rank'))
         DistDataParallel = True
 
     else:
@@ -130,10 +146,6 @@ def train(rank:int,
 
     # Setting null to None(for Json)
     null = None
-    
-    # Loading json
-    with open (JsonPath, 'r') as f:
-        data = json.load(f)
 
     FilePath = data['file_path']
     TrainJson = FilePath['json_path']['train_json']
@@ -155,6 +167,9 @@ def train(rank:int,
     NumHeads = TrConf['number_heads']
     DModel = TrConf['d_model']
     ContinueTheWork = TrConf['continue']
+    GradCheckpoint = TrConf.get('activation_checkpointing', False)
+    AdaptiveCutoffs = TrConf.get('adaptive_cutoffs')
+    AdaptiveDivValue = TrConf.get('adaptive_div_value', 4.0)
 
     # Sample Size
     TotalSamples = data['dataset_config']['max_sample']
@@ -166,18 +181,36 @@ def train(rank:int,
     ModelDtype = ModelConfig['dtype']
     ModelPath = ModelConfig['existing_path']
 
-    bf16 = False
-    fp16 = False
-    
-    if ModelDtype == "bf16":
-        bf16 = True
-    elif ModelDtype == "fp16":
-        fp16 = True
+    '''
+    Checkpoints are saved to CheckpointPath every CheckpointInterval steps (0
+    disables it), the final model is saved to caption_model.pt. An elastic
+    run restarted by its launcher resumes from its own latest checkpoint,
+    whatever the 'continue' setting is, but only while that run is
+    unfinished (the periodic checkpoint is removed once the final model is
+    saved).
+    '''
+    CheckpointPath = DistConf.get('checkpoint_path') or 'caption_model.ckpt.pt'
+    CheckpointInterval = DistConf.get('checkpoint_interval') or 0
+    FinalPath = 'caption_model.pt'
+    Resume = bool(ContinueTheWork)
+    if Elastic and is_resumable(CheckpointPath):
+        ModelPath = CheckpointPath
+        Resume = True
+        if rank == 0:
+            print(f"Resuming elastic run from {CheckpointPath} with world size {world_size}")
+
+    # Autocast dtype, grad scaler and matmul precision for this device
+    Precision = precisionpolicy(ModelDtype, device_type)
+    if rank == 0:
+        print(f"Precision: {Precision}")
 
     # Cnn Model parameters
     CnnConf = data['cnn_model_config']
     ExistingPath = CnnConf['existing_path']
     SpecificDownloadPath = CnnConf['specific_download_path']
+    CnnName = CnnConf.get('name', 'efficientnet_b0')
+    CnnFeatures = CnnConf.get('features', 'logits')
+    ImgDim = get_backbone_spec(CnnName).feature_dim(CnnFeatures)
 
 
     # Creating a tokenizer
@@ -208,87 +241,142 @@ def train(rank:int,
                                    vocabSize=VocabSize,
                                    nLayers=NumLayers,
                                    nHead=NumHeads,
-                                   nEmbd=DModel)
+                                   nEmbd=DModel,
+                                   imgDim=ImgDim,
+                                   gradCheckpoint=GradCheckpoint,
+                                   adaptiveCutoffs=AdaptiveCutoffs,
+                                   adaptiveDivValue=AdaptiveDivValue)
     elif TrainModelName == 'llama-2':
+        assert AdaptiveCutoffs is None, "The adaptive softmax head is only available for gpt-2"
         config = mArgs(dim=DModel,
                        nLayers=NumLayers,
                        nHeads=NumHeads,
+                       nKVHeads=TrConf.get('number_kv_heads'),
                        MaxSeqLen=MaxLen,
-                       VocabSize=VocabSize)
+                       VocabSize=VocabSize,
+                       ImgDim=ImgDim,
+                       gradCheckpoint=GradCheckpoint)
     
 
     # Downloading the Cnn model
     if ExistingPath is not None and SpecificDownloadPath is not None:
-        efficientb0 = get_cnn_model(ExistingPath=ExistingPath,
-                                    SpecificDownloadPath=SpecificDownloadPath)
+        CnnModel = get_cnn_model(ExistingPath=ExistingPath,
+                                 SpecificDownloadPath=SpecificDownloadPath,
+                                 Name=CnnName,
+                                 Features=CnnFeatures)
 
     else:
-        efficientb0 = get_cnn_model()
-
+        CnnModel = get_cnn_model(Name=CnnName,
+                                 Features=CnnFeatures)
+
+    '''
+    The Cnn model is frozen, so it runs as a separate stage in eval mode
+    without autograd. Only the decoder is compiled, wrapped by DDP and has its
+    gradients clipped.
+    '''
+    Backbone = frozenbackbone(CnnModel,
+                              device,
+                              dtype=CnnConf.get('dtype'),
+                              Name=CnnName)
+
+
+    '''
+    Batching mode:
+        padded: one caption per row, padded to the block size
+        packed: several captions (and their images) share one row, every
+                caption attends only to itself
+        grouped: one entry per image with all of its captions, every image
+                 is loaded and encoded once (BatchSize still counts captions)
+    '''
+    DataConf = data['dataset_config']
+    Batching = DataConf.get('batching', 'padded')
+    LoaderBatchSize = BatchSize
 
     # Loading caption data into dataloader
-    CaptionDataClass = texttoid(WrappedTokenizer,
-                                TrainData)
-
+    if Batching == 'packed':
+        Plan = packingplan(WrappedTokenizer,
+                           TrainData,
+                           BlockSize=MaxLen,
+                           MaxSegments=DataConf.get('max_segments', 8))
+        if rank == 0:
+            print(f"Packed {len(TrainData)} captions into {len(Plan)} rows, useful tokens: {Plan.useful_tokens():.2%}")
+        CaptionDataClass = packedtexttoid(WrappedTokenizer, Plan)
+    elif Batching == 'grouped':
+        CaptionsPerImage = DataConf.get('captions_per_image', 5)
+        assert BatchSize % CaptionsPerImage == 0, "Make sure the batch size is divisible by captions per image"
+        LoaderBatchSize = BatchSize // CaptionsPerImage
+        Plan = groupingplan(TrainData, CaptionsPerImage)
+        CaptionDataClass = groupedtexttoid(WrappedTokenizer,
+                                           TrainData,
+                                           Plan)
+    else:
+        CaptionDataClass = texttoid(WrappedTokenizer,
+                                    TrainData)
 
-    if DistDataParallel:
-        CaptionData = parallel_data_sampler(rank=rank,
-                                            WorldSize=world_size,
-                                            dataset=CaptionDataClass,
-                                            batch_size=BatchSize)
 
-    else:
-        CaptionData = DataLoader(CaptionDataClass,
-                                 batch_size=BatchSize)
+    CaptionData = parallel_data_sampler(rank=rank,
+                                        WorldSize=world_size,
+                                        dataset=CaptionDataClass,
+                                        batch_size=LoaderBatchSize)
 
 
     # Loading Image data into dataloader
-    ImgDataClass = imgextracter(dataframe=TrainData)
-
+    if Batching == 'packed':
+        ImgDataClass = packedimgextracter(dataframe=TrainData,
+                                          plan=Plan,
+                                          CnnName=CnnName)
+    elif Batching == 'grouped':
+        ImgDataClass = imgextracter(dataframe=Plan.images,
+                                    CnnName=CnnName)
+    else:
+        ImgDataClass = imgextracter(dataframe=TrainData,
+                                    CnnName=CnnName)
 
-    if DistDataParallel:
-        ImgData = parallel_data_sampler(rank=rank,
-                                        WorldSize=world_size,
-                                        dataset=ImgDataClass,
-                                        batch_size=BatchSize)
 
-    else:
-        ImgData = DataLoader(ImgDataClass,
-                             batch_size=BatchSize)
+    ImgData = parallel_data_sampler(rank=rank,
+                                    WorldSize=world_size,
+                                    dataset=ImgDataClass,
+                                    batch_size=LoaderBatchSize)
 
 
     # Initializing the transformer model
-    if bf16:
-        torch.set_float32_matmul_precision('high')
+    Precision.apply()
     if TrainModelName == 'gpt-2':
-        model = transformer(config=config,
-                            CnnModel=efficientb0)
+        model = transformer(config=config)
     elif TrainModelName == 'llama-2':
         model = llama_transformer(config,
-                                  CnnModel=efficientb0,
                                   device=device)
-    if ContinueTheWork:
-        checkpoint = torch.load(ModelPath)
-        state_dict = checkpoint['model_state_dict']
-        for key in list(state_dict.keys()):
-            state_dict[key.replace("module._orig_mod.", "")] = state_dict.pop(key)
-        model.load_state_dict(state_dict)
+
+    '''
+    Clusters of the adaptive head are built from the token counts of the
+    training captions (a resumed checkpoint keeps its own order).
+    '''
+    if AdaptiveCutoffs is not None:
+        TokenCounts = count_tokens(WrappedTokenizer, TrainData, VocabSize)
+        model.head.set_order(frequency_order(TokenCounts))
+        if rank == 0:
+            Coverage = ", ".join(f"{Part:.2%}" for Part in model.head.coverage(TokenCounts))
+            print(f"Adaptive head clusters cover {Coverage} of the training tokens")
+            print(f"Output head: {model.head.flops_per_token() / 1e6:.2f}M MACs per token (full head: {DModel * VocabSize / 1e6:.2f}M)")
+
+    if Resume:
+        checkpoint = torch.load(ModelPath, map_location='cpu')
+        load_state(model, checkpoint['model_state_dict'], Backbone)
 
     model.to(device) 
 
-    # To compile model and make model faster
-    if model == 'gpt-2' or DModel == 384:
-        model = torch.compile(model)
+    # To compile model and make model faster (settings per component)
+    CompileConf = data.get('compile_config', {})
+    load_compile_cache(CompileConf.get('cache_dir'))
+    model = compile_component(model, CompileConf, 'decoder')
+    Backbone.model = compile_component(Backbone.model, CompileConf, 'backbone')
 
 
     # Adding grad scaler for mixed precision
-    if device_type == 'cuda' and fp16:
-        Scaler = torch.cuda.amp.GradScaler(enabled=True)
-        if ContinueTheWork:
-            Scaler.load_state_dict(checkpoint['scaler'])
-        UseScaler = True
-    else:
-        UseScaler = False
+    Scaler = Precision.get_scaler()
+    UseScaler = Scaler is not None
+    if UseScaler and Resume and 'scaler' in checkpoint:
+        Scaler.load_state_dict(checkpoint['scaler'])
 
 
     if DistDataParallel:
@@ -301,7 +389,15 @@ def train(rank:int,
         gradients of every GPU.
         '''
         model = DDP(model,
-                    device_ids=[device])
+                    device_ids=[device] if device_type == 'cuda' else None)
+
+        # Gradient compression during all-reduce (kept from the checkpoint)
+        HookConf = get_hook_config(DistConf, checkpoint if Resume else None)
+        CommStats = register_comm_hook(model,
+                                       HookConf,
+                                       checkpoint['global_step'] if Resume else 0)
+        if rank == 0:
+            print(f"Using communication hook: {HookConf['name']}")
 
 
     # We need to create raw model for our configure optimizer to work properly
@@ -325,211 +421,238 @@ def train(rank:int,
                                   eps=1e-8)'''
     optimizer = raw_model.configure_optimizers(WeightDecay=0.1,
                                            LearningRate=6e-4,
-                                           device=device_type)
-    if ContinueTheWork:
+                                           device=device_type,
+                                           ZeroSharding=DistDataParallel and bool(DistConf.get('zero_sharding', 0)))
+    if Resume:
         # Loading checkpoint
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
 
-    # Creating gradient accumulation step to increase batch size
-    TotalBatchSize = 2**16
-    assert TotalBatchSize % (BatchSize * MaxLen * world_size) == 0, "Make sure the total batch size is divisible by Batch * SeqLen"
+    '''
+    Creating gradient accumulation step to increase batch size. It is
+    computed from the current world size, so the global batch stays the same
+    when an elastic run restarts with fewer or more processes.
+    '''
+    TotalBatchSize = ModelConfig.get('total_batch_size', 2**16)
+    assert TotalBatchSize % (BatchSize * MaxLen * world_size) == 0, "Make sure the total batch size is divisible by Batch * SeqLen * WorldSize"
     GradAccumSteps = TotalBatchSize // (BatchSize * MaxLen * world_size)
     if rank == 0: # This will prevent displaying text multiple times
         print(f"Total batch size is: {TotalBatchSize} ")
         print(f"-> calculated gradient accumulation steps: {GradAccumSteps}")
 
-    # Tensorboard
+    # Tensorboard, scalars of the training steps are written in the background
     writer = SummaryWriter()
+    MetricsConf = data.get('metrics_config', {})
+    Metrics = metricslogger(writer,
+                            device_type,
+                            FlushInterval=MetricsConf.get('flush_interval', 50),
+                            rank=rank,
+                            world_size=world_size,
+                            Aggregate=bool(MetricsConf.get('aggregate', 0)))
+
+    # Validation images are preprocessed once (only rank 0 validates)
+    ValConf = data.get('validation_config', {})
+    ValInterval = ValConf.get('interval', 500)
+    if rank == 0:
+        Validator = validator(ValConf.get('image_paths') or TestImgPath,
+                              Backbone,
+                              WrappedTokenizer,
+                              config,
+                              MaxLen,
+                              writer=writer,
+                              Precision=Precision,
+                              Temprature=ValConf.get('temperature', 0.64),
+                              Topk=ValConf.get('top_k', 100),
+                              Background=bool(ValConf.get('background', 0)))
 
     # Training
-    TimeTaken = 0
-    if ContinueTheWork:
+    EpochPosition = 0 # Dataset items of the current epoch already trained on
+    if Resume:
         GlobalSteps = checkpoint['global_step']
         StartEpochs = checkpoint['epoch']
         EndEpochs = StartEpochs + Epochs
+        if 'epoch_position' in checkpoint:
+            # Periodic checkpoint, the interrupted run is continued
+            EndEpochs = checkpoint['end_epoch']
+            EpochPosition = checkpoint['epoch_position']
     else:
         GlobalSteps = 0
         StartEpochs = 0
         EndEpochs = StartEpochs + Epochs
 
+    # Dataset items of one step, the same for every world size
+    ItemsPerStep = LoaderBatchSize * GradAccumSteps * world_size
+
+    def forward_micro_batch(Batch):
+        caption, img = Batch
+
+        # Storing the values and converting them to device
+        DecoderInput = caption['decoder_input'].to(device)
+        Label = caption['label'].to(device)
+
+        Position = Segment = ImgIndex = None
+        if Batching == 'grouped':
+            # (Images, CaptionsPerImage, SeqLen) -> (Captions, SeqLen)
+            ImgIndex = torch.arange(DecoderInput.size(0),
+                                    device=DecoderInput.device)
+            ImgIndex = ImgIndex.repeat_interleave(DecoderInput.size(1))
+            DecoderInput = DecoderInput.flatten(0, 1)
+            Label = Label.flatten(0, 1)
+            img = Backbone(img)
+        elif 'segment' in caption:
+            # Packed rows, only images of used segments go through the Cnn
+            Position = caption['position'].to(device)
+            Segment = caption['segment'].to(device)
+            NumSegments = caption['segment'].max(dim=1).values + 1
+            Used = torch.arange(img.size(1)) < NumSegments.unsqueeze(1)
+            Features = Backbone(img[Used.to(img.device)])
+            img = Features.new_zeros(*img.shape[:2], Features.size(-1))
+            img[Used.to(device)] = Features
+        else:
+            img = Backbone(img)
+
+        '''
+        Autocasting to datatypes of model to bfloat16 as it is 4x
+        faster than normal float32. It reduces the decimal value. The
+        forward pass runs once, under the dtype chosen by the policy.
+        '''
+        with Precision.autocast():
+            _ , loss = model(DecoderInput,
+                             img,
+                             Label,
+                             Position=Position,
+                             Segment=Segment,
+                             ImgIndex=ImgIndex)
+        return loss
+
+    '''
+    Reason why we do Gradient Accumulation:-
+    Reason for doing gradient accumulation is because larger batch 
+    have tendency to smoothen out the convergence while small 
+    batches have tendency to converge faster. Large batches are 
+    good on large dataset but are costlier to train. To fix this
+    gradient accumulation is used on smaller batches to accumulate
+    gradient. If gradients are accumulated we can average the loss
+    and get the same result as that on larger batch. But not doing
+    will not accumulate and will not smooth out the training process,
+    i.e. model will not converge(minimum loss) smoothly and will shock
+    the model.
+
+    Gradient syncing is stopped before last micro batch because
+    synchronizing every inner loop will waste time. Gradients of ranks are
+    added up and reduced alltogether during the last backward pass.
+    '''
+    Accumulator = gradaccumulator(model,
+                                  GradAccumSteps,
+                                  Scaler=Scaler,
+                                  DistDataParallel=DistDataParallel)
+
     for i in tqdm(range(StartEpochs, EndEpochs)):
-        IterImgData = iter(ImgData)
-        IterCapData = iter(CaptionData)
+        # Skipping the items trained on before a restart
+        CaptionData.sampler.set_start(EpochPosition)
+        ImgData.sampler.set_start(EpochPosition)
+        MicroBatches = zip(iter(CaptionData), iter(ImgData))
 
-        LocalSteps = 0
+        LocalSteps = EpochPosition // ItemsPerStep
 
         TrainRange = len(ImgData)//GradAccumSteps
         if test:
             TrainRange = 4
         for _ in range(TrainRange):
-            t0 = time.time() # Storing time of begining of the step
-
-            # Accumulated gradient calculation
-            for MicroStep in range(GradAccumSteps):
-
-                # Iterating the dataset
-                caption = next(IterCapData)
-                img = next(IterImgData)
-                
-                # Storing the values and converting them to device
-                DecoderInput = caption['decoder_input'].to(device)
-                Label = caption['label'].to(device)
-                img = img.to(device)
-
-                '''
-                Autocasting to datatypes of model to bfloat16 as it is 4x
-                faster than normal float32. It reduces the decimal value.
-                '''
-                if bf16:
-                    with torch.autocast(device_type=device_type,
-                                        dtype=torch.bfloat16):
-                        _ , loss = model(DecoderInput, img, Label)
-                if fp16:
-                    with torch.autocast(device_type=device_type,
-                                        dtype=torch.float16):
-                        _ , loss = model(DecoderInput, img, Label)
+            '''
+            Nothing in the step waits for the device: the loss and the
+            gradient norm stay device tensors and times are device events,
+            metricslogger copies them to the host every few steps. (The fp16
+            grad scaler still checks for inf gradients on the host.)
+            '''
+            Metrics.start_step()
+
+            # Accumulated gradient calculation (backward on every micro batch)
+            with Metrics.stage('forward_backward'):
+                LossAccum = Accumulator.accumulate(MicroBatches, forward_micro_batch)
+
+            with Metrics.stage('optimizer'):
+                if UseScaler:
+                    Scaler.unscale_(optimizer)
+
+                # Applying norm on gradients to reduce shock of the model
+                Norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+
+                # Decay in learning rate
+                lr = get_decay_lr(GlobalSteps,
+                                  WarmupSteps=WarmupSteps,
+                                  MaxSteps=MaxSteps,
+                                  MaxLr=MaxLr,
+                                  MinLr=MinLr)
+
+                for param_group in optimizer.param_groups:
+                    param_group['lr'] = lr
+
+                if not UseScaler:
+                    optimizer.step() # Applying a backpropogation step
+
                 else:
-                    _ , loss = model(DecoderInput, img, Label)
-
-
-                '''
-                To calculate Gradient accumulation for larger batches, we need
-                to add loss for each micro batch size and scaled it down during
-                each step.
-                '''
-                loss = loss / GradAccumSteps
-
-                '''
-                Gradient syncing is stopped before last step because it
-                increase training process and synchronize every inner loop will
-                waste time. We will not synchronize gradients of ranks until
-                last step, we will just add them up and reduce them alltogther.
-
-
-                Reason why we do Gradient Accumulation:-
-                Reason for doing gradient accumulation is because larger batch 
-                have tendency to smoothen out the convergence while small 
-                batches have tendency to converge faster. Large batches are 
-                good on large dataset but are costlier to train. To fix this
-                gradient accumulation is used on smaller batches to accumulate
-                gradient. If gradients are accumulated we can average the loss
-                and get the same result as that on larger batch. But not doing
-                will not accumulate and will not smooth out the training process,
-                i.e. model will not converge(minimum loss) smoothly and will shock
-                the model.
-                '''
-
-                if DistDataParallel:
-                    model.require_backward_grad_sync = (MicroStep == GradAccumSteps - 1)
-
-            if UseScaler:
-                Scaler.scale(loss).backward()
-                Scaler.unscale_(optimizer)
-
-            else:
-                loss.backward()
-
-            # Applying norm on gradients to reduce shock of the model
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            
-            # Decay in learning rate
-            lr = get_decay_lr(GlobalSteps,
-                              WarmupSteps=WarmupSteps,
-                              MaxSteps=MaxSteps,
-                              MaxLr=MaxLr,
-                              MinLr=MinLr)
-
-            for param_group in optimizer.param_groups:
-                param_group['lr'] = lr
-
-            if not UseScaler:
-                optimizer.step() # Applying a backpropogation step
-
-            else:
-                Scaler.step(optimizer)
-                Scaler.update()
-            optimizer.zero_grad(set_to_none=True)
-
-            # Synchronizing GPU and CPU runtime
-            torch.cuda.synchronize()
-
-            # Storing output time
-            t1 = time.time()
-            dt = t1 - t0 
-
-            # Calculating Tokens processed per second
-            Lossf = loss.item() * GradAccumSteps
+                    Scaler.step(optimizer)
+                    Scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+
+            # Tokens processed by all ranks per optimizer step, used for tokens per second
             TokensProcessed = BatchSize * MaxLen * GradAccumSteps * world_size
-            TokensPerSec = TokensProcessed / dt
 
             GlobalSteps += 1
             LocalSteps += 1
-
-            '''if rank == 0 and not UseScaler:
-                print(f"Epoch: {i} | Steps: {LocalSteps} | loss: {LossAccum.item(): .2f} | lr: {lr: .5e} |{norm: .2f} | Process time: {dt*1000:.2f}ms | tok/sec: {TokensPerSec:.2f}")
-
-            elif rank == 0:
-                print(f"Epoch: {i} | Steps: {LocalSteps} | loss: {LossAccum.item(): .2f} | lr: {lr: .5e} |Process time: {dt*1000:.2f}ms | tok/sec: {TokensPerSec:.2f}")'''
-            if rank == 0:
-                print(f"Epoch: {i+1} | Steps: {LocalSteps+1} | loss: {Lossf: .2f} | lr: {lr: .5e} | Process time: {dt*1000:.2f}ms | tok/sec: {TokensPerSec:.2f}")
-
-            writer.add_scalar('Training Loss', Lossf, global_step=GlobalSteps)
-            writer.add_scalar('Training Time Per Step', dt * 1000, global_step=GlobalSteps)
-            TimeTaken += dt*1000
-            writer.add_scalar("Training Time", TimeTaken, global_step=GlobalSteps)
-
-
-            if rank == 0 and (GlobalSteps % 500 == 0 or GlobalSteps == 1):
-                with torch.no_grad():
-                    cap_text = validation(TrainModelName,
-                                          TestImgPath,
-                                          WrappedTokenizer,
-                                          model,
-                                          MaxLen)
+            EpochPosition += ItemsPerStep
+
+            StepValues = {'loss': LossAccum, 'norm': Norm, 'lr': lr}
+            if DistDataParallel:
+                CommBytes, CommTime = CommStats.step()
+                StepValues['comm_mb'] = CommBytes / 2**20
+                StepValues['comm_ms'] = CommTime * 1000
+            Metrics.end_step(GlobalSteps,
+                             Tokens=TokensProcessed,
+                             Epoch=i+1,
+                             LocalStep=LocalSteps,
+                             **StepValues)
+
+
+            if rank == 0 and (GlobalSteps % ValInterval == 0 or GlobalSteps == 1):
+                cap_text = Validator(raw_model, GlobalSteps)
+
+            # Periodic checkpoint (every rank calls it, rank 0 writes it)
+            if CheckpointInterval and GlobalSteps % CheckpointInterval == 0:
+                save_checkpoint(CheckpointPath,
+                                model,
+                                optimizer,
+                                Epoch=i,
+                                GlobalStep=GlobalSteps,
+                                Scaler=Scaler,
+                                rank=rank,
+                                end_epoch=EndEpochs,
+                                epoch_position=EpochPosition,
+                                **({'comm_hook': HookConf} if DistDataParallel else {}))
+
+        EpochPosition = 0
+
+    Metrics.close()
+    if rank == 0:
+        Validator.join()
+        save_compile_cache(CompileConf.get('cache_dir'))
     writer.close()
     
 
-    if DistDataParallel and rank == 0 and UseScaler:
-
-        ModelName = 'caption_model.pt'
-        torch.save({
-            'epoch': Epochs,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'global_step': GlobalSteps,
-            'scaler': Scaler.state_dict()
-            }, ModelName)
-
-    elif UseScaler:
-
-        ModelName = 'caption_model.pt'
-        torch.save({
-            'epoch': Epochs,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'global_step': GlobalSteps,
-            'scaler': Scaler.state_dict()
-            }, ModelName)
-
-    elif DistDataParallel and rank == 0:
-
-        ModelName = 'caption_model.pt'
-        torch.save({
-            'epoch': Epochs,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'global_step': GlobalSteps
-            }, ModelName)
-    else: 
-
-        ModelName = 'caption_model.pt'
-        torch.save({
-            'epoch': Epochs,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'global_step': GlobalSteps
-            }, ModelName)
+    # Saving the checkpoint (rank 0 writes it)
+    save_checkpoint(FinalPath,
+                    model,
+                    optimizer,
+                    Epoch=EndEpochs,
+                    GlobalStep=GlobalSteps,
+                    Scaler=Scaler,
+                    rank=rank,
+                    **({'comm_hook': HookConf} if DistDataParallel else {}))
+
+    # The run is finished, its periodic checkpoint must not be resumed
+    if rank == 0 and CheckpointPath != FinalPath and os.path.exists(CheckpointPath):
+        os.remove(CheckpointPath)
 
     # Destroy all parallel process
     if DistDataParallel:
@@ -540,6 +663,8 @@ def train(rank:int,
 def command_line_argument():
     parser = ArgumentParser()
     parser.add_argument('--path', dest='Path')
+    parser.add_argument('--backend', dest='Backend', help='Distributed backend (nccl or gloo)')
+    parser.add_argument('--world-size', dest='WorldSize', type=int, help='Number of training processes')
     return parser.parse_args()
 
 
@@ -547,17 +672,39 @@ def command_line_argument():
 if __name__ == "__main__":
 
     JsonPath = command_line_argument()
-    world_size = torch.cuda.device_count()
+    with open(JsonPath.Path, 'r') as f:
+        DistConf = json.load(f).get('distributed_config', {})
+
+    # Command line arguments take priority over the config
+    Backend = get_backend(JsonPath.Backend or DistConf.get('backend'))
+    ElasticEnv = get_elastic_env()
 
-    if world_size > 1 and torch.cuda.is_available():
-        mp.spawn(train,
-                 args=(world_size, JsonPath.Path),
-                 nprocs=world_size)
+    if ElasticEnv is not None:
+        '''
+        Started by torchrun, e.g.
+            torchrun --nnodes=1:4 --nproc-per-node=8 --max-restarts=3
+                     --rdzv-backend=c10d --rdzv-endpoint=HOST:PORT
+                     model.py --path config.json
+        Failed workers are restarted by torchrun (world size may change
+        between restarts) and resume from the latest periodic checkpoint.
+        '''
+        train(ElasticEnv['rank'],
+              ElasticEnv['world_size'],
+              JsonPath.Path,
+              Backend,
+              LocalRank=ElasticEnv['local_rank'],
+              LocalWorldSize=ElasticEnv['local_world_size'],
+              Elastic=True)
 
     else:
-        rank = 0
-        world_size = 1
+        world_size = get_world_size(Backend,
+                                    JsonPath.WorldSize or DistConf.get('world_size'))
+        if world_size > 1:
+            mp.spawn(train,
+                     args=(world_size, JsonPath.Path, Backend),
+                     nprocs=world_size)
 
-        train(rank,
-              world_size,
-              JsonPath.Path)
+        else:
+            train(0,
+                  1,
+                  JsonPath.Path)
@@ -0,0 +1,130 @@
+import time
+import json
+import torch
+import warnings
+import numpy as np
+from argparse import ArgumentParser
+from base_files.cnn_model_files.cnn_model import BACKBONES, get_cnn_model, frozenbackbone
+from base_files.dataset_files.image_transforms import preprocess_images, load_image
+
+
+def profile_backbone(Name: str,
+                     Images: list,
+                     Features: str = 'logits',
+                     Runs: int = 20,
+                     Warmup: int = 3,
+                     BatchSize: int = 1) -> dict:
+    '''
+    Measures the encode latency of one backbone on the local CPU: resize, crop
+    and normalization of decoded images plus the frozen Cnn model stage, at
+    the backbone's own resolution. Latency does not depend on the weights, so
+    the model is built without downloading them.
+    '''
+    Spec = BACKBONES[Name]
+    Backbone = frozenbackbone(get_cnn_model(Pretrained=False,
+                                            Name=Name,
+                                            Features=Features),
+                              'cpu',
+                              Name=Name)
+    Batch = [Images[i % len(Images)] for i in range(BatchSize)]
+
+    PreprocessTimes, EncodeTimes = [], []
+    for Step in range(Warmup + Runs):
+        t0 = time.perf_counter()
+        img = preprocess_images(Batch, Name)
+        t1 = time.perf_counter()
+        Backbone(img)
+        t2 = time.perf_counter()
+        if Step >= Warmup:
+            PreprocessTimes.append((t1 - t0) / BatchSize)
+            EncodeTimes.append((t2 - t1) / BatchSize)
+
+    Weights = Spec.get_weights()
+    Total = np.add(PreprocessTimes, EncodeTimes) * 1000
+    return {
+            'name': Name,
+            'input': Spec.cropSize,
+            'feature_dim': Spec.feature_dim(Features),
+            'params_m': sum(p.numel() for p in Backbone.model.parameters()) / 1e6,
+            'gflops': Weights.meta.get('_ops'),
+            'imagenet_acc1': Weights.meta['_metrics']['ImageNet-1K']['acc@1'],
+            'preprocess_ms': float(np.median(PreprocessTimes) * 1000),
+            'encode_ms': float(np.median(EncodeTimes) * 1000),
+            'total_ms': float(np.median(Total)),
+            'total_p90_ms': float(np.percentile(Total, 90))
+            }
+
+
+def profile_backbones(Names: list = None,
+                      ImgPath: str = None,
+                      Features: str = 'logits',
+                      Runs: int = 20,
+                      Warmup: int = 3,
+                      BatchSize: int = 1,
+                      Threads: int = None,
+                      MinAcc: float = None) -> list:
+    '''
+    Profiles every backbone of the registry (or the given names) and prints
+    per image latency next to the ImageNet top-1 accuracy of the pretrained
+    weights. With MinAcc the fastest backbone reaching that accuracy is
+    reported. ImageNet accuracy is only a proxy of caption quality, the
+    decoder has to be trained again for another backbone.
+    '''
+    warnings.filterwarnings('ignore')
+    if Threads is not None:
+        torch.set_num_threads(Threads)
+
+    # A real image gives realistic decode sizes, otherwise a 480x640 noise image
+    if ImgPath is not None:
+        Images = [load_image(ImgPath)]
+    else:
+        Images = [torch.randint(0, 256, (3, 480, 640), dtype=torch.uint8)]
+
+    Results = []
+    print(f"CPU threads: {torch.get_num_threads()} | batch size: {BatchSize} | features: {Features}")
+    print(f"{'backbone':<20}{'input':>6}{'dim':>6}{'params(M)':>10}{'GFLOPs':>8}{'acc@1':>7}{'prep ms':>9}{'enc ms':>9}{'total ms':>9}{'p90 ms':>9}")
+    for Name in Names or list(BACKBONES):
+        with torch.inference_mode():
+            Result = profile_backbone(Name, Images, Features, Runs, Warmup, BatchSize)
+        Results.append(Result)
+        print(f"{Name:<20}{Result['input']:>6}{Result['feature_dim']:>6}{Result['params_m']:>10.2f}{Result['gflops']:>8.2f}{Result['imagenet_acc1']:>7.2f}"
+              f"{Result['preprocess_ms']:>9.2f}{Result['encode_ms']:>9.2f}{Result['total_ms']:>9.2f}{Result['total_p90_ms']:>9.2f}")
+
+    if MinAcc is not None:
+        Candidates = [Result for Result in Results if Result['imagenet_acc1'] >= MinAcc]
+        if Candidates:
+            Best = min(Candidates, key=lambda Result: Result['total_ms'])
+            print(f"Fastest backbone with acc@1 >= {MinAcc}: {Best['name']} ({Best['total_ms']:.2f}ms per image)")
+        else:
+            print(f"No backbone reaches acc@1 >= {MinAcc}")
+    return Results
+
+
+# Argument parser
+def command_line_argument():
+    parser = ArgumentParser()
+    parser.add_argument('--names', dest='Names', help='Comma separated backbones (default: every registered backbone)')
+    parser.add_argument('--ipath', dest='ImgPath', help='Image used for profiling (default: random image)')
+    parser.add_argument('--features', dest='Features', default='logits', choices=['logits', 'pooled'], help='Classifier logits or pooled features')
+    parser.add_argument('--runs', dest='Runs', type=int, default=20, help='Timed runs per backbone')
+    parser.add_argument('--warmup', dest='Warmup', type=int, default=3, help='Untimed runs per backbone')
+    parser.add_argument('--batch', dest='BatchSize', type=int, default=1, help='Images per forward pass')
+    parser.add_argument('--threads', dest='Threads', type=int, help='Number of CPU threads')
+    parser.add_argument('--min-acc', dest='MinAcc', type=float, help='Reports the fastest backbone reaching this ImageNet top-1 accuracy')
+    parser.add_argument('--out', dest='OutPath', help='Writes the results to this json file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    Args = command_line_argument()
+    Results = profile_backbones(None if Args.Names is None else Args.Names.split(','),
+                                Args.ImgPath,
+                                Args.Features,
+                                Args.Runs,
+                                Args.Warmup,
+                                Args.BatchSize,
+                                Args.Threads,
+                                Args.MinAcc)
+    if Args.OutPath is not None:
+        with open(Args.OutPath, 'w') as f:
+            json.dump(Results, f, indent=4)
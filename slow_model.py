@@ -18,7 +18,7 @@ import torch.distributed as dist
 import torch.multiprocessing as mp
 from base_files.transformer_files.dataclass import transformerconfig
 from base_files.transformer_files.transformer import transformer
-from base_files.cnn_model_files.cnn_model import get_cnn_model
+from base_files.cnn_model_files.cnn_model import get_cnn_model, get_backbone_spec, frozenbackbone
 from base_files.tokenizer_files.tokenizer import get_tokenizer, texttoid, fast_tokenizer
 from base_files.dataset_files.json_extracter import caption_extracter
 from base_files.dataset_files.image_extracter import imgextracter
@@ -170,6 +170,9 @@ def train(rank:int,
     CnnConf = data['cnn_model_config']
     ExistingPath = CnnConf['existing_path']
     SpecificDownloadPath = CnnConf['specific_download_path']
+    CnnName = CnnConf.get('name', 'efficientnet_b0')
+    CnnFeatures = CnnConf.get('features', 'logits')
+    ImgDim = get_backbone_spec(CnnName).feature_dim(CnnFeatures)
 
 
     # Creating a tokenizer
@@ -195,17 +198,26 @@ def train(rank:int,
                                vocabSize=VocabSize,
                                nLayers=NumLayers,
                                nHead=NumHeads,
-                               nEmbd=DModel)
+                               nEmbd=DModel,
+                               imgDim=ImgDim)
     
 
     # Downloading the Cnn model
     if ExistingPath is not None and SpecificDownloadPath is not None:
-        efficient5 = get_cnn_model(DModel=DModel,
-                                  ExistingPath=ExistingPath,
-                                  SpecificDownloadPath=SpecificDownloadPath)
+        CnnModel = get_cnn_model(ExistingPath=ExistingPath,
+                                 SpecificDownloadPath=SpecificDownloadPath,
+                                 Name=CnnName,
+                                 Features=CnnFeatures)
 
     else:
-        efficient5 = get_cnn_model(DModel=DModel)
+        CnnModel = get_cnn_model(Name=CnnName,
+                                 Features=CnnFeatures)
+
+    # The Cnn model runs as a frozen stage in front of the decoder
+    Backbone = frozenbackbone(CnnModel,
+                              device,
+                              dtype=CnnConf.get('dtype'),
+                              Name=CnnName)
 
 
     # Loading caption data into dataloader
@@ -225,7 +237,8 @@ def train(rank:int,
 
 
     # Loading Image data into dataloader
-    ImgDataClass = imgextracter(dataframe=TrainData)
+    ImgDataClass = imgextracter(dataframe=TrainData,
+                                CnnName=CnnName)
 
 
     if DistDataParallel:
@@ -242,8 +255,7 @@ def train(rank:int,
     # Initializing the transformer model
     if bf16:
         torch.set_float32_matmul_precision('high')
-    model = transformer(config=config,
-                        CnnModel=efficient5)
+    model = transformer(config=config)
     model.to(device) 
 
     # Adding grad scaler for mixed precision
@@ -334,9 +346,9 @@ def train(rank:int,
                 if bf16:
                     with torch.autocast(device_type=device_type,
                                         dtype=torch.bfloat16):
-                        logits = model(DecoderInput, img)
+                        logits = model(DecoderInput, Backbone(img))
                 else:
-                    logits = model(DecoderInput, img)
+                    logits = model(DecoderInput, Backbone(img))
 
                 loss = F.cross_entropy(logits.view(-1, logits.size(-1)),
                                        Label.view(-1))
@@ -436,10 +448,12 @@ def train(rank:int,
 
             if rank == 0:
                 with torch.no_grad():
-                    cap_text = validation(TestImgPath,
+                    cap_text = validation('gpt-2',
+                                          TestImgPath,
                                           WrappedTokenizer,
                                           model,
-                                          MaxLen)
+                                          MaxLen,
+                                          Backbone)
                 with open("validation_output.txt", 'a') as f:
                     f.write(cap_text + "\n")
 
@@ -1,9 +1,12 @@
+import time
 import torch
-from torch.cuda import temperature
-from torchvision.transforms import v2
-from torchvision.io import read_image
-import torch.nn.functional as F
+import torch.multiprocessing as mp
 import warnings
+from base_files.dataset_files.image_transforms import preprocess_images
+from base_files.inference_files.generator import generate_captions
+from base_files.inference_files.model_loader import build_decoder
+from base_files.cnn_model_files.cnn_model import get_cnn_model, frozenbackbone
+from base_files.runtime_files.precision import precisionpolicy
 
 
 # Setting the seed
@@ -12,84 +15,202 @@ if torch.cuda.is_available():
     torch.cuda.manual_seed(1337)
 
 
-def validation(ModelName:str,
-               ImgPath:str,
+def run_validation(model,
+                   Features: torch.Tensor,
+                   tokenizer,
+                   TokenSize: int,
+                   Temprature: float,
+                   Topk: int,
+                   Precision: precisionpolicy = None) -> dict:
+    '''
+    Captions every validation image in one batch and returns the captions
+    with timing metrics.
+    '''
+    device = next(model.parameters()).device
+    if Precision is None:
+        Precision = precisionpolicy('fp32', device.type)
+    StartTok = tokenizer.convert_tokens_to_ids('<|start_of_text|>')
+    EndTok = tokenizer.convert_tokens_to_ids('<|end_of_text|>')
+
+    SampleRng = torch.Generator(device=device)
+    SampleRng.manual_seed(1337)
+
+    t0 = time.time()
+    Training = model.training
+    model.eval()
+    with torch.no_grad(), Precision.autocast():
+        ImgEmbd = model.encode_image(Features.to(device))
+        Tokens = generate_captions(model,
+                                   ImgEmbd,
+                                   TokenSize,
+                                   StartTok=StartTok,
+                                   EndTok=EndTok,
+                                   Temprature=Temprature,
+                                   Topk=Topk,
+                                   SampleRng=SampleRng)
+    model.train(Training)
+    dt = time.time() - t0
+
+    NumTokens = sum(len(Row) - 1 for Row in Tokens)
+    return {
+            'captions': [tokenizer.decode(Row, skip_special_tokens=True)
+                         for Row in Tokens],
+            'time': dt,
+            'tokens_per_sec': NumTokens / dt,
+            'caption_length': NumTokens / len(Tokens)
+            }
+
+
+def write_validation(writer,
+                     Result: dict,
+                     GlobalStep: int):
+    # Reporting validation metrics of a step to tensorboard
+    writer.add_scalar('Validation Time', Result['time'] * 1000, global_step=GlobalStep)
+    writer.add_scalar('Validation Tokens Per Sec', Result['tokens_per_sec'], global_step=GlobalStep)
+    writer.add_scalar('Validation Caption Length', Result['caption_length'], global_step=GlobalStep)
+    writer.add_text('Validation Captions',
+                    '\n\n'.join(Result['captions']),
+                    global_step=GlobalStep)
+    for Caption in Result['captions']:
+        print(f"Caption: {Caption}\n")
+
+
+def _background_validation(config,
+                           StateDict: dict,
+                           Features: torch.Tensor,
+                           tokenizer,
+                           TokenSize: int,
+                           Temprature: float,
+                           Topk: int,
+                           LogDir: str,
+                           GlobalStep: int,
+                           dtype: str):
+    # Runs inside a separate process on a CPU copy of the weights
+    from torch.utils.tensorboard import SummaryWriter
+    warnings.filterwarnings('ignore')
+
+    model = build_decoder(config)
+    model.load_state_dict(StateDict)
+    Result = run_validation(model,
+                            Features,
+                            tokenizer,
+                            TokenSize,
+                            Temprature,
+                            Topk,
+                            precisionpolicy(dtype, 'cpu'))
+
+    writer = SummaryWriter(log_dir=LogDir)
+    write_validation(writer, Result, GlobalStep)
+    writer.close()
+
+
+def validation(ModelName: str,
+               ImgPath: str,
                tokenizer,
                model,
-               TokenSize):
+               TokenSize: int,
+               Backbone: frozenbackbone = None) -> str:
+    '''
+    Captions a single image, kept for older training scripts. The decoder no
+    longer holds the Cnn model, a default frozen backbone is created when
+    none is given. ModelName is not needed anymore (every decoder has
+    encode_image and decode).
+    '''
+    warnings.filterwarnings('ignore')
+    # DDP wrapped models are unwrapped
+    model = getattr(model, 'module', model)
+    device = next(model.parameters()).device
+    if Backbone is None:
+        Backbone = frozenbackbone(get_cnn_model(), device)
 
-    Temprature = 0.64
-    Topk = 100
-    device = 'cpu'
+    Result = run_validation(model,
+                            Backbone(preprocess_images([ImgPath], Backbone.name)),
+                            tokenizer,
+                            TokenSize,
+                            Temprature=0.64,
+                            Topk=100)
+    print(f"Caption: {Result['captions'][0]}\n")
+    return Result['captions'][0]
 
-    # Use GPU if it is available
-    if torch.cuda.is_available():
-        device = 'cuda'
 
-    # Use MPS if it is available(Apple devices only)
-    elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-        device = 'mps'
-        
+class validator:
+    '''
+    Validation during training. Validation images are read, transformed and
+    passed through the frozen Cnn model once, each call captions all of them
+    as a single batch with incremental (key/value cached) decoding.
 
-    # Filtering the warnings
-    warnings.filterwarnings('ignore')
+    With Background=True the weights are copied to CPU and captioning runs in
+    a separate process, so training ranks do not wait for it.
+    '''
+    def __init__(self,
+                 ImgPaths,
+                 Backbone,
+                 tokenizer,
+                 config,
+                 TokenSize: int,
+                 writer=None,
+                 Temprature: float = 0.64,
+                 Topk: int = 100,
+                 Background: bool = False,
+                 Precision: precisionpolicy = None):
 
-    
-    # Creating a transform image object
-    transform = v2.Compose([
-        v2.Resize(size=[489,456], antialias=True),
-	    v2.Resize(size=[256,224], antialias=True),
-        v2.ToDtype(torch.float, scale=True),
-        v2.RandomRotation(degrees=(0,180)),
-        v2.CenterCrop(224),
-        v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
-
-    # Reading the image and transforming the image
-    img = transform(read_image(ImgPath))
-
-    '''Creating caption for Image'''
-    model.eval()
-    # NumReturnSequences = 4
-    CurrentTok = tokenizer.convert_tokens_to_ids('<|start_of_text|>')
-    XGen = torch.tensor([CurrentTok], dtype=torch.long)
-    XGen = XGen.unsqueeze(0)
-    XGen = XGen.to(device)
-
-    img = img.unsqueeze(0)#.repeat(NumReturnSequences, 1, 1)
-    img = img.to(device)
-    SampleRng = torch.Generator(device=device)
-    SampleRng.manual_seed(1337)
-    if ModelName == 'llama-2':
-        values = XGen
-    for x in range(TokenSize):
-
-        # forwarding the model
-        if ModelName == 'llama-2':
-            logits = model(XGen, img, StartPos=x)
-        else:
-            logits = model(XGen, img)
-        # Take the logits at last position
-        logits = logits[:, -1, :] / Temprature
-        # Topk
-        v, _ = torch.topk(logits, min(Topk, logits.size(-1)))
-        logits[logits < v[:, [-1]]] = -float('Inf')
-        # Get the probablities
-        probs = F.softmax(logits, dim=-1)
-        # TopK sampling
-        ix = torch.multinomial(probs, num_samples=1, generator=SampleRng) # (B, 1)
-
-        # gather the corresponding indices
-        if ModelName == 'llama-2':
-            XGen = ix
-            values = torch.cat((values, ix), dim=1)
-        else:
-            XGen = torch.cat((XGen, ix), dim=1)
-
-        if ix[0] == 1:
-            break
-    if ModelName == 'llama-2':
-        XGen = values
-    Decoded = tokenizer.decode(XGen[0], skip_special_tokens=True)
-    print(f"Caption: {Decoded}\n")
-    return Decoded
+        if isinstance(ImgPaths, str):
+            ImgPaths = [ImgPaths]
+
+        # Backbone is frozen, so features of the validation images never change
+        self.features = Backbone(preprocess_images(ImgPaths, Backbone.name))
+        self.tokenizer = tokenizer
+        self.config = config
+        self.TokenSize = TokenSize
+        self.writer = writer
+        self.Temprature = Temprature
+        self.Topk = Topk
+        self.Background = Background
+        self.Precision = Precision
+        self.process = None
+
+    def __call__(self, model, GlobalStep: int):
+        # Compiled and DDP wrapped models are unwrapped
+        model = getattr(model, 'module', model)
+        model = getattr(model, '_orig_mod', model)
+
+        if not self.Background:
+            Result = run_validation(model,
+                                    self.features,
+                                    self.tokenizer,
+                                    self.TokenSize,
+                                    self.Temprature,
+                                    self.Topk,
+                                    self.Precision)
+            if self.writer is not None:
+                write_validation(self.writer, Result, GlobalStep)
+            return Result['captions']
+
+        # Only one background validation runs at a time
+        self.join()
+        StateDict = {Key: Value.detach().to('cpu', copy=True)
+                     for Key, Value in model.state_dict().items()}
+        LogDir = self.writer.log_dir if self.writer is not None else None
+        # Mixed precision runs as bf16 autocast inside the CPU process
+        dtype = 'fp32' if self.Precision is None or self.Precision.dtype is None else 'bf16'
+        self.process = mp.get_context('spawn').Process(
+                target=_background_validation,
+                args=(self.config,
+                      StateDict,
+                      self.features.cpu(),
+                      self.tokenizer,
+                      self.TokenSize,
+                      self.Temprature,
+                      self.Topk,
+                      LogDir,
+                      GlobalStep,
+                      dtype),
+                daemon=True)
+        self.process.start()
+        return None
+
+    def join(self):
+        # Waiting for the running background validation
+        if self.process is not None:
+            self.process.join()
+            self.process = None